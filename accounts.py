@@ -0,0 +1,226 @@
+import asyncio
+import multiprocessing
+import re
+import secrets
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from starlette.concurrency import run_in_threadpool
+
+import settings
+from cache import MISSING, LRUCache
+from database import get_connection, load_secret_file
+from db_async import db
+
+ALGORITHM = "HS256"
+USERNAME_PATTERN = re.compile(r"^[A-Za-z0-9_.-]{3,32}$")
+PASSWORD_MIN_LENGTH = 8
+# bcrypt учитывает только первые 72 байта пароля -- длиннее не принимаем, чтобы хвост не игнорировался молча
+PASSWORD_MAX_BYTES = 72
+USERNAME_TAKEN = "Логин уже занят"
+
+
+# очередь к bcrypt переполнена -- вход отвечает 503, а не копит запросы
+class PasswordHasherBusy(Exception):
+    pass
+
+
+# bcrypt занимает процессор на сотни миллисекунд: в потоках он держал бы общий threadpool
+# (и GIL на время работы passlib), поэтому считаем его в отдельных процессах. Очередь ограничена:
+# при max_pending ожидающих проверок следующие сразу получают PasswordHasherBusy
+class PasswordHasher:
+    def __init__(self, workers: int, max_pending: int):
+        self.workers = workers
+        self.max_pending = max_pending
+        self._executor = None
+        self._dummy_hash = None
+        # меняется только в цикле событий, блокировка не нужна
+        self._pending = 0
+        self.calls = 0
+        self.rejected = 0
+        self.total_ms = 0.0
+
+    # пул создается при первой проверке пароля: воркер, к которому не приходят входы, его не держит
+    def start(self):
+        if self.workers <= 0 or self._executor is not None:
+            return
+        # spawn, а не fork: процесс воркера уже многопоточный (пулы базы, фоновые задачи)
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")
+        )
+
+    def stop(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    async def run(self, fn, *args):
+        if self._pending >= self.max_pending:
+            self.rejected += 1
+            raise PasswordHasherBusy()
+        self._pending += 1
+        started = time.perf_counter()
+        try:
+            self.start()
+            if self._executor is None:
+                return await run_in_threadpool(fn, *args)
+            return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+        finally:
+            self._pending -= 1
+            self.calls += 1
+            self.total_ms += (time.perf_counter() - started) * 1000
+
+    # passlib импортируем при первом использовании: нужен он в процессах пула, а не при старте воркера
+    async def hash(self, password: str) -> str:
+        from passwords import hash_password
+        return await self.run(hash_password, password)
+
+    # для несуществующего пользователя тоже проверяем пароль (против случайного хэша),
+    # чтобы по времени ответа нельзя было узнать, есть ли такой логин
+    async def verify(self, password: str, password_hash: str = None) -> bool:
+        from passwords import verify_password
+        if password_hash is None:
+            if self._dummy_hash is None:
+                self._dummy_hash = await self.hash(secrets.token_hex(16))
+            await self.run(verify_password, password, self._dummy_hash)
+            return False
+        return await self.run(verify_password, password, password_hash)
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "pending": self._pending,
+            "max_pending": self.max_pending,
+            "calls": self.calls,
+            "rejected": self.rejected,
+            "avg_ms": round(self.total_ms / self.calls, 1) if self.calls else 0.0,
+        }
+
+
+# ключ подписи: из настроек или общий для всех процессов файл рядом с базой (database.load_secret_file)
+def load_secret_key(path: str) -> str:
+    if settings.SECRET_KEY:
+        return settings.SECRET_KEY
+    return load_secret_file(path)
+
+
+# JWT доступа и кэш уже проверенных: повторные запросы с тем же токеном не проверяют подпись.
+# Запись живет не дольше ttl и не дольше самого токена; отвергнутые токены не кэшируем,
+# чтобы мусорные заголовки не вытесняли настоящие
+class TokenService:
+    def __init__(self, expire_minutes: int, cache_size: int, cache_ttl: float):
+        self.expire_minutes = expire_minutes
+        self.cache = LRUCache(cache_size, cache_ttl)
+        self._secret_key = None
+        self.verified = 0
+        self.rejected = 0
+
+    @property
+    def secret_key(self) -> str:
+        if self._secret_key is None:
+            self._secret_key = load_secret_key(settings.DB_PATH + ".secret")
+        return self._secret_key
+
+    def issue(self, user_id: int, username: str) -> str:
+        from jose import jwt
+        now = int(time.time())
+        claims = {"sub": str(user_id), "name": username, "iat": now, "exp": now + self.expire_minutes * 60}
+        return jwt.encode(claims, self.secret_key, algorithm=ALGORITHM)
+
+    # (user_id, username) или None
+    def verify(self, token: str):
+        cached = self.cache.get(token)
+        if cached is not MISSING:
+            user_id, username, expires_ts = cached
+            if expires_ts > time.time():
+                return user_id, username
+            self.cache.invalidate(token)
+            return None
+        # python-jose тянет cryptography -- импортируем при первом токене, а не при старте
+        from jose import JWTError, jwt
+        try:
+            claims = jwt.decode(token, self.secret_key, algorithms=[ALGORITHM])
+            user = int(claims["sub"]), claims.get("name"), claims["exp"]
+        except (JWTError, KeyError, TypeError, ValueError):
+            self.rejected += 1
+            return None
+        self.verified += 1
+        self.cache.set(token, user)
+        return user[:2]
+
+    def stats(self) -> dict:
+        return {
+            "expire_minutes": self.expire_minutes,
+            "verified": self.verified,
+            "rejected": self.rejected,
+            "cache": self.cache.stats(),
+        }
+
+
+def validate_credentials(username: str, password: str):
+    if not USERNAME_PATTERN.match(username or ""):
+        return "Логин: от 3 до 32 символов, латинские буквы, цифры, '.', '_' и '-'"
+    if len(password or "") < PASSWORD_MIN_LENGTH:
+        return f"Пароль должен быть не короче {PASSWORD_MIN_LENGTH} символов"
+    if len(password.encode()) > PASSWORD_MAX_BYTES:
+        return f"Пароль должен быть не длиннее {PASSWORD_MAX_BYTES} байт"
+    return None
+
+
+# id нового пользователя или None, если логин занят (без учета регистра)
+def insert_user(username: str, password_hash: str):
+    conn = get_connection()
+    try:
+        with conn:
+            return conn.execute(
+                "INSERT INTO users (username, password_hash, created_ts) VALUES (?, ?, ?)",
+                (username, password_hash, int(time.time()))
+            ).lastrowid
+    except sqlite3.IntegrityError:
+        return None
+    finally:
+        conn.close()
+
+
+# (id, username, password_hash) или None
+def find_user(username: str):
+    conn = get_connection()
+    try:
+        return conn.execute(
+            "SELECT id, username, password_hash FROM users WHERE username = ?", (username,)
+        ).fetchone()
+    finally:
+        conn.close()
+
+
+# (user_id, None) или (None, текст ошибки)
+async def register(username: str, password: str):
+    error = validate_credentials(username, password)
+    if error:
+        return None, error
+    # заранее проверяем логин, чтобы не тратить bcrypt на заведомо занятый
+    if await db.run(find_user, username):
+        return None, USERNAME_TAKEN
+    user_id = await db.run(insert_user, username, await password_hasher.hash(password))
+    if user_id is None:
+        return None, USERNAME_TAKEN
+    return user_id, None
+
+
+# (user_id, username) или None
+async def authenticate(username: str, password: str):
+    password = password or ""
+    row = await db.run(find_user, username) if username else None
+    # такой длинный пароль зарегистрировать нельзя, а bcrypt на нем падает
+    if row is None or len(password.encode()) > PASSWORD_MAX_BYTES:
+        await password_hasher.verify("")
+        return None
+    user_id, username, password_hash = row
+    if not await password_hasher.verify(password, password_hash):
+        return None
+    return user_id, username
+
+
+password_hasher = PasswordHasher(settings.PASSWORD_HASH_WORKERS, settings.PASSWORD_HASH_MAX_PENDING)
+tokens = TokenService(settings.ACCESS_TOKEN_EXPIRE_MINUTES, settings.TOKEN_CACHE_SIZE, settings.TOKEN_CACHE_TTL)
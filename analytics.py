@@ -0,0 +1,221 @@
+import sqlite3
+import threading
+import time
+from urllib.parse import urlsplit
+
+import settings
+from storage import storage
+
+# размер корзины в секундах для каждой гранулярности
+GRANULARITIES = {"minute": 60, "hour": 3600, "day": 86400}
+# разрезы, которые считаем по дням: имя разреза -> колонка click_events
+DIMENSIONS = {"referrer": "referrer_host", "agent": "agent"}
+# в sequences храним id последнего свернутого события
+WATERMARK_NAME = "click_events_rolled"
+# подстроки user-agent (в нижнем регистре) для грубой классификации клиента
+BOT_MARKERS = ("bot", "crawl", "spider", "slurp", "curl", "wget", "python", "preview")
+MOBILE_MARKERS = ("mobile", "android", "iphone", "ipad")
+
+
+# фоновая свертка сырых событий (click_events) в агрегаты по минутам/часам/дням:
+# события с id после водяной отметки складываются в click_rollups и click_breakdowns
+# одной транзакцией вместе с новой отметкой, поэтому ничего не считается дважды.
+# Старые события и поминутные агрегаты удаляются по сроку хранения
+class RollupWorker:
+    def __init__(self, interval: float, batch_size: int, event_retention_days: int, minute_retention_days: int):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.event_retention = event_retention_days * 86400
+        self.minute_retention = minute_retention_days * 86400
+        self._stopped = threading.Event()
+        self._thread = None
+        self.passes = 0
+        self.rolled_total = 0
+        self.pruned_total = 0
+        self.last_rolled = 0
+        self.last_duration = 0.0
+        self.last_run_at = None
+
+    def roll_batch(self, shard) -> int:
+        conn = shard.connect()
+        try:
+            with conn:
+                # блокировку записи берем сразу: если свертку запустят два процесса,
+                # второй прочитает отметку уже после коммита первого и не посчитает события дважды
+                conn.execute("BEGIN IMMEDIATE")
+                row = conn.execute("SELECT next_value FROM sequences WHERE name = ?", (WATERMARK_NAME,)).fetchone()
+                low = row[0] if row else 0
+                high, count = conn.execute(
+                    "SELECT MAX(id), COUNT(*) FROM (SELECT id FROM click_events WHERE id > ? ORDER BY id LIMIT ?)",
+                    (low, self.batch_size)
+                ).fetchone()
+                if not count:
+                    return 0
+                # события удаленных ссылок не сворачиваем, иначе их унаследует новая ссылка с тем же алиасом
+                for granularity, size in GRANULARITIES.items():
+                    conn.execute(
+                        """INSERT INTO click_rollups (short_code, granularity, bucket_ts, clicks)
+                        SELECT short_code, ?, ts - ts % ?, SUM(clicks) FROM click_events
+                        WHERE id > ? AND id <= ? AND short_code IN (SELECT short_code FROM links)
+                        GROUP BY short_code, ts - ts % ?
+                        ON CONFLICT (short_code, granularity, bucket_ts) DO UPDATE SET clicks = clicks + excluded.clicks""",
+                        (granularity, size, low, high, size)
+                    )
+                for dimension, column in DIMENSIONS.items():
+                    conn.execute(
+                        f"""INSERT INTO click_breakdowns (short_code, dimension, day_ts, value, clicks)
+                        SELECT short_code, ?, ts - ts % 86400, COALESCE({column}, ''), SUM(clicks) FROM click_events
+                        WHERE id > ? AND id <= ? AND short_code IN (SELECT short_code FROM links)
+                        GROUP BY short_code, ts - ts % 86400, COALESCE({column}, '')
+                        ON CONFLICT (short_code, dimension, day_ts, value) DO UPDATE SET clicks = clicks + excluded.clicks""",
+                        (dimension, low, high)
+                    )
+                conn.execute(
+                    "INSERT INTO sequences (name, next_value) VALUES (?, ?) "
+                    "ON CONFLICT (name) DO UPDATE SET next_value = excluded.next_value",
+                    (WATERMARK_NAME, high)
+                )
+            return count
+        finally:
+            conn.close()
+
+    # удаляем только уже свернутые события, пачками от самых старых
+    def prune(self, shard, now: int) -> int:
+        removed = 0
+        conn = shard.connect()
+        try:
+            row = conn.execute("SELECT next_value FROM sequences WHERE name = ?", (WATERMARK_NAME,)).fetchone()
+            watermark = row[0] if row else 0
+            while not self._stopped.is_set():
+                with conn:
+                    deleted = conn.execute(
+                        """DELETE FROM click_events WHERE id IN (
+                            SELECT id FROM click_events WHERE id <= ? ORDER BY id LIMIT ?
+                        ) AND ts < ?""",
+                        (watermark, self.batch_size, now - self.event_retention)
+                    ).rowcount
+                removed += deleted
+                if deleted < self.batch_size:
+                    break
+            with conn:
+                conn.execute(
+                    "DELETE FROM click_rollups WHERE granularity = 'minute' AND bucket_ts < ?",
+                    (now - self.minute_retention,)
+                )
+        finally:
+            conn.close()
+        return removed
+
+    def run_once(self) -> int:
+        started = time.perf_counter()
+        now = int(time.time())
+        rolled = 0
+        # у каждого шарда свои события, агрегаты и водяная отметка
+        for shard in storage.shards:
+            while not self._stopped.is_set():
+                count = self.roll_batch(shard)
+                rolled += count
+                if count < self.batch_size:
+                    break
+            self.pruned_total += self.prune(shard, now)
+        self.passes += 1
+        self.rolled_total += rolled
+        self.last_rolled = rolled
+        self.last_duration = time.perf_counter() - started
+        self.last_run_at = now
+        return rolled
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.run_once()
+            except sqlite3.Error:
+                pass
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="click-rollups", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def stats(self) -> dict:
+        return {
+            "interval": self.interval,
+            "batch_size": self.batch_size,
+            "passes": self.passes,
+            "rolled_total": self.rolled_total,
+            "pruned_total": self.pruned_total,
+            "last_rolled": self.last_rolled,
+            "last_duration_ms": round(self.last_duration * 1000, 3),
+            "last_run_at": self.last_run_at,
+        }
+
+
+# хост реферера без порта и "www."; None -- прямой переход
+def referrer_host(referrer: str):
+    if not referrer:
+        return None
+    try:
+        host = urlsplit(referrer).hostname
+    except ValueError:
+        return None
+    if not host:
+        return None
+    return host[4:] if host.startswith("www.") else host
+
+
+# грубый класс клиента по user-agent: этого хватает для статистики и стоит пару поисков подстроки
+def classify_agent(user_agent: str) -> str:
+    if not user_agent:
+        return "unknown"
+    agent = user_agent.lower()
+    if any(marker in agent for marker in BOT_MARKERS):
+        return "bot"
+    if any(marker in agent for marker in MOBILE_MARKERS):
+        return "mobile"
+    if "mozilla" in agent or "opera" in agent:
+        return "desktop"
+    return "other"
+
+
+# чтение агрегатов: только по первичному ключу, без обращения к сырым событиям,
+# поэтому время не зависит от общего числа кликов по ссылке. Соединение -- для отчетов (connect_read)
+def fetch_buckets(short_code: str, granularity: str, since: int, until: int) -> list:
+    conn = storage.shard_for(short_code).connect_read()
+    try:
+        return conn.execute(
+            """SELECT bucket_ts, clicks FROM click_rollups
+            WHERE short_code = ? AND granularity = ? AND bucket_ts >= ? AND bucket_ts < ?
+            ORDER BY bucket_ts""",
+            (short_code, granularity, since, until)
+        ).fetchall()
+    finally:
+        conn.close()
+
+
+def fetch_breakdown(short_code: str, dimension: str, since: int, until: int, limit: int) -> list:
+    conn = storage.shard_for(short_code).connect_read()
+    try:
+        return conn.execute(
+            """SELECT value, SUM(clicks) AS total FROM click_breakdowns
+            WHERE short_code = ? AND dimension = ? AND day_ts >= ? AND day_ts < ?
+            GROUP BY value ORDER BY total DESC, value LIMIT ?""",
+            (short_code, dimension, since - since % 86400, until, limit)
+        ).fetchall()
+    finally:
+        conn.close()
+
+
+rollups = RollupWorker(
+    settings.ROLLUP_INTERVAL,
+    settings.ROLLUP_BATCH,
+    settings.EVENT_RETENTION_DAYS,
+    settings.MINUTE_ROLLUP_RETENTION_DAYS,
+)
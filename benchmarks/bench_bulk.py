@@ -0,0 +1,84 @@
+# скорость создания ссылок (links/sec): по одной через POST /shorten
+# против пакета через POST /api/links/bulk (JSON и NDJSON)
+#
+#   python benchmarks/bench_bulk.py --count 20000
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+import urllib.parse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from loadgen import HTTPConnection, free_port, start_server, stop_server  # noqa: E402
+
+
+async def bench_single(port: int, count: int, concurrency: int) -> dict:
+    counter = iter(range(count))
+    errors = 0
+
+    async def worker():
+        nonlocal errors
+        conn = HTTPConnection("127.0.0.1", port)
+        for i in counter:
+            body = urllib.parse.urlencode({"url": f"https://example.com/single/{i}"}).encode()
+            status, _, _ = await conn.request(
+                "POST", "/shorten", body, {"Content-Type": "application/x-www-form-urlencoded"}
+            )
+            errors += status != 200
+        conn.close()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    return {"mode": f"POST /shorten x{concurrency}", "links": count, "errors": errors,
+            "seconds": round(elapsed, 3), "links_per_sec": round(count / elapsed, 1)}
+
+
+async def bench_bulk(port: int, count: int, batch: int, ndjson: bool) -> dict:
+    conn = HTTPConnection("127.0.0.1", port)
+    tag = "ndjson" if ndjson else "json"
+    errors = 0
+    started = time.perf_counter()
+    for start in range(0, count, batch):
+        items = [{"url": f"https://example.com/{tag}/{i}"} for i in range(start, min(start + batch, count))]
+        if ndjson:
+            body = "".join(json.dumps(item) + "\n" for item in items).encode()
+            content_type = "application/x-ndjson"
+        else:
+            body = json.dumps({"items": items}).encode()
+            content_type = "application/json"
+        status, _, data = await conn.request("POST", "/api/links/bulk", body, {"Content-Type": content_type})
+        errors += status != 200
+    elapsed = time.perf_counter() - started
+    conn.close()
+    return {"mode": f"POST /api/links/bulk ({tag}, batch {batch})", "links": count, "errors": errors,
+            "seconds": round(elapsed, 3), "links_per_sec": round(count / elapsed, 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=5000)
+    parser.add_argument("--batch", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    args = parser.parse_args()
+
+    port = free_port()
+    with tempfile.TemporaryDirectory() as tmp:
+        server = start_server(port, {"SHORTENER_DB_PATH": os.path.join(tmp, "bench.db")})
+        try:
+            for result in (
+                asyncio.run(bench_single(port, args.count, args.concurrency)),
+                asyncio.run(bench_bulk(port, args.count, args.batch, ndjson=False)),
+                asyncio.run(bench_bulk(port, args.count, args.batch, ndjson=True)),
+            ):
+                print(json.dumps(result, ensure_ascii=False))
+        finally:
+            stop_server(server)
+
+
+if __name__ == "__main__":
+    main()
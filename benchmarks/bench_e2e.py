@@ -0,0 +1,188 @@
+# сквозной нагрузочный тест: база на N ссылок (заполняется напрямую через SQLite,
+# без HTTP, и переиспользуется между запусками), затем смесь редиректов, созданий
+# и поиска с заданной конкурентностью против локального uvicorn.
+# Результат -- один JSON (p50/p90/p99, rps по операциям, коммит, параметры);
+# два таких файла сравнивает benchmarks/compare.py
+#
+#   python benchmarks/bench_e2e.py --links 1000000 --db /tmp/bench-1m.db \
+#       --mix redirect=0.9,shorten=0.05,search=0.05 --concurrency 64 --duration 30 --output e2e.json
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from loadgen import ROOT, drive, free_port, start_server, stop_server  # noqa: E402
+
+DOMAINS = ("example.com", "docs.example.org", "shop.example.net", "news.example.io", "blog.example.dev")
+TOPICS = ("article", "product", "search", "profile", "video", "release", "report", "invoice")
+SEED_BATCH = 50000
+
+
+def seed_url(i: int) -> str:
+    return f"https://{DOMAINS[i % len(DOMAINS)]}/{TOPICS[i // 7 % len(TOPICS)]}/{i}"
+
+
+# заполняем базу до count ссылок; номера кодов берем из той же последовательности,
+# что и сервер, чтобы его новые коды не пересеклись с засеянными
+def seed(path: str, count: int) -> dict:
+    os.environ["SHORTENER_DB_PATH"] = path
+    import database
+    from shortcode import allocator, reserve_block
+
+    database.init_db()
+    conn = database.open_connection(path)
+    existing = conn.execute("SELECT COUNT(*) FROM links").fetchone()[0]
+    row = conn.execute("SELECT next_value FROM sequences WHERE name = 'bench_seed'").fetchone()
+    first = row[0] if row else None
+    started = time.perf_counter()
+    if existing < count or first is None:
+        if existing:
+            raise SystemExit(f"{path}: уже есть {existing} ссылок, для --links {count} возьмите пустой файл")
+        conn.execute("PRAGMA synchronous = OFF")
+        first = reserve_block(count)
+        now = int(time.time())
+        created_at = time.strftime(database.DEFAULT_EXPIRATION_FORMAT, time.localtime(now))
+        expires_at = "2099-01-01 00:00:00"
+        for start in range(0, count, SEED_BATCH):
+            rows = []
+            for i in range(start, min(start + SEED_BATCH, count)):
+                url = seed_url(i)
+                rows.append((
+                    url, allocator.encode(first + i), created_at, expires_at,
+                    database.url_hash(url), 4070908800, now - count + i,
+                ))
+            with conn:
+                conn.executemany(
+                    """INSERT INTO links (original_url, short_code, created_at, expires_at, url_hash, expires_ts, created_ts)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                    rows,
+                )
+            print(f"seeded {start + len(rows)}/{count}", file=sys.stderr, flush=True)
+        with conn:
+            conn.execute("INSERT INTO sequences (name, next_value) VALUES ('bench_seed', ?)", (first,))
+        conn.execute("PRAGMA optimize")
+    conn.close()
+    database.pool.close_all()
+    return {
+        "links": count,
+        "first_number": first,
+        "seconds": round(time.perf_counter() - started, 1),
+        "db_bytes": os.path.getsize(path),
+    }
+
+
+def parse_mix(value: str) -> dict:
+    mix = {}
+    for part in value.split(","):
+        name, _, weight = part.partition("=")
+        mix[name.strip()] = float(weight)
+    unknown = set(mix) - {"redirect", "shorten", "search"}
+    if unknown:
+        raise SystemExit(f"неизвестные операции в --mix: {', '.join(sorted(unknown))}")
+    return mix
+
+
+def make_mix(mix: dict, codes: list, run_id: str):
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    terms = DOMAINS + TOPICS
+
+    async def make_request(conn, i):
+        name = random.choices(names, weights)[0]
+        if name == "redirect":
+            status, _, _ = await conn.request("GET", f"/r/{random.choice(codes)}")
+            return name, status == 307
+        if name == "shorten":
+            body = urllib.parse.urlencode({"url": f"https://example.com/{run_id}/{i}"}).encode()
+            status, _, _ = await conn.request(
+                "POST", "/shorten", body, {"Content-Type": "application/x-www-form-urlencoded"}
+            )
+            return name, status == 200
+        query = urllib.parse.urlencode({"q": random.choice(terms), "limit": 20})
+        status, _, _ = await conn.request("GET", f"/admin/links/search?{query}")
+        return name, status == 200
+    return make_request
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def run(args, db_path: str) -> dict:
+    seeded = seed(db_path, args.links)
+    from shortcode import allocator
+
+    sample = random.Random(args.seed).sample(range(args.links), min(args.links, args.sample))
+    codes = [allocator.encode(seeded["first_number"] + i) for i in sample]
+    mix = parse_mix(args.mix)
+    run_id = f"run{int(time.time())}"
+
+    port = free_port()
+    server = start_server(port, {"SHORTENER_DB_PATH": db_path, "SHORTENER_ADMIN_TOKEN": ""}, args.workers)
+    try:
+        if args.warmup > 0:
+            asyncio.run(drive("127.0.0.1", port, args.concurrency, args.warmup, make_mix(mix, codes, run_id + "w")))
+        results = asyncio.run(drive("127.0.0.1", port, args.concurrency, args.duration, make_mix(mix, codes, run_id)))
+    finally:
+        stop_server(server)
+
+    return {
+        "benchmark": "e2e",
+        "commit": git_commit(),
+        "timestamp": int(time.time()),
+        "params": {
+            "links": args.links,
+            "mix": mix,
+            "concurrency": args.concurrency,
+            "duration": args.duration,
+            "workers": args.workers,
+        },
+        "seed": seeded,
+        "results": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--links", type=int, default=100000)
+    parser.add_argument("--db", default="", help="файл базы; если уже засеян на --links, переиспользуется")
+    parser.add_argument("--mix", default="redirect=0.9,shorten=0.05,search=0.05")
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--duration", type=float, default=20.0)
+    parser.add_argument("--warmup", type=float, default=3.0)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--sample", type=int, default=10000, help="сколько разных кодов дергать редиректами")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default="", help="куда записать JSON (по умолчанию только stdout)")
+    args = parser.parse_args()
+
+    if args.db:
+        report = run(args, os.path.abspath(args.db))
+    else:
+        with tempfile.TemporaryDirectory() as tmp:
+            report = run(args, os.path.join(tmp, "bench.db"))
+
+    text = json.dumps(report, ensure_ascii=False)
+    print(text)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+# нагрузочное сравнение режимов доступа к базе (SHORTENER_DB_EXECUTOR_MODE):
+# "dedicated" -- свои потоки с очередью, "threadpool" -- общий threadpool
+#
+#   python benchmarks/bench_load.py --concurrency 64 --duration 10
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import urllib.parse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from loadgen import drive, free_port, start_server, stop_server, HTTPConnection  # noqa: E402
+
+CODE_RE = re.compile(rb'href="/r/([\w-]+)"')
+
+
+async def seed(port: int, count: int) -> list:
+    conn = HTTPConnection("127.0.0.1", port)
+    codes = []
+    for i in range(count):
+        body = urllib.parse.urlencode({"url": f"https://example.com/seed/{i}"}).encode()
+        status, _, data = await conn.request(
+            "POST", "/shorten", body, {"Content-Type": "application/x-www-form-urlencoded"}
+        )
+        match = CODE_RE.search(data)
+        if status == 200 and match:
+            codes.append(match.group(1).decode())
+    conn.close()
+    return codes
+
+
+def make_mix(codes: list, shorten_ratio: float, run_id: str):
+    async def make_request(conn, i):
+        if random.random() < shorten_ratio:
+            body = urllib.parse.urlencode({"url": f"https://example.com/{run_id}/{i}"}).encode()
+            status, _, _ = await conn.request(
+                "POST", "/shorten", body, {"Content-Type": "application/x-www-form-urlencoded"}
+            )
+            return "shorten", status == 200
+        status, _, _ = await conn.request("GET", f"/r/{random.choice(codes)}")
+        return "redirect", status == 307
+    return make_request
+
+
+def run_mode(mode: str, args) -> dict:
+    port = free_port()
+    with tempfile.TemporaryDirectory() as tmp:
+        env = {
+            "SHORTENER_DB_PATH": os.path.join(tmp, "bench.db"),
+            "SHORTENER_DB_EXECUTOR_MODE": mode,
+        }
+        server = start_server(port, env)
+        try:
+            codes = asyncio.run(seed(port, args.links))
+            results = asyncio.run(drive(
+                "127.0.0.1", port, args.concurrency, args.duration,
+                make_mix(codes, args.shorten_ratio, mode),
+            ))
+        finally:
+            stop_server(server)
+    return {"mode": mode, "concurrency": args.concurrency, "results": results}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--modes", default="threadpool,dedicated")
+    parser.add_argument("--links", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--shorten-ratio", type=float, default=0.1)
+    args = parser.parse_args()
+
+    for mode in args.modes.split(","):
+        print(json.dumps(run_mode(mode, args), ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
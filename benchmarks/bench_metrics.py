@@ -0,0 +1,114 @@
+# цена метрик на запрос: сколько стоит один observe()/inc() и насколько медленнее
+# редирект из кэша через все приложение с MetricsMiddleware и без нее (ASGI-вызовы в процессе,
+# без сети, чтобы разница не тонула в шуме клиента)
+#
+#   python benchmarks/bench_metrics.py --requests 20000
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def bench_observe(count: int) -> dict:
+    from metrics import Counter, Histogram, REGISTRY
+
+    histogram = Histogram("bench_seconds", "bench", ("route",))
+    counter = Counter("bench_total", "bench", ("route", "method", "status"))
+    REGISTRY.remove(histogram)
+    REGISTRY.remove(counter)
+    started = time.perf_counter()
+    for i in range(count):
+        histogram.observe(0.0003, "/r/{short_code}")
+    observe_ns = (time.perf_counter() - started) / count * 1e9
+    started = time.perf_counter()
+    for i in range(count):
+        counter.inc("/r/{short_code}", "GET", 307)
+    inc_ns = (time.perf_counter() - started) / count * 1e9
+    return {"observe_ns": round(observe_ns, 1), "inc_ns": round(inc_ns, 1)}
+
+
+async def call(app, path: str):
+    scope = {
+        "type": "http", "http_version": "1.1", "method": "GET", "scheme": "http",
+        "path": path, "raw_path": path.encode(), "root_path": "", "query_string": b"",
+        "headers": [(b"host", b"bench"), (b"user-agent", b"bench")],
+        "client": ("127.0.0.1", 1), "server": ("bench", 80),
+    }
+    status = None
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+
+    await app(scope, receive, send)
+    return status
+
+
+async def bench_redirects(app, path: str, count: int) -> float:
+    for _ in range(200):
+        await call(app, path)
+    started = time.perf_counter()
+    for _ in range(count):
+        await call(app, path)
+    return (time.perf_counter() - started) / count * 1e6
+
+
+def bench_app(count: int, rounds: int) -> dict:
+    import main
+    from metrics import MetricsMiddleware
+
+    main.storage.init_schema()
+    code = main.storage.create_link("https://example.com/bench", None, "2099-01-01 00:00:00", 4070908800)[0]
+
+    with_metrics = main.app.build_middleware_stack()
+    main.app.user_middleware = [m for m in main.app.user_middleware if m.cls is not MetricsMiddleware]
+    without_metrics = main.app.build_middleware_stack()
+
+    async def run():
+        main.db.start()
+        try:
+            # чередуем варианты, чтобы прогрев и шум делились поровну
+            on, off = [], []
+            for _ in range(rounds):
+                on.append(await bench_redirects(with_metrics, f"/r/{code}", count))
+                off.append(await bench_redirects(without_metrics, f"/r/{code}", count))
+            return min(on), min(off), await call(with_metrics, f"/r/{code}")
+        finally:
+            main.db.stop()
+
+    on, off, status = asyncio.run(run())
+    assert status == main.settings.REDIRECT_STATUS, f"редирект ответил {status}"
+    return {
+        "redirect_status": status,
+        "with_metrics_us": round(on, 2),
+        "without_metrics_us": round(off, 2),
+        "overhead_us": round(on - off, 2),
+        "overhead_pct": round((on - off) / off * 100, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["SHORTENER_DB_PATH"] = os.path.join(tmp, "bench.db")
+        # все запросы идут с одного адреса -- без этого мерили бы ответы 429
+        os.environ["SHORTENER_RATE_LIMIT"] = "0"
+        result = {"micro": bench_observe(args.requests * 10), "redirect": bench_app(args.requests, args.rounds)}
+    print(json.dumps(result, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+# микробенчмарки горячих функций без HTTP: генерация кода, проверка алиаса, разбор даты,
+# отпечаток URL, рендер страницы. Каждая функция гоняется --repeat раз по --number вызовов,
+# в отчет идут медиана и минимум нс/вызов -- одна JSON-строка на функцию
+#
+#   python benchmarks/bench_micro.py --number 100000 > micro.jsonl
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def measure(fn, number: int, repeat: int) -> dict:
+    fn()
+    runs = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(number):
+            fn()
+        runs.append((time.perf_counter() - started) / number * 1e9)
+    return {
+        "median_ns": round(statistics.median(runs), 1),
+        "min_ns": round(min(runs), 1),
+        "ops_per_sec": round(1e9 / statistics.median(runs), 1),
+    }
+
+
+def cases() -> dict:
+    import main
+    from database import url_hash
+    from rendering import render
+    from shortcode import base62_encode
+
+    main.storage.init_schema()
+    return {
+        "generate_short_code": main.generate_short_code,
+        "base62_encode": lambda: base62_encode(56800235583, 6),
+        "validate_alias_ok": lambda: main.validate_alias("my-custom-alias-2024"),
+        "validate_alias_bad": lambda: main.validate_alias("bad alias!"),
+        "parse_expiration_given": lambda: main.parse_expiration("2030-01-02 03:04:05"),
+        "parse_expiration_default": lambda: main.parse_expiration(None),
+        "parse_expiration_invalid": lambda: main.parse_expiration("02.01.2030"),
+        "url_hash": lambda: url_hash("https://example.com/some/fairly/long/path?with=query&and=more"),
+        "render_shortened": lambda: render(
+            "shortened",
+            short_url="http://localhost:8000/r/abc123",
+            short_code="abc123",
+            expires_at_str="2030-01-02 03:04:05",
+        ),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--number", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--only", default="", help="через запятую: какие функции мерить")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # generate_short_code резервирует блоки номеров в базе -- берем пустую временную
+        os.environ["SHORTENER_DB_PATH"] = os.path.join(tmp, "bench.db")
+        os.environ["SHORTENER_RATE_LIMIT"] = "0"
+        selected = set(filter(None, args.only.split(",")))
+        for name, fn in cases().items():
+            if selected and name not in selected:
+                continue
+            result = {"benchmark": name, "number": args.number, "repeat": args.repeat}
+            result.update(measure(fn, args.number, args.repeat))
+            print(json.dumps(result, ensure_ascii=False), flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+# сравнение старой схемы (md5 + 6 hex + повтор с солью) и нового аллокатора кодов
+#
+#   python benchmarks/bench_short_codes.py --count 1000000
+#
+# для старой схемы считаем коллизии и число "проверочных SELECT",
+# которые понадобились бы shorten_url; у аллокатора коллизий нет по построению
+import argparse
+import hashlib
+import itertools
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from shortcode import Scrambler, ShortCodeAllocator  # noqa: E402
+
+
+def legacy_code(url: str) -> str:
+    return hashlib.md5(url.encode()).hexdigest()[:6]
+
+
+def bench_legacy(count: int):
+    taken = set()
+    probes = collisions = failures = 0
+    started = time.perf_counter()
+    for i in range(count):
+        url = f"https://example.com/page/{i}"
+        attempts = 0
+        while True:
+            salt = str(random.randint(0, 999999)) if attempts > 0 else ""
+            code = legacy_code(url + salt)
+            probes += 1
+            if code not in taken:
+                taken.add(code)
+                break
+            collisions += 1
+            attempts += 1
+            if attempts > 5:
+                failures += 1
+                break
+    elapsed = time.perf_counter() - started
+    return {
+        "scheme": "md5[:6] + retry",
+        "codes": len(taken),
+        "collisions": collisions,
+        "probe_queries": probes,
+        "failures": failures,
+        "codes_per_sec": round(count / elapsed),
+    }
+
+
+def bench_allocator(count: int, scramble: bool, block_size: int):
+    counter = itertools.count(0, block_size)
+    allocator = ShortCodeAllocator(
+        block_size,
+        6,
+        Scrambler("bench") if scramble else None,
+        reserve=lambda size: next(counter),
+    )
+    taken = set()
+    collisions = 0
+    started = time.perf_counter()
+    for _ in range(count):
+        code = allocator.next_code()
+        if code in taken:
+            collisions += 1
+        taken.add(code)
+    elapsed = time.perf_counter() - started
+    return {
+        "scheme": "base62 sequence" + (" + feistel" if scramble else ""),
+        "codes": len(taken),
+        "collisions": collisions,
+        "probe_queries": 0,
+        "blocks_reserved": allocator.blocks,
+        "codes_per_sec": round(count / elapsed),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=200000)
+    parser.add_argument("--block-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    for result in (
+        bench_legacy(args.count),
+        bench_allocator(args.count, False, args.block_size),
+        bench_allocator(args.count, True, args.block_size),
+    ):
+        print(result)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+# холодный старт воркера: сколько стоит импорт main, старт приложения (схема, горячие ссылки,
+# фильтр кодов, фоновые потоки) и сколько проходит от запуска uvicorn до первого ответа.
+# Два сценария: пустая база (применяются все шаги схемы) и уже готовая -- обычный случай,
+# когда автоскейлинг добавляет воркер к работающему сервису. --links засевает готовую базу
+# (как bench_e2e.py), --db берет существующий файл. С --budget-ms код выхода 1, если медиана
+# времени до первого ответа на готовой базе больше бюджета
+#
+#   python benchmarks/bench_startup.py --runs 5 --links 100000 --budget-ms 1500
+import argparse
+import http.client
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+
+from loadgen import ROOT, free_port, stop_server  # noqa: E402
+
+# фазы внутри одного процесса: импорт, старт приложения, первый запрос (несуществующий код --
+# проходит фильтр кодов и базу) через ASGI напрямую
+PHASES_SCRIPT = """
+import asyncio, json, os, sys, time
+os.environ["SHORTENER_RATE_LIMIT"] = "0"
+started = time.perf_counter()
+import main
+imported = time.perf_counter()
+main.start_background_workers()
+ready = time.perf_counter()
+sys.path.insert(0, sys.argv[1])
+from bench_metrics import call
+status = asyncio.run(call(main.app, "/r/startup-probe"))
+answered = time.perf_counter()
+main.stop_background_workers()
+assert status == 404, f"несуществующий код ответил {status}"
+print(json.dumps({
+    "import_ms": (imported - started) * 1000,
+    "startup_ms": (ready - imported) * 1000,
+    "first_request_ms": (answered - ready) * 1000,
+    "status": status,
+    "migrations_applied": main.startup_stats["migrations_applied"],
+}))
+"""
+
+
+def measure_phases(env: dict) -> dict:
+    output = subprocess.run(
+        [sys.executable, "-c", PHASES_SCRIPT, BENCH_DIR], cwd=ROOT, env=env, capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+# от запуска процесса uvicorn до первого ответа на GET /, опрашиваем каждые 5 мс
+def measure_ready(env: dict) -> float:
+    port = free_port()
+    command = [
+        sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+        "--log-level", "warning", "--no-access-log",
+    ]
+    started = time.perf_counter()
+    process = subprocess.Popen(command, cwd=ROOT, env=env)
+    try:
+        while True:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+            try:
+                conn.request("GET", "/")
+                conn.getresponse().read()
+                return (time.perf_counter() - started) * 1000
+            except OSError:
+                if process.poll() is not None:
+                    raise RuntimeError("server exited during startup")
+                if time.perf_counter() - started > 60:
+                    raise RuntimeError("server did not start")
+                time.sleep(0.005)
+            finally:
+                conn.close()
+    finally:
+        stop_server(process)
+
+
+def scenario_env(db_path: str) -> dict:
+    env = dict(os.environ)
+    env.update({"SHORTENER_DB_PATH": db_path, "SHORTENER_CODE_FILTER_PATH": db_path + ".filter"})
+    return env
+
+
+def run_scenario(name: str, make_db, runs: int) -> dict:
+    phases, ready = [], []
+    for _ in range(runs):
+        env = scenario_env(make_db())
+        phases.append(measure_phases(env))
+        env = scenario_env(make_db())
+        ready.append(measure_ready(env))
+    ready.sort()
+
+    def median(key):
+        return round(statistics.median(run[key] for run in phases), 1)
+
+    return {
+        "name": f"startup/{name}",
+        "runs": runs,
+        "import_ms": median("import_ms"),
+        "startup_ms": median("startup_ms"),
+        "first_request_ms": median("first_request_ms"),
+        "migrations_applied": phases[-1]["migrations_applied"],
+        "p50_ms": round(statistics.median(ready), 1),
+        "max_ms": round(ready[-1], 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--links", type=int, default=0, help="засеять готовую базу на столько ссылок")
+    parser.add_argument("--db", default="", help="готовая база; по умолчанию временная")
+    parser.add_argument("--budget-ms", type=float, default=0, help="бюджет на время до первого ответа")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        counter = iter(range(10 ** 6))
+        existing = os.path.abspath(args.db) if args.db else os.path.join(tmp, "existing.db")
+        if args.links:
+            from bench_e2e import seed
+            seed(existing, args.links)
+        # первый запуск доводит готовую базу до последней версии схемы и строит файл фильтра
+        measure_phases(scenario_env(existing))
+
+        results = [
+            run_scenario("fresh", lambda: os.path.join(tmp, f"fresh-{next(counter)}.db"), args.runs),
+            run_scenario("existing", lambda: existing, args.runs),
+        ]
+
+    for result in results:
+        print(json.dumps(result, ensure_ascii=False))
+    if args.budget_ms and results[-1]["p50_ms"] > args.budget_ms:
+        print(f"холодный старт {results[-1]['p50_ms']} мс больше бюджета {args.budget_ms} мс", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+# выгрузка, загрузка и онлайн-копия таблицы ссылок (transfer.py): строк в секунду и пиковая
+# память процесса (должна не зависеть от числа ссылок). База засевается как в bench_e2e.py
+# (--db переиспользует файл между запусками); каждый шаг -- отдельный процесс python transfer.py:
+# выгрузка в NDJSON и CSV, загрузка NDJSON в пустую базу (индексы строятся в конце)
+# и в непустую (индексы обновляются на каждой вставке), копия засеянной базы
+#
+#   python benchmarks/bench_transfer.py --links 1000000 --db /tmp/bench-1m.db
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+
+from loadgen import ROOT  # noqa: E402
+
+
+# transfer.py и пиковая память процесса после exec (VmHWM, Linux): ru_maxrss дочернего процесса
+# включал бы память этого скрипта, скопированную при fork
+MEASURE_SCRIPT = """
+import runpy, sys
+sys.argv = ["transfer.py"] + sys.argv[1:]
+try:
+    runpy.run_path("transfer.py", run_name="__main__")
+finally:
+    with open("/proc/self/status") as f:
+        print(next(line.split()[1] for line in f if line.startswith("VmHWM")), file=sys.stderr)
+"""
+
+
+# (отчет transfer.py, секунды, пиковая память в МБ)
+def run_transfer(db_path: str, *args) -> tuple:
+    env = dict(os.environ)
+    env.update({"SHORTENER_DB_PATH": db_path, "SHORTENER_CODE_FILTER_PATH": db_path + ".filter"})
+    # отображенный в память файл базы попадает в RSS -- без него видно память самого процесса
+    env.setdefault("SHORTENER_DB_MMAP_SIZE", "0")
+    started = time.perf_counter()
+    completed = subprocess.run(
+        [sys.executable, "-c", MEASURE_SCRIPT, *args], cwd=ROOT, env=env, stderr=subprocess.PIPE, text=True
+    )
+    seconds = time.perf_counter() - started
+    if completed.returncode:
+        raise RuntimeError(f"transfer.py {args[0]} failed: {completed.stderr}")
+    *_, report, peak_kb = completed.stderr.strip().splitlines()
+    return json.loads(report), seconds, round(int(peak_kb) / 1024, 1)
+
+
+def result(name: str, rows: int, seconds: float, rss_mb: float, **extra) -> dict:
+    return {
+        "name": f"transfer/{name}",
+        "rows": rows,
+        "seconds": round(seconds, 2),
+        "rows_per_sec": round(rows / seconds),
+        "max_rss_mb": rss_mb,
+        **extra,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--links", type=int, default=200000)
+    parser.add_argument("--db", default="", help="файл засеянной базы; по умолчанию временный")
+    parser.add_argument("--batch", type=int, default=0, help="размер пачки; по умолчанию из настроек")
+    args = parser.parse_args()
+    batch = ["--batch", str(args.batch)] if args.batch else []
+
+    with tempfile.TemporaryDirectory() as tmp:
+        source = os.path.abspath(args.db) if args.db else os.path.join(tmp, "source.db")
+        from bench_e2e import seed
+        seed(source, args.links)
+        results = []
+
+        for fmt in ("ndjson", "csv"):
+            path = os.path.join(tmp, f"links.{fmt}")
+            report, seconds, rss = run_transfer(source, "export", path, "--format", fmt, *batch)
+            results.append(result(
+                f"export-{fmt}", report["rows"], seconds, rss, mb=round(os.path.getsize(path) / 1048576, 1)
+            ))
+        dump = os.path.join(tmp, "links.ndjson")
+
+        empty = os.path.join(tmp, "empty.db")
+        report, seconds, rss = run_transfer(empty, "import", dump, *batch)
+        results.append(result("import-empty", report["inserted"], seconds, rss, index_seconds=report["index_seconds"]))
+
+        # одна ссылка заранее -- индексы остаются на месте и обновляются при каждой вставке
+        indexed = os.path.join(tmp, "indexed.db")
+        with open(os.path.join(tmp, "one.ndjson"), "w") as f:
+            f.write(json.dumps({"short_code": "bench-existing", "original_url": "https://example.com/"}) + "\n")
+        run_transfer(indexed, "import", os.path.join(tmp, "one.ndjson"))
+        report, seconds, rss = run_transfer(indexed, "import", dump, *batch)
+        results.append(result("import-indexed", report["inserted"], seconds, rss))
+
+        report, seconds, rss = run_transfer(source, "backup", os.path.join(tmp, "backup"))
+        size = sum(item["bytes"] for item in report)
+        results.append(result("backup", args.links, seconds, rss, mb=round(size / 1048576, 1)))
+
+    for item in results:
+        print(json.dumps(item, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+# сравнение двух прогонов бенчмарков (например, до и после коммита):
+# понимает JSON из bench_e2e.py и JSON-строки из bench_micro.py / bench_short_codes.py / bench_startup.py /
+# bench_transfer.py.
+# Печатает изменение по каждой метрике и завершается с кодом 1, если что-то
+# ухудшилось больше чем на --threshold процентов
+#
+#   python benchmarks/compare.py base.json new.json --threshold 10
+import argparse
+import json
+import sys
+
+# метрика -> True, если больше -- лучше
+METRICS = {
+    "rps": True,
+    "ops_per_sec": True,
+    "links_per_sec": True,
+    "rows_per_sec": True,
+    "p50_ms": False,
+    "p99_ms": False,
+    "median_ns": False,
+    "import_ms": False,
+    "startup_ms": False,
+}
+
+
+def load(path: str) -> dict:
+    records = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            data = json.loads(line)
+            if data.get("benchmark") == "e2e":
+                for result in data["results"]:
+                    records[f"e2e/{result['name']}"] = result
+            else:
+                name = data.get("benchmark") or data.get("mode") or data.get("name")
+                records[str(name)] = data
+    return records
+
+
+def compare(base: dict, new: dict, threshold: float) -> list:
+    rows = []
+    for name in sorted(set(base) & set(new)):
+        for metric, higher_is_better in METRICS.items():
+            old_value = base[name].get(metric)
+            new_value = new[name].get(metric)
+            if not old_value or new_value is None:
+                continue
+            change = (new_value - old_value) / old_value * 100
+            worse = -change if higher_is_better else change
+            rows.append({
+                "name": name,
+                "metric": metric,
+                "base": old_value,
+                "new": new_value,
+                "change_pct": round(change, 1),
+                "regression": worse > threshold,
+            })
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("base")
+    parser.add_argument("new")
+    parser.add_argument("--threshold", type=float, default=10.0, help="допустимое ухудшение, %%")
+    parser.add_argument("--json", action="store_true", help="вывод JSON-строками вместо таблицы")
+    args = parser.parse_args()
+
+    rows = compare(load(args.base), load(args.new), args.threshold)
+    for row in rows:
+        if args.json:
+            print(json.dumps(row, ensure_ascii=False))
+        else:
+            mark = "  REGRESSION" if row["regression"] else ""
+            print(f"{row['name']:<32} {row['metric']:<12} {row['base']:>12} -> {row['new']:>12} "
+                  f"{row['change_pct']:>+7.1f}%{mark}")
+    sys.exit(1 if any(row["regression"] for row in rows) else 0)
+
+
+if __name__ == "__main__":
+    main()
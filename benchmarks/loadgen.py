@@ -0,0 +1,162 @@
+# минимальный асинхронный HTTP/1.1-клиент с keep-alive и генератор нагрузки
+# (только стандартная библиотека, чтобы бенчмарки не тянули зависимостей)
+import asyncio
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class HTTPConnection:
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+
+    async def _connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+
+    async def request(self, method: str, path: str, body: bytes = b"", headers: dict = None):
+        if self.writer is None:
+            await self._connect()
+        lines = [f"{method} {path} HTTP/1.1", f"Host: {self.host}:{self.port}"]
+        for name, value in (headers or {}).items():
+            lines.append(f"{name}: {value}")
+        if body or method in ("POST", "PUT"):
+            lines.append(f"Content-Length: {len(body)}")
+        self.writer.write(("\r\n".join(lines) + "\r\n\r\n").encode() + body)
+        await self.writer.drain()
+
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionError("connection closed")
+        status = int(status_line.split()[1])
+        response_headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b"\r\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            response_headers[name.strip().lower()] = value.strip()
+
+        if response_headers.get("transfer-encoding") == "chunked":
+            chunks = []
+            while True:
+                size = int((await self.reader.readline()).strip(), 16)
+                if size == 0:
+                    await self.reader.readline()
+                    break
+                chunks.append(await self.reader.readexactly(size))
+                await self.reader.readline()
+            data = b"".join(chunks)
+        else:
+            data = await self.reader.readexactly(int(response_headers.get("content-length", 0)))
+
+        if response_headers.get("connection") == "close":
+            self.close()
+        return status, response_headers, data
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+def percentile(sorted_values: list, fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarize(name: str, latencies: list, errors: int, elapsed: float) -> dict:
+    latencies = sorted(latencies)
+    return {
+        "name": name,
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p90_ms": round(percentile(latencies, 0.90) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "max_ms": round(latencies[-1] * 1000, 3) if latencies else 0.0,
+    }
+
+
+# гоняем make_request(conn, i) из concurrency соединений в течение duration секунд;
+# make_request возвращает (имя операции, ok)
+async def drive(host: str, port: int, concurrency: int, duration: float, make_request):
+    results = {}
+    stop_at = time.perf_counter() + duration
+    counter = iter(range(10 ** 12))
+
+    async def worker():
+        conn = HTTPConnection(host, port)
+        try:
+            while time.perf_counter() < stop_at:
+                i = next(counter)
+                started = time.perf_counter()
+                try:
+                    name, ok = await make_request(conn, i)
+                except (ConnectionError, asyncio.IncompleteReadError, OSError):
+                    conn.close()
+                    name, ok = "connection", False
+                latency = time.perf_counter() - started
+                latencies, errors = results.setdefault(name, ([], [0]))
+                if ok:
+                    latencies.append(latency)
+                else:
+                    errors[0] += 1
+        finally:
+            conn.close()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    return [summarize(name, latencies, errors[0], elapsed) for name, (latencies, errors) in sorted(results.items())]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+# запускаем uvicorn main:app в отдельном процессе с заданными переменными окружения;
+# при workers > 1 -- через serve.py, как в многопроцессном режиме. Нагрузка идет с одного IP,
+# поэтому ограничение запросов по умолчанию выключено (SHORTENER_RATE_LIMIT=1 включит)
+def start_server(port: int, env: dict, workers: int = 1) -> subprocess.Popen:
+    full_env = {"SHORTENER_RATE_LIMIT": "0"}
+    full_env.update(os.environ)
+    full_env.update(env)
+    if workers > 1:
+        command = [sys.executable, "serve.py", "--workers", str(workers)]
+    else:
+        command = [sys.executable, "-m", "uvicorn", "main:app"]
+    command += ["--host", "127.0.0.1", "--port", str(port), "--log-level", "warning", "--no-access-log"]
+    process = subprocess.Popen(command, cwd=ROOT, env=full_env)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/", timeout=1)
+            return process
+        except OSError:
+            if process.poll() is not None:
+                raise RuntimeError("server exited during startup")
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("server did not start")
+
+
+def stop_server(process: subprocess.Popen):
+    process.send_signal(signal.SIGINT)
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        process.kill()
@@ -0,0 +1,146 @@
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+import settings
+from database import DEFAULT_EXPIRATION_FORMAT
+from storage import storage
+
+
+# буфер кликов: редирект только увеличивает счетчик в памяти и добавляет событие
+# (время, хост реферера, класс user-agent, число кликов) в список; в базу все уходит пачкой
+# по таймеру или по размеру буфера. События потом сворачивает analytics.py.
+# Больше одного клика в событии -- отчет CDN о переходах по закэшированному редиректу.
+# Пока база не принимает запись, счетчики копятся без потерь, а событий остается не больше
+# max_events: лишние, самые старые, выбрасываются
+class ClickBuffer:
+    def __init__(self, flush_interval: float, max_pending: int, max_events: int):
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.max_events = max(max_events, 1)
+        self._pending = {}  # short_code -> [кликов, время последнего клика]
+        self._events = []  # (ts, short_code, referrer_host, agent, clicks)
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self.flushes = 0
+        self.flushed_clicks = 0
+        self.dropped_events = 0
+
+    def record(self, short_code: str, referrer_host: str = None, agent: str = None, clicks: int = 1):
+        now = time.time()
+        with self._lock:
+            item = self._pending.get(short_code)
+            if item is None:
+                self._pending[short_code] = [clicks, now]
+            else:
+                item[0] += clicks
+                item[1] = now
+            self._events.append((int(now), short_code, referrer_host, agent, clicks))
+            overflow = len(self._pending) >= self.max_pending or len(self._events) >= self.max_pending * 10
+        if overflow:
+            self._wakeup.set()
+
+    def pending(self, short_code: str) -> int:
+        with self._lock:
+            item = self._pending.get(short_code)
+            return item[0] if item else 0
+
+    def flush(self) -> int:
+        # один сброс за раз, чтобы таймер и shutdown не писали одно и то же дважды
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, {}
+                events, self._events = self._events, []
+            if not batch:
+                return 0
+            # каждый шард пишет свою часть отдельной транзакцией
+            parts = {}
+            for code, item in batch.items():
+                parts.setdefault(storage.shard_index(code), ({}, []))[0][code] = item
+            for event in events:
+                parts[storage.shard_index(event[1])][1].append(event)
+            total = 0
+            error = None
+            for index, (part, part_events) in parts.items():
+                rows = [
+                    (count, datetime.fromtimestamp(ts).strftime(DEFAULT_EXPIRATION_FORMAT), code)
+                    for code, (count, ts) in part.items()
+                ]
+                try:
+                    storage.shards[index].record_clicks(rows, part_events)
+                except sqlite3.Error as exc:
+                    # возвращаем клики в буфер, попробуем в следующий раз
+                    self._merge_back(part, part_events)
+                    error = exc
+                    continue
+                total += sum(count for count, _ in part.values())
+            self.flushes += 1
+            self.flushed_clicks += total
+            if error is not None:
+                raise error
+            return total
+
+    def _merge_back(self, batch: dict, events: list):
+        with self._lock:
+            self._events[:0] = events
+            overflow = len(self._events) - self.max_events
+            if overflow > 0:
+                del self._events[:overflow]
+                self.dropped_events += overflow
+            for code, (count, ts) in batch.items():
+                item = self._pending.get(code)
+                if item is None:
+                    self._pending[code] = [count, ts]
+                else:
+                    item[0] += count
+                    item[1] = max(item[1], ts)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except sqlite3.Error:
+                pass
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="click-flusher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def stats(self) -> dict:
+        with self._lock:
+            pending_codes = len(self._pending)
+            pending_clicks = sum(item[0] for item in self._pending.values())
+            pending_events = len(self._events)
+        return {
+            "pending_codes": pending_codes,
+            "pending_clicks": pending_clicks,
+            "pending_events": pending_events,
+            "flushes": self.flushes,
+            "flushed_clicks": self.flushed_clicks,
+            "dropped_events": self.dropped_events,
+            "flush_interval": self.flush_interval,
+            "max_pending": self.max_pending,
+            "max_events": self.max_events,
+        }
+
+
+click_buffer = ClickBuffer(
+    settings.CLICK_FLUSH_INTERVAL, settings.CLICK_FLUSH_MAX_PENDING, settings.CLICK_EVENTS_MAX_PENDING
+)
@@ -0,0 +1,357 @@
+import fcntl
+import hashlib
+import math
+import mmap
+import os
+import sqlite3
+import struct
+import threading
+import time
+from contextlib import contextmanager
+
+import settings
+from storage import storage
+
+MAGIC = b"SHCFLT01"
+# заголовок файла: magic, флаг "файл заменен новым", число хэш-функций, число счетчиков,
+# ссылок (приблизительно: повторные добавления тоже считаются), id идущей пересборки (0 -- нет),
+# время сборки; дальше -- снимок базы при закрытии последним процессом (см. close)
+HEADER = struct.Struct("<8sIIQQQQ")
+HEADER_SIZE = 64
+RETIRED_OFFSET = 8
+COUNTER = struct.Struct("<Q")
+COUNT_OFFSET = 24
+BUILDING_OFFSET = 32
+# (links_high_water + 1, links_version) базы; 0 -- снимка нет
+SNAPSHOT = struct.Struct("<QQ")
+SNAPSHOT_OFFSET = 48
+# счетчик, дошедший до максимума, больше не уменьшаем: сколько под ним кодов, уже неизвестно
+SATURATED = 255
+# пересборка вносит коды пачками и отпускает блокировку между ними, чтобы не держать писателей
+BUILD_BATCH = 10000
+
+
+# фильтр существования коротких кодов: считающий фильтр Блума (байт на счетчик) в общем файле,
+# который отображают в память все процессы (serve.py). "Нет" -- кода точно нет в базе,
+# и редирект отвечает 404 без запроса; "может быть" -- идем в базу как обычно.
+# Коды добавляются после вставки в базу и до ответа клиенту, удаление уменьшает счетчики.
+# Пересборка раз в rebuild_interval (в процессе с фоновыми задачами) убирает следы
+# насыщенных счетчиков и удалений в обход сервиса и подгоняет размер под число ссылок.
+# Если при старте других процессов с этим файлом нет (flock на .users), фильтр собирается
+# заново -- пока никто не работал, ссылки могли добавить в обход него, -- кроме случая, когда
+# последний процесс закрыл файл штатно и с тех пор база не менялась (снимок в заголовке)
+class CodeFilter:
+    def __init__(self, path: str, capacity: int, fp_rate: float, rebuild_interval: float):
+        self.path = path
+        self.capacity = capacity
+        self.fp_rate = fp_rate
+        self.rebuild_interval = rebuild_interval
+        # (mmap, (счетчиков, хэш-функций)) текущего файла и файла идущей пересборки:
+        # пару меняем целиком, чтобы читатель не взял геометрию от другого файла
+        self._current = None
+        self._next = None
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self._lock_file = None
+        self._users_file = None
+        self._stopped = threading.Event()
+        self._thread = None
+        self.definite_misses = 0
+        self.false_positives = 0
+        self.rebuilds = 0
+        self.last_build_ms = 0.0
+        self.built_on_open = False
+
+    @contextmanager
+    def _locked(self):
+        with self._lock:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    # (mmap, (счетчиков, хэш-функций)) или None
+    def _map(self, path: str):
+        try:
+            with open(path, "r+b") as f:
+                mm = mmap.mmap(f.fileno(), 0)
+        except (FileNotFoundError, ValueError):
+            return None
+        if len(mm) < HEADER_SIZE or mm[:len(MAGIC)] != MAGIC:
+            mm.close()
+            return None
+        _, _, hashes, size, _, _, _ = HEADER.unpack_from(mm, 0)
+        if len(mm) != HEADER_SIZE + size:
+            mm.close()
+            return None
+        return mm, (size, hashes)
+
+    def _create(self, path: str, expected: int):
+        # файл прерванной пересборки еще может быть отображен в других процессах:
+        # не обрезаем его, а создаем новый
+        if os.path.exists(path):
+            os.unlink(path)
+        # размер и число хэш-функций по формулам для заданной доли ложных срабатываний
+        expected = max(expected, 1)
+        size = max(64, math.ceil(-expected * math.log(self.fp_rate) / math.log(2) ** 2))
+        hashes = max(1, round(size / expected * math.log(2)))
+        with open(path, "w+b") as f:
+            f.truncate(HEADER_SIZE + size)
+            mm = mmap.mmap(f.fileno(), HEADER_SIZE + size)
+        HEADER.pack_into(mm, 0, MAGIC, 0, hashes, size, 0, 0, int(time.time()))
+        return mm, (size, hashes)
+
+    @staticmethod
+    def _positions(short_code: str, geometry) -> list:
+        size, hashes = geometry
+        first, second = struct.unpack("<QQ", hashlib.blake2b(short_code.encode(), digest_size=16).digest())
+        second |= 1
+        return [HEADER_SIZE + (first + i * second) % size for i in range(hashes)]
+
+    def _increment(self, mm, geometry, short_codes):
+        for short_code in short_codes:
+            for position in self._positions(short_code, geometry):
+                if mm[position] < SATURATED:
+                    mm[position] += 1
+        COUNTER.pack_into(mm, COUNT_OFFSET, COUNTER.unpack_from(mm, COUNT_OFFSET)[0] + len(short_codes))
+
+    def _decrement(self, mm, geometry, short_codes):
+        for short_code in short_codes:
+            for position in self._positions(short_code, geometry):
+                if 0 < mm[position] < SATURATED:
+                    mm[position] -= 1
+        count = COUNTER.unpack_from(mm, COUNT_OFFSET)[0]
+        COUNTER.pack_into(mm, COUNT_OFFSET, max(0, count - len(short_codes)))
+
+    def _fill(self, mm, geometry, locked: bool):
+        batch = []
+        for short_code in storage.iter_codes():
+            batch.append(short_code)
+            if len(batch) >= BUILD_BATCH:
+                self._fill_batch(mm, geometry, batch, locked)
+                batch = []
+        self._fill_batch(mm, geometry, batch, locked)
+
+    def _fill_batch(self, mm, geometry, batch: list, locked: bool):
+        if locked:
+            self._increment(mm, geometry, batch)
+        else:
+            with self._locked():
+                self._increment(mm, geometry, batch)
+
+    def _replace(self, tmp_path: str, mm):
+        mm.flush()
+        mm.close()
+        old = self._map(self.path)
+        os.replace(tmp_path, self.path)
+        if old is not None:
+            struct.pack_into("<I", old[0], RETIRED_OFFSET, 1)
+            old[0].close()
+        self._current = self._map(self.path)
+        self._next = None
+        self._next_id = 0
+
+    def open(self):
+        if not self.path or self._current is not None:
+            return
+        self._lock_file = open(self.path + ".lock", "a+b")
+        self._users_file = open(self.path + ".users", "a+b")
+        with self._locked():
+            try:
+                fcntl.flock(self._users_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                alone = True
+            except BlockingIOError:
+                alone = False
+            current = self._map(self.path)
+            if alone and current is not None and SNAPSHOT.unpack_from(current[0], SNAPSHOT_OFFSET) != self._snapshot():
+                current[0].close()
+                current = None
+            if current is None:
+                # остальные процессы (если есть) ждут блокировку, так что собираем целиком под ней
+                started = time.perf_counter()
+                tmp_path = self.path + ".tmp"
+                new, new_geometry = self._create(tmp_path, max(self.capacity, 2 * storage.count_links()))
+                self._fill(new, new_geometry, locked=True)
+                self._replace(tmp_path, new)
+                self.last_build_ms = round((time.perf_counter() - started) * 1000, 1)
+                self.built_on_open = True
+            else:
+                self._current = current
+            # пока процесс жив, файл считается актуальным для тех, кто стартует после него
+            fcntl.flock(self._users_file, fcntl.LOCK_SH)
+
+    # открыт ли файл работающими процессами; если нет, его все равно пересоберет следующий старт,
+    # и утилитам вроде transfer.py незачем вносить в него коды
+    def in_use(self) -> bool:
+        if not self.path:
+            return False
+        with open(self.path + ".users", "a+b") as users_file:
+            try:
+                fcntl.flock(users_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return True
+        return False
+
+    # пересборка на ходу: новые коды, вставленные в базу после начала чтения, писатели
+    # сами добавляют и в новый файл (см. add); удаления в него не вносим -- код, удаленный
+    # до начала чтения, туда не попал, и уменьшать его счетчики нельзя
+    def rebuild(self):
+        if self._current is None:
+            return
+        started = time.perf_counter()
+        tmp_path = self.path + ".tmp"
+        with self._locked():
+            current = self._writable()
+            if current is None:
+                return
+            new, new_geometry = self._create(tmp_path, max(self.capacity, 2 * storage.count_links()))
+            COUNTER.pack_into(current[0], BUILDING_OFFSET, time.time_ns())
+        self._fill(new, new_geometry, locked=False)
+        with self._locked():
+            self._replace(tmp_path, new)
+        self.rebuilds += 1
+        self.last_build_ms = round((time.perf_counter() - started) * 1000, 1)
+
+    # текущий файл под блокировкой писателя; если его пересобрали, берем новый
+    def _writable(self):
+        current = self._current
+        if current is not None and struct.unpack_from("<I", current[0], RETIRED_OFFSET)[0]:
+            self._current = current = self._map(self.path)
+        return current
+
+    # новый файл идущей пересборки (ее id записан в текущем)
+    def _building(self, current):
+        build_id = COUNTER.unpack_from(current[0], BUILDING_OFFSET)[0]
+        if not build_id:
+            return None
+        if build_id != self._next_id:
+            self._next = self._map(self.path + ".tmp")
+            self._next_id = build_id
+        return self._next
+
+    # (links_high_water + 1, links_version): вставка в обход сервиса меняет первое, удаление -- второе
+    @staticmethod
+    def _snapshot():
+        return storage.links_high_water() + 1, storage.links_version()
+
+    # последний процесс оставляет в файле снимок базы: следующий старт возьмет файл как есть,
+    # если в базе с тех пор ничего не менялось. Вызывать до закрытия хранилища
+    def close(self):
+        if self._users_file is not None:
+            with self._locked():
+                try:
+                    fcntl.flock(self._users_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    last = True
+                except BlockingIOError:
+                    last = False
+                current = self._writable()
+                if last and current is not None:
+                    try:
+                        SNAPSHOT.pack_into(current[0], SNAPSHOT_OFFSET, *self._snapshot())
+                        current[0].flush()
+                    except sqlite3.Error:
+                        pass
+        self._current = None
+        self._next = None
+        for f in (self._users_file, self._lock_file):
+            if f is not None:
+                f.close()
+        self._users_file = self._lock_file = None
+
+    def might_contain(self, short_code: str) -> bool:
+        current = self._current
+        if current is None:
+            return True
+        if struct.unpack_from("<I", current[0], RETIRED_OFFSET)[0]:
+            with self._locked():
+                current = self._writable()
+            if current is None:
+                return True
+        mm, geometry = current
+        for position in self._positions(short_code, geometry):
+            if not mm[position]:
+                self.definite_misses += 1
+                return False
+        return True
+
+    # фильтр ответил "может быть", а в базе кода не оказалось
+    def record_false_positive(self, count: int = 1):
+        self.false_positives += count
+
+    # после вставки в базу, до ответа клиенту
+    def add(self, short_codes: list):
+        if self._current is None or not short_codes:
+            return
+        with self._locked():
+            current = self._writable()
+            if current is None:
+                return
+            self._increment(*current, short_codes)
+            building = self._building(current)
+            if building is not None:
+                self._increment(*building, short_codes)
+
+    # после удаления из базы
+    def remove(self, short_codes: list):
+        if self._current is None or not short_codes:
+            return
+        with self._locked():
+            current = self._writable()
+            if current is not None:
+                self._decrement(*current, short_codes)
+
+    def _run(self):
+        while not self._stopped.wait(self.rebuild_interval):
+            try:
+                self.rebuild()
+            except (sqlite3.Error, OSError):
+                pass
+
+    def start(self):
+        if self._current is None or self.rebuild_interval <= 0 or self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="code-filter-rebuild", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def stats(self) -> dict:
+        current = self._current
+        if current is None:
+            return {"enabled": bool(self.path)}
+        mm, (size, hashes) = current
+        count = COUNTER.unpack_from(mm, COUNT_OFFSET)[0]
+        # доля ненулевых счетчиков в степени k -- ожидаемая доля ложных "может быть"
+        filled = (size - mm[HEADER_SIZE:].count(0)) / size
+        checked = self.false_positives + self.definite_misses
+        return {
+            "enabled": True,
+            "path": self.path,
+            "bytes": HEADER_SIZE + size,
+            "counters": size,
+            "hashes": hashes,
+            "links": count,
+            "bits_per_link": round(size * 8 / count, 1) if count else None,
+            "target_fp_rate": self.fp_rate,
+            "estimated_fp_rate": round(filled ** hashes, 6),
+            "definite_misses": self.definite_misses,
+            "false_positives": self.false_positives,
+            "measured_fp_rate": round(self.false_positives / checked, 6) if checked else None,
+            "built_on_open": self.built_on_open,
+            "rebuilds": self.rebuilds,
+            "last_build_ms": self.last_build_ms,
+        }
+
+
+code_filter = CodeFilter(
+    settings.CODE_FILTER_PATH if settings.CODE_FILTER_ENABLED else "",
+    settings.CODE_FILTER_CAPACITY,
+    settings.CODE_FILTER_FP_RATE,
+    settings.CODE_FILTER_REBUILD_INTERVAL,
+)
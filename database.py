@@ -1,22 +1,243 @@
+import hashlib
+import os
+import queue
+import secrets
 import sqlite3
+import threading
+import time
+import urllib.parse
 from datetime import datetime
 
+import settings
+from metrics import DB_ACQUIRE, DB_HOLD
+
 # Добавляем константу для формата даты
 DEFAULT_EXPIRATION_FORMAT = "%Y-%m-%d %H:%M:%S"  # Теперь с секундами
 
+# Регистрируем адаптеры для datetime (один раз на процесс)
+sqlite3.register_adapter(datetime, lambda dt: dt.strftime(DEFAULT_EXPIRATION_FORMAT))
 
-def get_connection():
-    conn = sqlite3.connect('shortener.db', check_same_thread=False)
-    # Добавляем преобразование дат для SQLite
-    conn.execute("PRAGMA foreign_keys = 1")
 
-    # Регистрируем адаптеры для datetime
-    sqlite3.register_adapter(datetime, lambda dt: dt.strftime(DEFAULT_EXPIRATION_FORMAT))
+# 64-битный отпечаток URL для индексированного поиска дублей
+def url_hash(url: str) -> int:
+    digest = hashlib.blake2b(url.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big", signed=True)
+
+
+# открываем новое соединение и настраиваем его.
+# read_only -- mode=ro и query_only: запись невозможна, режим журнала и synchronous не трогаем.
+# immutable -- файл никто не меняет (копия для отчетов, см. replica.py), SQLite не берет на нем блокировок
+def open_connection(path: str = None, read_only: bool = False, immutable: bool = False) -> sqlite3.Connection:
+    path = path or settings.DB_PATH
+    if read_only:
+        uri = f"file:{urllib.parse.quote(os.path.abspath(path))}?mode=ro" + ("&immutable=1" if immutable else "")
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False, timeout=settings.DB_BUSY_TIMEOUT_MS / 1000)
+    else:
+        conn = sqlite3.connect(path, check_same_thread=False, timeout=settings.DB_BUSY_TIMEOUT_MS / 1000)
+    conn.execute("PRAGMA foreign_keys = 1")
+    if read_only:
+        conn.execute("PRAGMA query_only = 1")
+    else:
+        # WAL: читатели не ждут писателя, а fsync только на checkpoint
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute(f"PRAGMA synchronous = {settings.DB_SYNCHRONOUS}")
+    conn.execute(f"PRAGMA busy_timeout = {int(settings.DB_BUSY_TIMEOUT_MS)}")
+    conn.execute(f"PRAGMA cache_size = -{int(settings.DB_CACHE_SIZE_KB)}")
+    conn.execute(f"PRAGMA mmap_size = {int(settings.DB_MMAP_SIZE)}")
+    conn.execute("PRAGMA temp_store = MEMORY")
     return conn
 
 
-def init_db():
-    conn = get_connection()
+# соединение из пула: close() возвращает его в пул вместо закрытия
+class PooledConnection:
+    def __init__(self, pool, conn: sqlite3.Connection):
+        self._pool = pool
+        self._conn = conn
+        self._acquired_at = time.perf_counter()
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __enter__(self):
+        return self._conn.__enter__()
+
+    def __exit__(self, *exc):
+        return self._conn.__exit__(*exc)
+
+    def close(self):
+        if self._conn is None:
+            return
+        conn, self._conn = self._conn, None
+        DB_HOLD.observe(time.perf_counter() - self._acquired_at)
+        self._pool.release(conn)
+
+    # страховка: забытое соединение все равно вернется в пул
+    def __del__(self):
+        self.close()
+
+
+# пул соединений: держит до size соединений и отдает их потокам по одному
+class ConnectionPool:
+    def __init__(self, path: str, size: int, timeout: float, read_only: bool = False, immutable: bool = False):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self.read_only = read_only
+        self.immutable = immutable
+        # выведенный из оборота пул (копия для чтения заменена новой): соединения закрываются
+        # по мере возврата
+        self.retired = False
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self.created = 0
+        self.in_use = 0
+        self.acquired = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.discarded = 0
+
+    def acquire(self) -> PooledConnection:
+        started = time.perf_counter()
+        conn = None
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                can_create = self.created < self.size
+                if can_create:
+                    self.created += 1
+            if can_create:
+                try:
+                    conn = open_connection(self.path, self.read_only, self.immutable)
+                except sqlite3.Error:
+                    with self._lock:
+                        self.created -= 1
+                    raise
+            else:
+                with self._lock:
+                    self.waits += 1
+                try:
+                    conn = self._idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    with self._lock:
+                        self.timeouts += 1
+                    raise sqlite3.OperationalError("connection pool exhausted")
+        with self._lock:
+            self.in_use += 1
+            self.acquired += 1
+        DB_ACQUIRE.observe(time.perf_counter() - started)
+        return PooledConnection(self, conn)
+
+    def release(self, conn: sqlite3.Connection):
+        with self._lock:
+            self.in_use -= 1
+        if self.retired:
+            with self._lock:
+                self.created -= 1
+            conn.close()
+            return
+        try:
+            # незавершенную транзакцию не отдаем следующему потоку
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            with self._lock:
+                self.created -= 1
+                self.discarded += 1
+            conn.close()
+            return
+        self._idle.put(conn)
+
+    def close_all(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self.created -= 1
+
+    def retire(self):
+        self.retired = True
+        self.close_all()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "path": self.path,
+                "size": self.size,
+                "created": self.created,
+                "idle": self._idle.qsize(),
+                "in_use": self.in_use,
+                "acquired": self.acquired,
+                "waits": self.waits,
+                "timeouts": self.timeouts,
+                "discarded": self.discarded,
+            }
+
+
+pool = ConnectionPool(settings.DB_PATH, settings.DB_POOL_SIZE, settings.DB_POOL_TIMEOUT)
+
+
+def get_connection():
+    return pool.acquire()
+
+
+# случайный ключ в файле рядом с базой, общий для всех процессов. Файл создается атомарно
+# (link не перезаписывает существующий), так что воркеры, стартующие одновременно,
+# получат один и тот же ключ
+def load_secret_file(path: str) -> str:
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        pass
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as f:
+        f.write(secrets.token_urlsafe(48))
+    try:
+        os.link(tmp_path, path)
+    except FileExistsError:
+        pass
+    finally:
+        os.unlink(tmp_path)
+    with open(path) as f:
+        return f.read().strip()
+
+
+# схема одной базы; по умолчанию -- основной файл, для шардов передается их пул (см. storage.py).
+# Вызывается при старте приложения (и из serve.py, rebalance.py), а не при импорте: база уже
+# на последней версии стоит одного чтения PRAGMA user_version. Возвращает число примененных шагов
+def init_db(connection_pool=None) -> int:
+    conn = (connection_pool or pool).acquire()
+    applied = 0
+    try:
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version < len(MIGRATIONS):
+            # шаги и номер версии -- одной транзакцией; IMMEDIATE, чтобы процессы, стартующие
+            # одновременно, применяли их по очереди, а не наперегонки
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                version = conn.execute("PRAGMA user_version").fetchone()[0]
+                for number in range(version + 1, len(MIGRATIONS) + 1):
+                    MIGRATIONS[number - 1](conn)
+                    conn.execute(f"PRAGMA user_version = {number}")
+                    applied += 1
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+        detect_search_index(conn)
+    finally:
+        conn.close()
+    return applied
+
+
+# шаг 1: схема, какой она была до появления версий. Для новой базы создает все с нуля,
+# для старой (user_version 0) повторяет прежние проверки и дозаполнения -- они идемпотентны.
+# Следующие изменения схемы -- новыми функциями в конце MIGRATIONS, без правки этой
+def migrate_baseline(conn):
     cursor = conn.cursor()
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS links (
@@ -26,11 +247,266 @@ def init_db():
             created_at TEXT DEFAULT (strftime('%Y-%m-%d %H:%M:%S', 'now', 'localtime')),
             clicks INTEGER DEFAULT 0,
             last_used_at TEXT,
-            expires_at TEXT
+            expires_at TEXT,
+            url_hash INTEGER,
+            expires_ts INTEGER,
+            created_ts INTEGER,
+            redirect_status INTEGER,
+            owner_id INTEGER
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS sequences (
+            name TEXT PRIMARY KEY,
+            next_value INTEGER NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS click_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            ts INTEGER NOT NULL,
+            short_code TEXT NOT NULL,
+            referrer_host TEXT,
+            agent TEXT,
+            clicks INTEGER NOT NULL DEFAULT 1
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS click_rollups (
+            short_code TEXT NOT NULL,
+            granularity TEXT NOT NULL,
+            bucket_ts INTEGER NOT NULL,
+            clicks INTEGER NOT NULL,
+            PRIMARY KEY (short_code, granularity, bucket_ts)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS click_breakdowns (
+            short_code TEXT NOT NULL,
+            dimension TEXT NOT NULL,
+            day_ts INTEGER NOT NULL,
+            value TEXT NOT NULL,
+            clicks INTEGER NOT NULL,
+            PRIMARY KEY (short_code, dimension, day_ts, value)
+        ) WITHOUT ROWID
+    ''')
+    # учетные записи (accounts.py); ссылки ссылаются на них через links.owner_id -- без внешнего ключа,
+    # потому что шарды ссылок лежат в других файлах
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT NOT NULL UNIQUE COLLATE NOCASE,
+            password_hash TEXT NOT NULL,
+            created_ts INTEGER NOT NULL
+        )
+    ''')
+    # изменения ссылок для сброса кэша в других процессах (invalidation.py)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS cache_invalidations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            short_code TEXT NOT NULL,
+            ts INTEGER NOT NULL
+        )
+    ''')
+    # при удалении ссылки ее агрегаты больше не нужны
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS links_rollups_delete AFTER DELETE ON links BEGIN
+            DELETE FROM click_rollups WHERE short_code = old.short_code;
+            DELETE FROM click_breakdowns WHERE short_code = old.short_code;
+        END
+    ''')
+    migrate_url_hash(conn)
+    migrate_expires_ts(conn)
+    migrate_created_ts(conn)
+    migrate_search_index(conn)
+    migrate_redirect_status(conn)
+    migrate_click_weights(conn)
+    migrate_owner_id(conn)
+    # счетчик удалений и смены адреса/срока: по нему файл горячих ссылок (hotlinks.py)
+    # при старте понимает, что база не менялась в обход него
+    cursor.execute("INSERT OR IGNORE INTO sequences (name, next_value) VALUES ('links_version', 0)")
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS links_version_delete AFTER DELETE ON links BEGIN
+            UPDATE sequences SET next_value = next_value + 1 WHERE name = 'links_version';
+        END
+    ''')
+    # пересоздаем, чтобы в старых базах триггер видел и redirect_status
+    cursor.execute("DROP TRIGGER IF EXISTS links_version_update")
+    cursor.execute('''
+        CREATE TRIGGER links_version_update AFTER UPDATE OF original_url, expires_ts, redirect_status ON links BEGIN
+            UPDATE sequences SET next_value = next_value + 1 WHERE name = 'links_version';
+        END
+    ''')
+    for _, sql in LINK_INDEXES:
+        cursor.execute(sql)
+
+
+# вторичные индексы links (имя, DDL); загрузка в пустой шард строит их после вставки (transfer.py)
+LINK_INDEXES = (
+    ("idx_links_url_hash", "CREATE INDEX IF NOT EXISTS idx_links_url_hash ON links (url_hash)"),
+    ("idx_links_expires_ts", "CREATE INDEX IF NOT EXISTS idx_links_expires_ts ON links (expires_ts)"),
+    ("idx_links_created_ts", "CREATE INDEX IF NOT EXISTS idx_links_created_ts ON links (created_ts, id)"),
+    # "мои ссылки" -- один проход по индексу в порядке показа; анонимные ссылки в него не попадают
+    (
+        "idx_links_owner",
+        "CREATE INDEX IF NOT EXISTS idx_links_owner ON links (owner_id, created_ts, id) WHERE owner_id IS NOT NULL",
+    ),
+)
+
+
+def column_exists(conn, table: str, column: str) -> bool:
+    return any(row[1] == column for row in conn.execute(f"PRAGMA table_info({table})"))
+
+
+# миграция старых баз: добавляем url_hash и заполняем его для существующих строк
+def migrate_url_hash(conn):
+    if not column_exists(conn, "links", "url_hash"):
+        conn.execute("ALTER TABLE links ADD COLUMN url_hash INTEGER")
+    conn.create_function("url_hash", 1, url_hash, deterministic=True)
+    conn.execute("UPDATE links SET url_hash = url_hash(original_url) WHERE url_hash IS NULL")
+
+
+# миграция старых баз: срок действия как unix-время, чтобы не разбирать строку на каждый запрос
+# (expires_at хранится в локальном времени)
+def migrate_expires_ts(conn):
+    if not column_exists(conn, "links", "expires_ts"):
+        conn.execute("ALTER TABLE links ADD COLUMN expires_ts INTEGER")
+    conn.execute(
+        "UPDATE links SET expires_ts = CAST(strftime('%s', expires_at, 'utc') AS INTEGER) "
+        "WHERE expires_ts IS NULL AND expires_at IS NOT NULL"
+    )
+
+
+# миграция старых баз: код ответа редиректа для ссылки (NULL -- SHORTENER_REDIRECT_STATUS)
+def migrate_redirect_status(conn):
+    if not column_exists(conn, "links", "redirect_status"):
+        conn.execute("ALTER TABLE links ADD COLUMN redirect_status INTEGER")
+
+
+# миграция старых баз: событие может нести несколько кликов (отчеты CDN о закэшированных редиректах)
+def migrate_click_weights(conn):
+    if not column_exists(conn, "click_events", "clicks"):
+        conn.execute("ALTER TABLE click_events ADD COLUMN clicks INTEGER NOT NULL DEFAULT 1")
+
+
+# миграция старых баз: владелец ссылки (NULL -- создана без входа, принадлежит cookie браузера)
+def migrate_owner_id(conn):
+    if not column_exists(conn, "links", "owner_id"):
+        conn.execute("ALTER TABLE links ADD COLUMN owner_id INTEGER")
+
+
+# миграция старых баз: время создания как unix-время для сортировки и постраничности по индексу
+def migrate_created_ts(conn):
+    if not column_exists(conn, "links", "created_ts"):
+        conn.execute("ALTER TABLE links ADD COLUMN created_ts INTEGER")
+    conn.execute(
+        "UPDATE links SET created_ts = CAST(strftime('%s', created_at, 'utc') AS INTEGER) "
+        "WHERE created_ts IS NULL"
+    )
+
+
+# полнотекстовый индекс по original_url и short_code (FTS5, триграммы) для поиска подстроки;
+# синхронизируется триггерами, так что любые INSERT/UPDATE/DELETE по links его обновляют.
+# Если SQLite собран без FTS5 или без trigram, поиск остается на LIKE
+FTS_ENABLED = False
+
+
+# есть ли индекс в этой базе -- определяем при каждом старте, миграция выполняется один раз
+def detect_search_index(conn):
+    global FTS_ENABLED
+    FTS_ENABLED = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'links_fts'"
+    ).fetchone() is not None
+
+
+def migrate_search_index(conn):
+    exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'links_fts'"
+    ).fetchone()
+    if not exists:
+        try:
+            conn.execute('''
+                CREATE VIRTUAL TABLE links_fts USING fts5(
+                    original_url, short_code,
+                    content='links', content_rowid='id', tokenize='trigram'
+                )
+            ''')
+        except sqlite3.OperationalError:
+            return
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS links_fts_insert AFTER INSERT ON links BEGIN
+            INSERT INTO links_fts (rowid, original_url, short_code)
+            VALUES (new.id, new.original_url, new.short_code);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS links_fts_delete AFTER DELETE ON links BEGIN
+            INSERT INTO links_fts (links_fts, rowid, original_url, short_code)
+            VALUES ('delete', old.id, old.original_url, old.short_code);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS links_fts_update AFTER UPDATE OF original_url, short_code ON links BEGIN
+            INSERT INTO links_fts (links_fts, rowid, original_url, short_code)
+            VALUES ('delete', old.id, old.original_url, old.short_code);
+            INSERT INTO links_fts (rowid, original_url, short_code)
+            VALUES (new.id, new.original_url, new.short_code);
+        END
+    ''')
+    if not exists:
+        # индекс для строк, которые были в базе до его появления
+        conn.execute("INSERT INTO links_fts (links_fts) VALUES ('rebuild')")
+
+
+# шаг 2: списки анонимных ссылок, вытесненные из cookie my_urls (linkcookie.py). Строки лежат
+# в том же шарде, что и ссылка, и удаляются вместе с ней
+def migrate_link_lists(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS link_lists (
+            list_id INTEGER NOT NULL,
+            link_id INTEGER NOT NULL,
+            PRIMARY KEY (list_id, link_id)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_link_lists_link ON link_lists (link_id)")
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS links_lists_delete AFTER DELETE ON links BEGIN
+            DELETE FROM link_lists WHERE link_id = old.id;
+        END
+    ''')
+
+
+# шаг 3: id событий кликов не должны переиспользоваться: свертка (analytics.py) помнит последний
+# обработанный id, и после удаления всех событий новые с меньшими id она бы пропустила.
+# Старую таблицу без AUTOINCREMENT пересоздаем и продолжаем счетчик не ниже водяной отметки
+def migrate_click_events_ids(conn):
+    sql = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'click_events'").fetchone()[0]
+    if "AUTOINCREMENT" in sql.upper():
+        return
+    conn.execute("ALTER TABLE click_events RENAME TO click_events_old")
+    conn.execute('''
+        CREATE TABLE click_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            ts INTEGER NOT NULL,
+            short_code TEXT NOT NULL,
+            referrer_host TEXT,
+            agent TEXT,
+            clicks INTEGER NOT NULL DEFAULT 1
         )
     ''')
-    conn.commit()
-    conn.close()
+    conn.execute(
+        "INSERT INTO click_events SELECT id, ts, short_code, referrer_host, agent, clicks FROM click_events_old"
+    )
+    conn.execute("DROP TABLE click_events_old")
+    row = conn.execute("SELECT next_value FROM sequences WHERE name = 'click_events_rolled'").fetchone()
+    last_id = max(row[0] if row else 0, conn.execute("SELECT COALESCE(MAX(id), 0) FROM click_events").fetchone()[0])
+    conn.execute("DELETE FROM sqlite_sequence WHERE name = 'click_events'")
+    conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('click_events', ?)", (last_id,))
 
 
-init_db()
+# шаги схемы по порядку: номер последнего примененного хранится в PRAGMA user_version файла
+MIGRATIONS = (
+    migrate_baseline,
+    migrate_link_lists,
+    migrate_click_events_ids,
+)
@@ -0,0 +1,101 @@
+import asyncio
+import queue
+import threading
+import time
+
+from starlette.concurrency import run_in_threadpool
+
+import settings
+from metrics import DB_CALL, DB_QUEUE_WAIT
+
+
+# очередь к базе переполнена -- отвечаем 503, а не копим запросы
+class DatabaseBusy(Exception):
+    pass
+
+
+def _set_result(future, result):
+    if not future.cancelled():
+        future.set_result(result)
+
+
+def _set_exception(future, exc):
+    if not future.cancelled():
+        future.set_exception(exc)
+
+
+# выделенные потоки для работы с SQLite: async-обработчики кладут задачу
+# в ограниченную очередь и ждут результат, не занимая общий threadpool
+class DBExecutor:
+    def __init__(self, workers: int, queue_size: int, mode: str = "dedicated"):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.mode = mode
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._threads = []
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self.rejected = 0
+
+    def start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._worker, name=f"db-worker-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self):
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for _ in threads:
+            self._queue.put(None)
+        for thread in threads:
+            thread.join()
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            fn, args, kwargs, loop, future, queued_at = item
+            started = time.perf_counter()
+            DB_QUEUE_WAIT.observe(started - queued_at)
+            try:
+                result = fn(*args, **kwargs)
+            except BaseException as exc:
+                loop.call_soon_threadsafe(_set_exception, future, exc)
+            else:
+                loop.call_soon_threadsafe(_set_result, future, result)
+            finally:
+                DB_CALL.observe(time.perf_counter() - started, fn.__name__)
+
+    async def run(self, fn, *args, **kwargs):
+        if self.mode == "threadpool":
+            with DB_CALL.time(fn.__name__):
+                return await run_in_threadpool(fn, *args, **kwargs)
+        if not self._threads:
+            self.start()
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        try:
+            self._queue.put_nowait((fn, args, kwargs, loop, future, time.perf_counter()))
+        except queue.Full:
+            self.rejected += 1
+            raise DatabaseBusy()
+        self.submitted += 1
+        return await future
+
+    def stats(self) -> dict:
+        return {
+            "mode": self.mode,
+            "workers": self.workers,
+            "queue_size": self.queue_size,
+            "queued": self._queue.qsize(),
+            "submitted": self.submitted,
+            "rejected": self.rejected,
+        }
+
+
+db = DBExecutor(settings.DB_WORKERS, settings.DB_QUEUE_SIZE, settings.DB_EXECUTOR_MODE)
@@ -0,0 +1,85 @@
+import sqlite3
+import threading
+import time
+
+import settings
+from cache import redirect_cache
+from codefilter import code_filter
+from hotlinks import hot_links
+from invalidation import invalidation
+from storage import storage
+
+
+# фоновое удаление просроченных ссылок небольшими пачками:
+# каждая пачка -- отдельная короткая транзакция, чтобы не держать блокировку записи
+class ExpirySweeper:
+    def __init__(self, interval: float, batch_size: int):
+        self.interval = interval
+        self.batch_size = batch_size
+        self._stopped = threading.Event()
+        self._thread = None
+        self.passes = 0
+        self.removed_total = 0
+        self.last_removed = 0
+        self.last_duration = 0.0
+        self.last_run_at = None
+
+    def delete_batch(self, shard, now: int) -> int:
+        codes = shard.delete_expired(now, self.batch_size)
+        for short_code in codes:
+            redirect_cache.invalidate(short_code)
+        hot_links.remove(codes)
+        code_filter.remove(codes)
+        invalidation.publish(codes)
+        return len(codes)
+
+    def sweep(self) -> int:
+        started = time.perf_counter()
+        now = int(time.time())
+        removed = 0
+        for shard in storage.shards:
+            while not self._stopped.is_set():
+                deleted = self.delete_batch(shard, now)
+                removed += deleted
+                if deleted < self.batch_size:
+                    break
+        self.passes += 1
+        self.removed_total += removed
+        self.last_removed = removed
+        self.last_duration = time.perf_counter() - started
+        self.last_run_at = now
+        return removed
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.sweep()
+            except sqlite3.Error:
+                pass
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="expiry-sweeper", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def stats(self) -> dict:
+        return {
+            "interval": self.interval,
+            "batch_size": self.batch_size,
+            "passes": self.passes,
+            "removed_total": self.removed_total,
+            "last_removed": self.last_removed,
+            "last_duration_ms": round(self.last_duration * 1000, 3),
+            "last_run_at": self.last_run_at,
+        }
+
+
+sweeper = ExpirySweeper(settings.EXPIRY_SWEEP_INTERVAL, settings.EXPIRY_SWEEP_BATCH)
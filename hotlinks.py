@@ -0,0 +1,351 @@
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+
+import settings
+from cache import MISSING
+from storage import storage
+
+MAGIC = b"SHLHOT01"
+# заголовок файла: magic, поколение (нечетное -- идет запись), флаг "файл заменен новым",
+# число слотов, вместимость, размер области данных, занято в ней, живых ссылок,
+# удаленных слотов, links_version базы, время сборки
+HEADER = struct.Struct("<8sQI4xQQQQQQQQ")
+HEADER_SIZE = 128
+GENERATION = struct.Struct("<QI")
+GENERATION_OFFSET = 8
+COUNTER = struct.Struct("<Q")
+DATA_USED_OFFSET = 48
+ENTRIES_OFFSET = 56
+TOMBSTONES_OFFSET = 64
+VERSION_OFFSET = 72
+# слот: crc32 кода, смещение записи (код + адрес) в области данных, длина адреса,
+# длина кода, состояние, код ответа редиректа (0 -- по умолчанию), срок действия (unix-время, 0 -- бессрочно)
+SLOT = struct.Struct("<IIIBBHI")
+EMPTY, LIVE, DELETED = 0, 1, 2
+# столько раз читатель перечитывает слот, если попал на запись; потом идет в базу
+READ_ATTEMPTS = 4
+MAX_CODE_BYTES = 255
+MAX_EXPIRES = 2 ** 32 - 1
+
+
+# таблица горячих ссылок в общем файле, который все процессы (serve.py) отображают в память:
+# short_code -> (original_url, expires_ts, redirect_status) без запросов к SQLite и без копии в каждом воркере.
+# Открытая адресация с линейным пробированием по фиксированным слотам (20 байт, слотов вдвое
+# больше вместимости) и область данных, куда записи только дописываются, -- размер файла
+# известен заранее. Читатели не берут блокировок: поколение в заголовке работает как seqlock.
+# Писатели (создание, изменение и удаление ссылок, sweeper) берут flock на файл рядом.
+# При старте файл просто отображается, если links_version базы совпадает с записанным в нем,
+# иначе таблица собирается заново из самых посещаемых ссылок; так же при нехватке места
+class HotLinks:
+    def __init__(self, path: str, capacity: int, data_bytes: int):
+        self.path = path
+        self.capacity = capacity
+        # смещения в слотах 32-битные
+        self.data_bytes = min(data_bytes, 2 ** 32 - 1)
+        self.slot_count = 1
+        while self.slot_count < capacity * 2:
+            self.slot_count *= 2
+        self.data_offset = HEADER_SIZE + self.slot_count * SLOT.size
+        self.file_size = self.data_offset + self.data_bytes
+        self._mm = None
+        self._lock = threading.Lock()
+        self._lock_file = None
+        self.hits = 0
+        self.misses = 0
+        self.skipped = 0
+        self.rebuilt = False
+        self.open_ms = 0.0
+
+    @contextmanager
+    def _locked(self):
+        with self._lock:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def _map(self):
+        try:
+            with open(self.path, "r+b") as f:
+                if os.fstat(f.fileno()).st_size != self.file_size:
+                    return None
+                mm = mmap.mmap(f.fileno(), self.file_size)
+        except FileNotFoundError:
+            return None
+        if mm[:len(MAGIC)] != MAGIC:
+            mm.close()
+            return None
+        return mm
+
+    def _usable(self, mm, version: int) -> bool:
+        (_, generation, retired, slot_count, capacity, data_bytes,
+         data_used, _, tombstones, links_version, _) = HEADER.unpack_from(mm, 0)
+        return (
+            not retired
+            # нечетное поколение -- писатель упал посреди записи
+            and generation % 2 == 0
+            and (slot_count, capacity, data_bytes) == (self.slot_count, self.capacity, self.data_bytes)
+            and links_version == version
+            and data_used < self.data_bytes * 0.9
+            and tombstones < self.slot_count // 4
+        )
+
+    def open(self):
+        if not self.path or self._mm is not None:
+            return
+        started = time.perf_counter()
+        self._lock_file = open(self.path + ".lock", "a+b")
+        with self._locked():
+            version = storage.links_version()
+            mm = self._map()
+            if mm is not None and not self._usable(mm, version):
+                mm.close()
+                mm = None
+            if mm is None:
+                self._build(version)
+                mm = self._map()
+                self.rebuilt = True
+            self._mm = mm
+        self.open_ms = round((time.perf_counter() - started) * 1000, 1)
+
+    # собираем новый файл рядом и подменяем им старый; процессы, которые держат старый,
+    # увидят флаг retired и переоткроют файл
+    def _build(self, version: int):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w+b") as f:
+            f.truncate(self.file_size)
+            mm = mmap.mmap(f.fileno(), self.file_size)
+        HEADER.pack_into(
+            mm, 0, b"\0" * len(MAGIC), 0, 0, self.slot_count, self.capacity, self.data_bytes,
+            0, 0, 0, version, int(time.time())
+        )
+        for short_code, original_url, expires_ts, redirect_status in storage.top_links(self.capacity, int(time.time())):
+            self._put(mm, short_code.encode(), original_url.encode(), expires_ts, redirect_status, replace=False)
+        # magic пишем последним: недописанный файл при следующем старте не примут
+        mm[:len(MAGIC)] = MAGIC
+        mm.flush()
+        mm.close()
+
+        try:
+            old = open(self.path, "r+b")
+        except FileNotFoundError:
+            old = None
+        os.replace(tmp_path, self.path)
+        if old is not None:
+            with old:
+                if old.read(len(MAGIC)) == MAGIC:
+                    os.pwrite(old.fileno(), struct.pack("<I", 1), GENERATION_OFFSET + 8)
+
+    def _reopen(self, mm):
+        with self._locked():
+            if self._mm is mm:
+                self._mm = self._map()
+
+    def close(self):
+        self._mm = None
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    # (номер слота, слот) или (None, свободный слот для вставки либо None)
+    def _find(self, mm, key: bytes, digest: int):
+        mask = self.slot_count - 1
+        position = digest & mask
+        free = None
+        for _ in range(self.slot_count):
+            slot = SLOT.unpack_from(mm, HEADER_SIZE + position * SLOT.size)
+            state = slot[4]
+            if state == EMPTY:
+                return None, position if free is None else free
+            if state == DELETED:
+                if free is None:
+                    free = position
+            elif slot[0] == digest and slot[3] == len(key):
+                start = self.data_offset + slot[1]
+                if mm[start:start + len(key)] == key:
+                    return position, slot
+            position = (position + 1) & mask
+        return None, free
+
+    def _counter(self, mm, offset: int) -> int:
+        return COUNTER.unpack_from(mm, offset)[0]
+
+    def _add_counter(self, mm, offset: int, delta: int):
+        COUNTER.pack_into(mm, offset, self._counter(mm, offset) + delta)
+
+    def _begin(self, mm):
+        self._add_counter(mm, GENERATION_OFFSET, 1)
+
+    _end = _begin
+
+    # False -- места нет (или replace=False, а код уже есть)
+    def _put(self, mm, key: bytes, url: bytes, expires_ts, redirect_status, replace: bool) -> bool:
+        if len(key) > MAX_CODE_BYTES:
+            return False
+        digest = zlib.crc32(key)
+        position, found = self._find(mm, key, digest)
+        if position is not None and not replace:
+            return False
+        if position is None and (found is None or self._counter(mm, ENTRIES_OFFSET) >= self.capacity):
+            return False
+        data_used = self._counter(mm, DATA_USED_OFFSET)
+        if data_used + len(key) + len(url) > self.data_bytes:
+            return False
+
+        # запись еще не видна читателям, пока на нее не указывает слот
+        start = self.data_offset + data_used
+        mm[start:start + len(key) + len(url)] = key + url
+        self._begin(mm)
+        if position is None:
+            position = found
+            if SLOT.unpack_from(mm, HEADER_SIZE + position * SLOT.size)[4] == DELETED:
+                self._add_counter(mm, TOMBSTONES_OFFSET, -1)
+            self._add_counter(mm, ENTRIES_OFFSET, 1)
+        SLOT.pack_into(
+            mm, HEADER_SIZE + position * SLOT.size,
+            digest, data_used, len(url), len(key), LIVE, redirect_status or 0,
+            # 0 -- бессрочная ссылка, поэтому срок до 1970 года сохраняем как 1
+            min(max(expires_ts, 1), MAX_EXPIRES) if expires_ts else 0
+        )
+        self._add_counter(mm, DATA_USED_OFFSET, len(key) + len(url))
+        self._end(mm)
+        return True
+
+    def _delete(self, mm, key: bytes):
+        position, _ = self._find(mm, key, zlib.crc32(key))
+        if position is None:
+            return
+        self._begin(mm)
+        struct.pack_into("<B", mm, HEADER_SIZE + position * SLOT.size + 13, DELETED)
+        self._add_counter(mm, ENTRIES_OFFSET, -1)
+        self._add_counter(mm, TOMBSTONES_OFFSET, 1)
+        self._end(mm)
+
+    # mm под блокировкой писателя; если файл успели пересобрать, берем новый
+    def _writable(self):
+        mm = self._mm
+        if mm is not None and GENERATION.unpack_from(mm, GENERATION_OFFSET)[1]:
+            self._mm = mm = self._map()
+        return mm
+
+    def get(self, short_code: str):
+        mm = self._mm
+        if mm is None:
+            return MISSING
+        key = short_code.encode()
+        digest = zlib.crc32(key)
+        for _ in range(READ_ATTEMPTS):
+            generation, retired = GENERATION.unpack_from(mm, GENERATION_OFFSET)
+            if retired:
+                self._reopen(mm)
+                mm = self._mm
+                if mm is None:
+                    return MISSING
+                continue
+            if generation % 2:
+                continue
+            try:
+                position, slot = self._find(mm, key, digest)
+                if position is not None:
+                    start = self.data_offset + slot[1] + slot[3]
+                    result = (mm[start:start + slot[2]].decode(), slot[6] or None, slot[5] or None)
+                else:
+                    result = MISSING
+            except (ValueError, UnicodeDecodeError):
+                # прочитали слот посреди записи
+                continue
+            if GENERATION.unpack_from(mm, GENERATION_OFFSET)[0] != generation:
+                continue
+            if result is MISSING:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return result
+        self.misses += 1
+        return MISSING
+
+    # новая ссылка: добавляем, пока есть место (уже занятые слоты не вытесняются).
+    # Адрес и срок читаем из базы под блокировкой: /shorten для дубля URL возвращает старый код
+    # с его сроком, а удаление, закоммиченное раньше нас, ждет блокировку и уберет запись после
+    def add(self, short_code: str):
+        if self._mm is None:
+            return
+        with self._locked():
+            mm = self._writable()
+            row = storage.get_redirect(short_code) if mm is not None else None
+            # истекшую ссылку (дубль URL со старым сроком) в таблицу не кладем
+            if row is not None and row[1] and row[1] <= time.time():
+                return
+            if row is not None and not self._put(mm, short_code.encode(), row[0].encode(), row[1], row[2], False):
+                self.skipped += 1
+
+    # после изменения адреса или кода ответа (links_version базы вырос на 1): если ссылка
+    # есть в таблице, перечитываем ее из базы под блокировкой
+    def update(self, short_code: str):
+        if self._mm is None:
+            return
+        with self._locked():
+            mm = self._writable()
+            if mm is None:
+                return
+            key = short_code.encode()
+            position, _ = self._find(mm, key, zlib.crc32(key))
+            if position is not None:
+                row = storage.get_redirect(short_code)
+                if row is None or not self._put(mm, key, row[0].encode(), row[1], row[2], True):
+                    # новая запись не поместилась -- старую отдавать нельзя
+                    self._delete(mm, key)
+            self._bump_version(mm, 1)
+
+    # после удаления ссылок из базы (каждая строка увеличила links_version на 1)
+    def remove(self, short_codes: list):
+        if self._mm is None or not short_codes:
+            return
+        with self._locked():
+            mm = self._writable()
+            if mm is None:
+                return
+            for short_code in short_codes:
+                self._delete(mm, short_code.encode())
+            self._bump_version(mm, len(short_codes))
+
+    def _bump_version(self, mm, delta: int):
+        self._begin(mm)
+        self._add_counter(mm, VERSION_OFFSET, delta)
+        self._end(mm)
+
+    def stats(self) -> dict:
+        mm = self._mm
+        if mm is None:
+            return {"enabled": bool(self.path)}
+        (_, generation, _, _, _, _, data_used, entries, tombstones, links_version, built_at) = HEADER.unpack_from(mm, 0)
+        total = self.hits + self.misses
+        return {
+            "enabled": True,
+            "path": self.path,
+            "file_bytes": self.file_size,
+            "capacity": self.capacity,
+            "slots": self.slot_count,
+            "entries": entries,
+            "tombstones": tombstones,
+            "data_used": data_used,
+            "data_bytes": self.data_bytes,
+            "links_version": links_version,
+            "built_at": built_at,
+            "rebuilt_on_open": self.rebuilt,
+            "open_ms": self.open_ms,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+            "skipped": self.skipped,
+        }
+
+
+hot_links = HotLinks(settings.HOT_LINKS_PATH, settings.HOT_LINKS_CAPACITY, settings.HOT_LINKS_DATA_MB * 1024 * 1024)
@@ -0,0 +1,114 @@
+import sqlite3
+import threading
+import time
+
+import settings
+from cache import redirect_cache
+from database import get_connection, open_connection
+
+# сколько секунд хранить записи об изменениях: за это время их успеют прочитать все процессы
+RETENTION = 3600
+
+
+# канал инвалидации кэша между процессами (см. serve.py): процесс, который изменил или удалил
+# ссылку, пишет ее код в таблицу cache_invalidations основной базы, а фоновый поток каждого
+# процесса раз в interval секунд дочитывает новые записи и выкидывает коды из своего кэша.
+# Пока никто ничего не записал, PRAGMA data_version не меняется и запроса к таблице нет.
+# В одном процессе канал выключен: кэш и так сбрасывается на месте
+class InvalidationChannel:
+    def __init__(self, interval: float, enabled: bool):
+        self.interval = interval
+        self.enabled = enabled
+        self._stopped = threading.Event()
+        self._thread = None
+        self._conn = None
+        self._data_version = None
+        self._last_id = 0
+        self._last_prune = 0.0
+        self.published = 0
+        self.received = 0
+        self.polls = 0
+        self.reads = 0
+
+    def publish(self, short_codes: list):
+        if not self.enabled or not short_codes:
+            return
+        now = int(time.time())
+        conn = get_connection()
+        try:
+            with conn:
+                conn.executemany(
+                    "INSERT INTO cache_invalidations (short_code, ts) VALUES (?, ?)",
+                    [(short_code, now) for short_code in short_codes]
+                )
+        finally:
+            conn.close()
+        self.published += len(short_codes)
+
+    def poll(self) -> int:
+        self.polls += 1
+        data_version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+        if data_version == self._data_version:
+            return 0
+        self._data_version = data_version
+        self.reads += 1
+        rows = self._conn.execute(
+            "SELECT id, short_code FROM cache_invalidations WHERE id > ? ORDER BY id",
+            (self._last_id,)
+        ).fetchall()
+        for _, short_code in rows:
+            redirect_cache.invalidate(short_code)
+        if rows:
+            self._last_id = rows[-1][0]
+        self.received += len(rows)
+        return len(rows)
+
+    def prune(self):
+        now = time.time()
+        if now - self._last_prune < RETENTION / 10:
+            return
+        self._last_prune = now
+        with self._conn:
+            self._conn.execute("DELETE FROM cache_invalidations WHERE ts < ?", (int(now) - RETENTION,))
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.poll()
+                self.prune()
+            except sqlite3.Error:
+                pass
+
+    def start(self):
+        if not self.enabled or self._thread is not None:
+            return
+        # свое соединение вне пула: data_version считается для конкретного соединения
+        self._conn = open_connection()
+        self._last_id = self._conn.execute("SELECT COALESCE(MAX(id), 0) FROM cache_invalidations").fetchone()[0]
+        self._data_version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="cache-invalidation", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "interval": self.interval,
+            "published": self.published,
+            "received": self.received,
+            "polls": self.polls,
+            "reads": self.reads,
+            "last_id": self._last_id,
+        }
+
+
+invalidation = InvalidationChannel(settings.CACHE_INVALIDATION_INTERVAL, settings.WORKERS > 1)
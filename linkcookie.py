@@ -0,0 +1,151 @@
+import base64
+import hashlib
+import hmac
+import secrets
+import zlib
+
+import settings
+from accounts import tokens
+from storage import storage
+
+COOKIE_NAME = "my_urls"
+# значение cookie: "1.<base64url(подпись + сжатые данные)>". В старом формате (коды через запятую)
+# точки нет: в кодах и алиасах только буквы, цифры и дефисы
+VERSION = "1"
+SIGNATURE_BYTES = 12
+
+
+def encode_varints(values) -> bytes:
+    out = bytearray()
+    for value in values:
+        while value >= 0x80:
+            out.append(value & 0x7F | 0x80)
+            value >>= 7
+        out.append(value)
+    return bytes(out)
+
+
+def decode_varints(data: bytes) -> list:
+    values, value, shift = [], 0, 0
+    for byte in data:
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            values.append(value)
+            value = shift = 0
+    if shift:
+        raise ValueError("оборванное число")
+    return values
+
+
+def count_ids(link_ids: dict) -> int:
+    return sum(len(ids) for ids in link_ids.values())
+
+
+# анонимные ссылки браузера в cookie my_urls: id ссылок по шардам (первичный ключ, а не коды),
+# по возрастанию разностями в varint, сжатые deflate и подписанные HMAC ключом из accounts.py.
+# Данные: число шардов, id серверного списка (0 -- нет), затем по каждому шарду -- его номер,
+# число id и сами id. Сверх max_links записи уходят в серверный список (таблица link_lists),
+# и в cookie остается его id, так что размер cookie не растет с числом ссылок.
+# id действуют только при том же числе шардов: после rebalance.py или переноса ссылок
+# через transfer.py в другую базу старые cookie перестают находить ссылки
+class LinkCookie:
+    def __init__(self, max_links: int):
+        self.max_links = max(max_links, 1)
+        self._key = None
+        self.issued = 0
+        self.migrated = 0
+        self.spilled = 0
+        self.rejected = 0
+
+    # свой ключ, производный от ключа подписи токенов
+    @property
+    def key(self) -> bytes:
+        if self._key is None:
+            self._key = hmac.new(tokens.secret_key.encode(), b"my_urls cookie", hashlib.sha256).digest()
+        return self._key
+
+    def sign(self, data: bytes) -> bytes:
+        return hmac.new(self.key, data, hashlib.sha256).digest()[:SIGNATURE_BYTES]
+
+    @staticmethod
+    def is_legacy(value) -> bool:
+        return bool(value) and "." not in value
+
+    def dumps(self, link_ids: dict, list_id) -> str:
+        values = [len(storage.shards), list_id or 0]
+        for index in sorted(link_ids):
+            ids = sorted(set(link_ids[index]))
+            values.extend((index, len(ids)))
+            values.extend(link_id - previous for previous, link_id in zip([0] + ids, ids))
+        compressor = zlib.compressobj(9, zlib.DEFLATED, -15)
+        data = compressor.compress(encode_varints(values)) + compressor.flush()
+        self.issued += 1
+        return f"{VERSION}.{base64.urlsafe_b64encode(self.sign(data) + data).decode().rstrip('=')}"
+
+    # ({шард: [id]}, list_id); пустой, поддельный или устаревший cookie -- пустой набор
+    def load(self, value):
+        if not value or self.is_legacy(value):
+            return {}, None
+        try:
+            version, encoded = value.split(".", 1)
+            raw = base64.urlsafe_b64decode(encoded + "=" * (-len(encoded) % 4))
+            signature, data = raw[:SIGNATURE_BYTES], raw[SIGNATURE_BYTES:]
+            if version != VERSION or not hmac.compare_digest(signature, self.sign(data)):
+                raise ValueError("неверная подпись")
+            values = decode_varints(zlib.decompress(data, -15))
+            shard_count, list_id = values[0], values[1]
+            if shard_count != len(storage.shards):
+                raise ValueError("другое число шардов")
+            link_ids, position = {}, 2
+            while position < len(values):
+                index, count = values[position], values[position + 1]
+                deltas = values[position + 2:position + 2 + count]
+                if len(deltas) != count:
+                    raise ValueError("оборванный список")
+                ids, link_id = [], 0
+                for delta in deltas:
+                    link_id += delta
+                    ids.append(link_id)
+                link_ids[index] = ids
+                position += 2 + count
+        except (ValueError, IndexError, zlib.error):
+            self.rejected += 1
+            return {}, None
+        return link_ids, list_id or None
+
+    # больше limit записей -- все переносим в серверный список; вызывается в потоке базы
+    def spill(self, link_ids: dict, list_id, limit: int):
+        if count_ids(link_ids) <= limit:
+            return link_ids, list_id
+        list_id = list_id or secrets.randbits(62) + 1
+        storage.save_link_list(list_id, link_ids)
+        self.spilled += 1
+        return {}, list_id
+
+    # старый cookie "код,код,...": коды -> id; вызывается в потоке базы
+    def migrate(self, value):
+        self.migrated += 1
+        return self.spill(storage.link_ids(value.split(",")), None, self.max_links)
+
+    # новое значение cookie с добавленной ссылкой short_code; вызывается в потоке базы
+    def remember(self, value, short_code: str) -> str:
+        link_ids, list_id = self.migrate(value) if self.is_legacy(value) else self.load(value)
+        # новая ссылка остается в cookie, вытесняются старые
+        link_ids, list_id = self.spill(link_ids, list_id, self.max_links - 1)
+        for index, ids in storage.link_ids([short_code]).items():
+            link_ids.setdefault(index, []).extend(ids)
+        return self.dumps(link_ids, list_id)
+
+    def stats(self) -> dict:
+        return {
+            "max_links": self.max_links,
+            "issued": self.issued,
+            "migrated": self.migrated,
+            "spilled": self.spilled,
+            "rejected": self.rejected,
+        }
+
+
+link_cookie = LinkCookie(settings.MY_URLS_COOKIE_MAX_LINKS)
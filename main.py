@@ -1,396 +1,562 @@
-import hashlib
+import hmac
+import json
 import sqlite3
+import tempfile
+import time
+import zlib
+from urllib.parse import urlencode
+
+from fastapi import FastAPI, Form, Body, Request, Response, HTTPException, Depends, Header
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse, RedirectResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+
+import database
+from database import pool, url_hash
+from cache import MISSING, redirect_cache
+from clicks import click_buffer
+from shortcode import allocator
+from storage import storage
+from db_async import DatabaseBusy, db
+from expiry import sweeper
+from invalidation import invalidation
+from hotlinks import hot_links
+from codefilter import code_filter
+from accounts import USERNAME_TAKEN, PasswordHasherBusy, authenticate, password_hasher, register, tokens
+from analytics import classify_agent, fetch_breakdown, fetch_buckets, referrer_host, rollups, GRANULARITIES
+import metrics
+from ratelimit import RateLimitMiddleware, limiter
+from replica import read_routing
+from linkcookie import COOKIE_NAME, link_cookie
+from metrics import CallbackMetric, MetricsMiddleware
+from rendering import Safe, js_string, render, render_rows, static_page
+import transfer
+import settings
 
-from fastapi import FastAPI, Form, Body, Request, Response, HTTPException, status
-from fastapi.responses import HTMLResponse, RedirectResponse
-
-import random
-from database import get_connection
-
-from passlib.context import CryptContext
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from datetime import datetime, timedelta
 from typing import Optional
 
 from fastapi.middleware.cors import CORSMiddleware 
 
-import uvicorn
-
-# это я пытался настроить регистрацию -- но времени не хватило, так что оставлю на память
-SECRET_KEY = "мой-очень-секретный-ключ-12345"
-ALGORITHM = "HS256"
-ACCESS_TOKEN_EXPIRE_MINUTES = 30
-
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/login")
+# токен из заголовка Authorization: Bearer ...; без заголовка запрос анонимный (см. current_user)
+oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/login", auto_error=False)
 
 DEFAULT_EXPIRATION_HOURS = 24
 DEFAULT_EXPIRATION_FORMAT = "%Y-%m-%d %H:%M:%S"
 
+# сколько корзин можно запросить из /api/links/{short_code}/stats за раз
+STATS_MAX_BUCKETS = 10000
+
+# коды ответа редиректа: 301/308 кэшируются браузерами и CDN (Cache-Control по сроку ссылки),
+# 302/307 -- нет, зато каждый переход доходит до сервиса и засчитывается
+REDIRECT_STATUSES = (301, 302, 307, 308)
+CACHEABLE_REDIRECTS = (301, 308)
+# сколько записей принимает /admin/clicks за один запрос
+CLICK_REPORT_MAX_ITEMS = 10000
+
 app = FastAPI()
 
+
+# ключ клиента для ограничения запросов: пользователь по действующему токену (проверенные
+# токены берутся из кэша), иначе IP
+def client_key(scope) -> str:
+    forwarded = None
+    for name, value in scope["headers"]:
+        if name == b"authorization" and value[:7].lower() == b"bearer ":
+            user = tokens.verify(value[7:].decode("latin-1"))
+            if user is not None:
+                return f"user:{user[0]}"
+        elif name == b"x-forwarded-for" and settings.RATE_LIMIT_TRUST_FORWARDED:
+            forwarded = value.decode("latin-1").split(",")[0].strip()
+    client = scope.get("client")
+    return f"ip:{forwarded or (client[0] if client else '')}"
+
+
+# внутри CORS, чтобы и у ответов 429/503 были CORS-заголовки
+app.add_middleware(RateLimitMiddleware, limiter=limiter, client_key=client_key)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# снаружи CORS, чтобы время запроса включало всю обработку
+app.add_middleware(MetricsMiddleware)
+
+
+# время старта воркера для /admin/stats: сколько шло до готовности и сколько шагов схемы применено
+startup_stats = {}
+
+
+def start_background_workers():
+    started = time.perf_counter()
+    # схема -- здесь, а не при импорте: импорт main ничего не пишет на диск
+    startup_stats["migrations_applied"] = storage.init_schema()
+    # горячие ссылки: отображаем готовый файл или собираем его из базы
+    hot_links.open()
+    code_filter.open()
+    storage.code_filter = code_filter
+    db.start()
+    # отчеты и поиск -- в своих потоках и к соединениям только для чтения (SHORTENER_READ_ROUTING)
+    read_routing.attach(storage)
+    read_routing.start(settings.BACKGROUND_JOBS)
+    click_buffer.start()
+    invalidation.start()
+    # при нескольких воркерах (serve.py) очистку и свертку ведет только один из них
+    if settings.BACKGROUND_JOBS:
+        sweeper.start()
+        rollups.start()
+        code_filter.start()
+    # процессы bcrypt и ключ подписи токенов появляются при первом входе (accounts.py)
+    startup_stats["startup_ms"] = round((time.perf_counter() - started) * 1000, 1)
+
+
+def stop_background_workers():
+    # сбрасываем накопленные клики перед остановкой
+    sweeper.stop()
+    click_buffer.stop()
+    rollups.stop()
+    code_filter.stop()
+    invalidation.stop()
+    password_hasher.stop()
+    read_routing.stop()
+    db.stop()
+    hot_links.close()
+    code_filter.close()
+    storage.close()
+    pool.close_all()
+
+
+# lifespan приложения: FastAPI 0.68 не принимает lifespan в конструкторе, но роутер starlette
+# уже умеет асинхронный генератор вместо списков on_startup/on_shutdown
+async def lifespan(app):
+    start_background_workers()
+    try:
+        yield
+    finally:
+        stop_background_workers()
+
+
+app.router.lifespan_context = lifespan
+
+
+# после вставки в базу и до ответа клиенту: иначе другой воркер мог бы ответить 404 по фильтру
+def link_created(short_code: str):
+    code_filter.add([short_code])
+    hot_links.add(short_code)
+
+
+# после изменения адреса или кода ответа ссылки
+def link_updated(short_code: str):
+    hot_links.update(short_code)
+    invalidation.publish([short_code])
+
 
-# генерация короткого кода из URL
-def generate_short_code(url: str) -> str:
-    hash_object = hashlib.md5(url.encode())
-    return hash_object.hexdigest()[:6]
+# после удаления из базы: общие структуры и кэши остальных процессов
+def links_deleted(short_codes: list):
+    hot_links.remove(short_codes)
+    code_filter.remove(short_codes)
+    invalidation.publish(short_codes)
 
 
-# подключение к базе данных SQLite
-def get_db():
-    conn = get_connection()
-    return conn, conn.cursor()
+# очередь к базе переполнена: отвечаем сразу, клиент повторит позже
+@app.exception_handler(DatabaseBusy)
+async def database_busy_handler(request: Request, exc: DatabaseBusy):
+    return HTMLResponse(
+        content="<h1>Сервис перегружен, попробуйте позже</h1>",
+        status_code=503,
+        headers={"Retry-After": "1"},
+    )
+
+
+# проверок пароля ждет слишком много: вход и регистрация отвечают сразу
+@app.exception_handler(PasswordHasherBusy)
+async def password_hasher_busy_handler(request: Request, exc: PasswordHasherBusy):
+    return JSONResponse(
+        {"detail": "Слишком много входов одновременно, попробуйте позже"},
+        status_code=503,
+        headers={"Retry-After": "1"},
+    )
+
+
+# (user_id, username) по токену или None для анонимного запроса; неверный или истекший
+# токен -- 401, а не тихий переход в анонимный режим. Проверенные токены берутся из кэша
+async def current_user(token: Optional[str] = Depends(oauth2_scheme)):
+    if token is None:
+        return None
+    user = tokens.verify(token)
+    if user is None:
+        raise HTTPException(
+            status_code=401, detail="Неверный или истекший токен", headers={"WWW-Authenticate": "Bearer"}
+        )
+    return user
+
+
+async def require_user(user=Depends(current_user)):
+    if user is None:
+        raise HTTPException(status_code=401, detail="Нужен вход", headers={"WWW-Authenticate": "Bearer"})
+    return user
+
+
+# ссылку пользователя меняет и удаляет только он, анонимные -- кто угодно, как раньше.
+# False -- ссылки нет
+async def check_owner(short_code: str, user) -> bool:
+    row = await db.run(storage.link_owner, short_code)
+    if row is None:
+        return False
+    if row[0] is not None and (user is None or user[0] != row[0]):
+        raise HTTPException(status_code=403, detail="Ссылка принадлежит другому пользователю")
+    return True
+
+
+# страницы, которые не меняются, собираем один раз при старте
+HOME_PAGE = static_page("home")
+NOT_FOUND_PAGE = render("not_found")
+
+
+def static_headers(page) -> dict:
+    return {"ETag": page.etag, "Cache-Control": f"public, max-age={settings.STATIC_PAGE_MAX_AGE}"}
+
+
+# генерация короткого кода: следующий номер из зарезервированного блока в base62
+def generate_short_code() -> str:
+    return allocator.next_code()
 
 
 # главная страница
 @app.get("/", response_class=HTMLResponse)
-def home():
-    return """
-    <html>
-      <head>
-        <title>Сокращатель ссылок</title>
-        <style>
-          body { font-family: Arial, sans-serif; text-align: center; margin-top: 50px; }
-          input, button { padding: 10px; margin-top: 10px; width: 400px; }
-          .custom-section { margin: 20px auto; padding: 15px; border: 1px solid #ddd; width: 450px; }
-          .nav-buttons { margin-top: 20px; }
-          .nav-buttons a { 
-              text-decoration: none; 
-              color: white; 
-              background: #007bff; 
-              padding: 10px 20px; 
-              border-radius: 4px; 
-              margin: 0 5px;
-          }
-        </style>
-      </head>
-      <body>
-        <h1>Добро пожаловать в сервис сокращения ссылок!</h1>
-
-        <!-- Основная форма -->
-        <form action="/shorten" method="post">
-          <label for="url">Введите длинный URL:</label><br>
-          <input type="text" id="url" name="url" placeholder="https://example.com" required><br>
-
-          <!-- Секция кастомного алиаса -->
-          <div class="custom-section">
-            <label for="custom_alias">Желаемый псевдоним (необязательно):</label><br>
-            <input type="text" id="custom_alias" name="custom_alias" placeholder="my-custom-link">
-            <p style="font-size: 12px; color: #666;">Только буквы, цифры и дефисы</p>
-          </div>
-
-          <button type="submit">Сократить ссылку</button>
-        </form>
-
-        <div class="nav-buttons">
-          <a href="/my_urls">Мои URL</a>
-        </div>
-      </body>
-    </html>
-    """
+async def home(request: Request):
+    if request.headers.get("if-none-match") == HOME_PAGE.etag:
+        return Response(status_code=304, headers=static_headers(HOME_PAGE))
+    return Response(content=HOME_PAGE.body, media_type="text/html", headers=static_headers(HOME_PAGE))
+
+ALIAS_CHARS = set("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789-")
+
+
+# текст ошибки или None, если алиас подходит
+def validate_alias(custom_alias: str) -> Optional[str]:
+    if not all(char in ALIAS_CHARS for char in custom_alias):
+        return "Можно использовать только буквы, цифры и дефисы"
+    if len(custom_alias) < 4 or len(custom_alias) > 32:
+        return "Длина alias должна быть от 4 до 32 символов"
+    return None
+
+
+# код ответа редиректа из формы или JSON: (код или None -- по умолчанию, текст ошибки)
+def parse_redirect_status(value):
+    if value is None or value == "":
+        return None, None
+    try:
+        redirect_status = int(value)
+    except (TypeError, ValueError):
+        redirect_status = None
+    if isinstance(value, bool) or redirect_status not in REDIRECT_STATUSES:
+        return None, "Код редиректа должен быть одним из: 301, 302, 307, 308"
+    return redirect_status, None
+
+
+# срок действия ссылки: (datetime, строка для базы, текст ошибки)
+def parse_expiration(expires_at: Optional[str]):
+    if expires_at:
+        try:
+            expiration_dt = datetime.strptime(expires_at, DEFAULT_EXPIRATION_FORMAT)
+        except (TypeError, ValueError):
+            return None, None, "Неверный формат даты истечения. Используйте 'YYYY-MM-DD HH:MM:SS'"
+        if expiration_dt <= datetime.now():
+            return None, None, "Дата истечения уже прошла"
+    else:
+        expiration_dt = datetime.now().replace(microsecond=0) + timedelta(hours=DEFAULT_EXPIRATION_HOURS)
+    return expiration_dt, expiration_dt.strftime(DEFAULT_EXPIRATION_FORMAT), None
+
 
 @app.post("/shorten", response_class=HTMLResponse)
-def shorten_url(
+async def shorten_url(
         request: Request,
         response: Response,
         url: str = Form(...),
         custom_alias: Optional[str] = Form(None),
-        expires_at: Optional[str] = Form(None)
+        expires_at: Optional[str] = Form(None),
+        redirect_status: Optional[str] = Form(None),
+        user=Depends(current_user)
 ):
-    conn, cursor = get_db()
-    error = None
-
     # валидация кастомного алиаса
     if custom_alias:
         custom_alias = custom_alias.strip()
-        allowed_chars = set("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789-")
-        if not all(char in allowed_chars for char in custom_alias):
-            error = "Можно использовать только буквы, цифры и дефисы"
-        elif len(custom_alias) < 4 or len(custom_alias) > 32:
-            error = "Длина alias должна быть от 4 до 32 символов"
-        else:
-            cursor.execute("SELECT short_code FROM links WHERE short_code = ?", (custom_alias,))
-            if cursor.fetchone():
-                error = f"Alias '{custom_alias}' уже занят"
+    error = validate_alias(custom_alias) if custom_alias else None
 
     # определяем время жизни ссылки
-    if expires_at:
-        try:
-            expiration_dt = datetime.strptime(expires_at, DEFAULT_EXPIRATION_FORMAT)
-            expires_at_str = expiration_dt.strftime(DEFAULT_EXPIRATION_FORMAT)
-        except ValueError:
-            error = "Неверный формат даты истечения. Используйте 'YYYY-MM-DD HH:MM:SS'"
-    else:
-        expiration_dt = datetime.now() + timedelta(hours=DEFAULT_EXPIRATION_HOURS)
-        expires_at_str = expiration_dt.strftime("%Y-%m-%d %H:%M:%S")
+    expiration_dt, expires_at_str, expiration_error = parse_expiration(expires_at)
+    error = expiration_error or error
+    redirect_status, status_error = parse_redirect_status(redirect_status)
+    error = error or status_error
+
+    if not error:
+        short_code, error = await db.run(
+            storage.create_link, url, custom_alias or None, expires_at_str, int(expiration_dt.timestamp()),
+            redirect_status, user[0] if user else None
+        )
 
     if error:
-        conn.close()
-        return f"""
-        <html>
-          <head><style>
-            body {{ text-align: center; margin-top: 50px; font-family: Arial; }}
-            .error {{ color: red; padding: 20px; border: 1px solid red; margin: 20px auto; width: 60%; }}
-          </style></head>
-          <body>
-            <div class="error">
-              <h3>Ошибка!</h3>
-              <p>{error}</p>
-              <a href="/">Попробовать снова</a>
-            </div>
-          </body>
-        </html>
-        """
-
-    # поиск существующей записи
-    cursor.execute("SELECT short_code FROM links WHERE original_url = ?", (url,))
-    existing_link = cursor.fetchone()
-
-    if existing_link:
-        short_code = existing_link[0]
-    else:
-        if custom_alias:
-            short_code = custom_alias
-        else:
-            attempts = 0
-            while True:
-                salt = str(random.randint(0, 999999)) if attempts > 0 else ""
-                short_code = generate_short_code(url + salt)
-                cursor.execute("SELECT short_code FROM links WHERE short_code = ?", (short_code,))
-                if not cursor.fetchone():
-                    break
-                attempts += 1
-                if attempts > 5:
-                    conn.close()
-                    return "Ошибка генерации уникальной ссылки"
-        try:
-            cursor.execute(
-                "INSERT INTO links (original_url, short_code, expires_at) VALUES (?, ?, ?)",
-                (url, short_code, expires_at_str)
-            )
-            conn.commit()
-        except sqlite3.IntegrityError:
-            conn.close()
-            return f"""
-            <html>
-              <body style="text-align:center; margin-top:50px;">
-                <h2 style="color:red;">Ошибка! Псевдоним '{short_code}' уже существует</h2>
-                <p><a href="/">Попробовать снова</a></p>
-              </body>
-            </html>
-            """
-    conn.close()
+        return render("error", error=error)
+    await db.run(link_created, short_code)
+
     short_url = f"/r/{short_code}"
-    html_content = f"""
-    <html>
-      <head>
-        <title>Сокращённая ссылка</title>
-        <style>
-          body {{ font-family: Arial, sans-serif; text-align: center; margin-top: 50px; }}
-          .success-box {{ 
-            padding: 20px;
-            border: 2px solid #4CAF50;
-            border-radius: 5px;
-            margin: 20px auto;
-            width: 60%;
-          }}
-          .short-url {{ 
-            font-size: 24px; 
-            color: #2196F3;
-            word-break: break-all;
-            margin: 15px 0;
-          }}
-          .button-group button {{
-            margin: 5px;
-            padding: 10px 20px;
-            border: none;
-            border-radius: 4px;
-            cursor: pointer;
-          }}
-          .delete-btn {{ background-color: #ff4444; color: white; }}
-          .update-btn {{ background-color: #ff9800; color: white; }}
-          .stats-btn {{ background-color: #4CAF50; color: white; }}
-          .nav-buttons a {{
-              text-decoration: none; 
-              color: white; 
-              background: #007bff; 
-              padding: 10px 20px; 
-              border-radius: 4px; 
-              margin: 0 5px;
-          }}
-          .footnote {{
-              font-size: 12px;
-              color: #666;
-              margin-top: 10px;
-          }}
-        </style>
-      </head>
-      <body>
-        <div class="success-box">
-          <h2>✅ Ссылка успешно создана!</h2>
-          <div class="short-url">
-            <a href="{short_url}" target="_blank">{short_url}</a>
-          </div>
-          <div class="button-group">
-            <a href="/"><button>Создать новую</button></a>
-            <form action="/delete" method="post" style="display: inline;">
-              <input type="hidden" name="short_code" value="{short_code}">
-              <button type="submit" class="delete-btn">Удалить</button>
-            </form>
-            <a href="/update/{short_code}"><button class="update-btn">Изменить</button></a>
-            <a href="/links/{short_code}/stats"><button class="stats-btn">Статистика</button></a>
-          </div>
-          <div class="footnote">
-            Эта ссылка будет активна до {expires_at_str}
-          </div>
-          <div class="nav-buttons" style="margin-top: 20px;">
-            <a href="/my_urls">Мои URL</a>
-          </div>
-        </div>
-      </body>
-    </html>
-    """
-    existing_cookie = request.cookies.get("my_urls")
-    if existing_cookie:
-        codes = existing_cookie.split(",")
-        if short_code not in codes:
-            codes.append(short_code)
-    else:
-        codes = [short_code]
+    html_content = render("shortened", short_url=short_url, short_code=short_code, expires_at_str=expires_at_str)
     response_obj = HTMLResponse(content=html_content)
-    response_obj.set_cookie(key="my_urls", value=",".join(codes), httponly=True)
+    # ссылки пользователя находятся по owner_id, в cookie браузера -- только анонимные
+    if user:
+        return response_obj
+    cookie = await db.run(link_cookie.remember, request.cookies.get(COOKIE_NAME), short_code)
+    response_obj.set_cookie(key=COOKIE_NAME, value=cookie, httponly=True)
     return response_obj
 
+
+# валидируем часть пакета и сохраняем корректные элементы; offset -- номер первого элемента
+async def process_bulk_items(raw_items: list, offset: int = 0, owner_id: int = None) -> list:
+    results = [None] * len(raw_items)
+    valid, positions = [], []
+    for i, raw in enumerate(raw_items):
+        if not isinstance(raw, dict):
+            results[i] = {"index": offset + i, "status": "error", "error": "Элемент должен быть JSON-объектом"}
+            continue
+        url = raw.get("url")
+        alias = raw.get("custom_alias")
+        error = None
+        if not isinstance(url, str) or not url.strip():
+            error = "URL не предоставлен"
+        elif alias is not None and not isinstance(alias, str):
+            error = "custom_alias должен быть строкой"
+        else:
+            alias = (alias or "").strip() or None
+            if alias:
+                error = validate_alias(alias)
+        expiration_dt, expires_at_str, expiration_error = parse_expiration(raw.get("expires_at"))
+        redirect_status, status_error = parse_redirect_status(raw.get("redirect_status"))
+        error = error or expiration_error or status_error
+        if error:
+            results[i] = {"index": offset + i, "url": url, "status": "error", "error": error}
+            continue
+        valid.append({
+            "url": url,
+            "alias": alias,
+            "expires_at": expires_at_str,
+            "expires_ts": int(expiration_dt.timestamp()),
+            "digest": url_hash(url),
+            "redirect_status": redirect_status,
+        })
+        positions.append(i)
+
+    if valid:
+        saved = await db.run(storage.create_links, valid, owner_id)
+        await db.run(code_filter.add, [short_code for short_code, outcome, _ in saved if outcome == "created"])
+        for i, item, (short_code, outcome, error) in zip(positions, valid, saved):
+            result = {"index": offset + i, "url": item["url"], "short_code": short_code, "status": outcome}
+            if error:
+                result["error"] = error
+            results[i] = result
+    return results
+
+
+# NDJSON: читаем тело построчно и сохраняем пачками по BULK_CHUNK_SIZE.
+# Результаты копим во временном файле (в памяти до 1 МБ, дальше на диске) и отдаем потоком:
+# starlette сам читает receive() во время StreamingResponse, поэтому вход и выход одновременно не стримим
+async def save_bulk_ndjson(request: Request, owner_id: int = None):
+    output = tempfile.SpooledTemporaryFile(max_size=1024 * 1024, mode="w+b")
+    buffer = b""
+    pending = []
+    offset = 0
+
+    async def flush():
+        nonlocal pending, offset
+        results = await process_bulk_items(pending, offset, owner_id)
+        offset += len(pending)
+        pending = []
+        output.write("".join(json.dumps(result, ensure_ascii=False) + "\n" for result in results).encode())
+
+    def parse(line: bytes):
+        try:
+            return json.loads(line)
+        except ValueError:
+            return None
+
+    async for chunk in request.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            if line.strip():
+                pending.append(parse(line))
+            if len(pending) >= settings.BULK_CHUNK_SIZE:
+                await flush()
+    if buffer.strip():
+        pending.append(parse(buffer))
+    if pending:
+        await flush()
+    output.seek(0)
+    return output
+
+
+# JSON API для пакетного создания ссылок:
+# {"items": [{"url": ..., "custom_alias": ..., "expires_at": ..., "redirect_status": ...}, ...]} или NDJSON-поток таких объектов
+@app.post("/api/links/bulk")
+async def bulk_shorten(request: Request, user=Depends(current_user)):
+    owner_id = user[0] if user else None
+    if "ndjson" in request.headers.get("content-type", ""):
+        output = await save_bulk_ndjson(request, owner_id)
+        return StreamingResponse(iter(lambda: output.read(65536), b""), media_type="application/x-ndjson")
+
+    try:
+        payload = await request.json()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Неверный JSON")
+    items = payload.get("items") if isinstance(payload, dict) else payload
+    if not isinstance(items, list):
+        raise HTTPException(status_code=400, detail="Ожидается список items")
+    if len(items) > settings.BULK_MAX_ITEMS:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Не больше {settings.BULK_MAX_ITEMS} ссылок за запрос, используйте NDJSON"
+        )
+
+    results = await process_bulk_items(items, owner_id=owner_id)
+    summary = {"created": 0, "existing": 0, "error": 0}
+    for result in results:
+        summary[result["status"]] += 1
+    return {"summary": summary, "results": results}
+
 # обработчик удаления ссылки через POST-запрос
 @app.post("/delete", response_class=HTMLResponse)
-def delete_link(short_code: str = Form(...)):
-    conn, cursor = get_db()
-    cursor.execute("SELECT id FROM links WHERE short_code = ?", (short_code,))
-    link = cursor.fetchone()
-
-    if not link:
-        conn.close()
-        return HTMLResponse(f"""
-        <html>
-          <head><title>Ошибка</title></head>
-          <body style="text-align:center; font-family:Arial; margin-top:50px;">
-            <h1>Ссылка не найдена</h1>
-            <p><a href="/">Вернуться на главную</a></p>
-          </body>
-        </html>
-        """, status_code=404)
-
-    cursor.execute("DELETE FROM links WHERE short_code = ?", (short_code,))
-    conn.commit()
-    conn.close()
-    return f"""
-    <html>
-      <head>
-        <title>Ссылка удалена</title>
-        <style>
-            body {{ font-family: Arial, sans-serif; text-align: center; margin-top: 50px; }}
-        </style>
-      </head>
-      <body>
-        <h1>Ссылка удалена</h1>
-        <p>Короткая ссылка с кодом {short_code} была успешно удалена.</p>
-        <p><a href="/">Вернуться на главную</a></p>
-      </body>
-    </html>
-    """
+async def delete_link(short_code: str = Form(...), user=Depends(current_user)):
+    if not await check_owner(short_code, user) or not await db.run(storage.delete_link, short_code):
+        return HTMLResponse(NOT_FOUND_PAGE, status_code=404)
+
+    redirect_cache.invalidate(short_code)
+    await db.run(links_deleted, [short_code])
+    return render("deleted", short_code=short_code)
 
 
 # обработчик обновления ссылки через PUT (принимает JSON)
 @app.put("/links/{short_code}")
-def update_link(short_code: str, payload: dict = Body(...)):
+async def update_link(short_code: str, payload: dict = Body(...), user=Depends(current_user)):
     new_url = payload.get("new_url")
+    if new_url is not None and not isinstance(new_url, str):
+        raise HTTPException(status_code=400, detail="new_url должен быть строкой")
     if not new_url:
         return {"detail": "Новый URL не предоставлен"}
-    conn, cursor = get_db()
-    cursor.execute("SELECT id FROM links WHERE short_code = ?", (short_code,))
-    link = cursor.fetchone()
-    if not link:
-        conn.close()
+    if not await check_owner(short_code, user) or not await db.run(storage.update_url, short_code, new_url):
         return {"detail": "Ссылка не найдена"}
-    cursor.execute("UPDATE links SET original_url = ? WHERE short_code = ?", (new_url, short_code))
-    conn.commit()
-    conn.close()
+    redirect_cache.invalidate(short_code)
+    await db.run(link_updated, short_code)
     return {"detail": "Ссылка обновлена успешно"}
 
 
+# код ответа редиректа для ссылки: {"redirect_status": 301 | 302 | 307 | 308 | null}, null -- по умолчанию.
+# Браузеры и CDN, уже закэшировавшие 301/308, узнают о смене только после истечения max-age
+@app.put("/links/{short_code}/redirect")
+async def update_redirect_status(short_code: str, payload: dict = Body(...), user=Depends(current_user)):
+    redirect_status, error = parse_redirect_status(payload.get("redirect_status"))
+    if error:
+        raise HTTPException(status_code=400, detail=error)
+    if (
+        not await check_owner(short_code, user)
+        or not await db.run(storage.set_redirect_status, short_code, redirect_status)
+    ):
+        raise HTTPException(status_code=404, detail="Link not found")
+    redirect_cache.invalidate(short_code)
+    await db.run(link_updated, short_code)
+    return {
+        "short_code": short_code,
+        "redirect_status": redirect_status or settings.REDIRECT_STATUS,
+        "default": redirect_status is None,
+    }
+
+
 # страница для обновления ссылки – форма с JavaScript для отправки PUT-запроса
 @app.get("/update/{short_code}", response_class=HTMLResponse)
-def update_form(short_code: str):
-    return f"""
-    <html>
-      <head>
-        <title>Обновление ссылки</title>
-        <script>
-          function updateLink() {{
-            const newUrl = document.getElementById("new_url").value;
-            fetch("/links/{short_code}", {{
-              method: "PUT",
-              headers: {{
-                "Content-Type": "application/json"
-              }},
-              body: JSON.stringify({{ "new_url": newUrl }})
-            }})
-            .then(response => response.json())
-            .then(data => {{
-              document.getElementById("result").innerText = data.detail;
-            }})
-            .catch(error => {{
-              document.getElementById("result").innerText = "Ошибка обновления";
-            }});
-          }}
-        </script>
-        <style>
-          body {{ font-family: Arial, sans-serif; text-align: center; margin-top: 50px; }}
-          input, button {{ padding: 10px; margin-top: 10px; }}
-        </style>
-      </head>
-      <body>
-        <h1>Обновление ссылки</h1>
-        <p>Введите новый URL:</p>
-        <input type="text" id="new_url" placeholder="https://new-example.com" required>
-        <br>
-        <button onclick="updateLink()">Обновить ссылку</button>
-        <p id="result"></p>
-        <p><a href="/">Вернуться на главную</a></p>
-      </body>
-    </html>
-    """
-
-
-# эндпоинт статистики по ссылке: GET /links/{short_code}/stats
-@app.get("/links/{short_code}/stats", response_class=HTMLResponse)
-def get_link_stats(short_code: str):
-    conn = get_connection()
-    cursor = conn.cursor()
+async def update_form(short_code: str):
+    return render("update", update_url=js_string(f"/links/{short_code}"))
 
+
+# регистрация: логин и пароль формой, как у /login
+@app.post("/register", status_code=201)
+async def register_user(username: str = Form(...), password: str = Form(...)):
+    user_id, error = await register(username, password)
+    if error:
+        raise HTTPException(status_code=409 if error == USERNAME_TAKEN else 400, detail=error)
+    return {"id": user_id, "username": username}
+
+
+# вход по OAuth2 password flow: {"access_token", "token_type": "bearer"}; токен передается
+# в заголовке Authorization: Bearer ... и делает запросы запросами этого пользователя
+@app.post("/login")
+async def login(form: OAuth2PasswordRequestForm = Depends()):
+    user = await authenticate(form.username, form.password)
+    if user is None:
+        raise HTTPException(
+            status_code=401, detail="Неверный логин или пароль", headers={"WWW-Authenticate": "Bearer"}
+        )
+    return {
+        "access_token": tokens.issue(*user),
+        "token_type": "bearer",
+        "expires_in": settings.ACCESS_TOKEN_EXPIRE_MINUTES * 60,
+    }
+
+
+@app.get("/api/me")
+async def me(user=Depends(require_user)):
+    return {"id": user[0], "username": user[1]}
+
+
+# ссылки пользователя, новые первыми; курсор after -- из next_after предыдущей страницы
+@app.get("/api/me/links")
+async def my_links(q: str = "", after: Optional[str] = None, limit: int = 50, user=Depends(require_user)):
+    limit = max(1, min(limit, 500))
+    cursor = None
+    if after is not None:
+        cursor = parse_page_cursor(after)
+        if cursor is None:
+            raise HTTPException(status_code=400, detail="Неверный курсор after")
+    rows = await read_routing.run(storage.list_owner_links, user[0], q.strip(), cursor, limit + 1)
+    shown = rows[:limit]
+    return {
+        "links": [
+            {"short_code": short_code, "original_url": original_url, "created_at": created_at}
+            for short_code, original_url, created_at, _, _, _ in shown
+        ],
+        "next_after": format_cursor(*shown[-1][3:]) if len(rows) > limit else None,
+    }
+
+
+# последние 7 дней по дням и 24 часа по часам (пустые корзины -- нули), топ рефереров и клиентов;
+# все из агрегатов, время в UTC
+def fetch_activity(short_code: str, now: int) -> dict:
+    day_end = now - now % 86400 + 86400
+    hour_end = now - now % 3600 + 3600
+    daily = dict(fetch_buckets(short_code, "day", day_end - 7 * 86400, day_end))
+    hourly = dict(fetch_buckets(short_code, "hour", hour_end - 24 * 3600, hour_end))
+    return {
+        "daily": [(ts, daily.get(ts, 0)) for ts in range(day_end - 7 * 86400, day_end, 86400)],
+        "hourly": [(ts, hourly.get(ts, 0)) for ts in range(hour_end - 24 * 3600, hour_end, 3600)],
+        "referrers": fetch_breakdown(short_code, "referrer", day_end - 7 * 86400, day_end, 10),
+        "agents": fetch_breakdown(short_code, "agent", day_end - 7 * 86400, day_end, 10),
+    }
+
+
+@app.get("/links/{short_code}/stats", response_class=HTMLResponse)
+async def get_link_stats(short_code: str):
     try:
         # все данные о ссылке
-        cursor.execute(
-            """SELECT original_url, created_at, clicks, last_used_at 
-            FROM links 
-            WHERE short_code = ?""",
-            (short_code,)
-        )
-        link = cursor.fetchone()
+        link = await db.run(storage.get_link, short_code)
 
         if not link:
             return HTMLResponse(
                 content="<h1>Ссылка не найдена</h1>",
                 status_code=404
             )
+        activity = await read_routing.run(fetch_activity, short_code, int(time.time()))
 
         original_url, created_at, clicks, last_used_at = link
+        # добавляем клики, которые еще не сброшены в базу
+        clicks += click_buffer.pending(short_code)
 
         # форматируем даты
         created_at = datetime.strptime(created_at, "%Y-%m-%d %H:%M:%S").strftime("%d.%m.%Y %H:%M")
@@ -400,301 +566,446 @@ def get_link_stats(short_code: str):
             else "Никогда"
         )
 
-        return f"""
-        <html>
-          <head>
-            <title>Статистика</title>
-            <style>
-              body {{ font-family: Arial, sans-serif; padding: 20px; }}
-              .stats {{ 
-                max-width: 600px;
-                margin: 0 auto;
-                border: 1px solid #ddd;
-                padding: 20px;
-                border-radius: 8px;
-              }}
-              table {{ width: 100%; border-collapse: collapse; margin-top: 20px; }}
-              td, th {{ 
-                padding: 12px;
-                text-align: left;
-                border-bottom: 1px solid #ddd;
-              }}
-              th {{ background-color: #f5f5f5; }}
-            </style>
-          </head>
-          <body>
-            <div class="stats">
-              <h2>Статистика для ссылки: {short_code}</h2>
-              <table>
-                <tr>
-                  <th>Оригинальный URL</th>
-                  <td><a href="{original_url}" target="_blank">{original_url}</a></td>
-                </tr>
-                <tr>
-                  <th>Дата создания</th>
-                  <td>{created_at}</td>
-                </tr>
-                <tr>
-                  <th>Переходов</th>
-                  <td>{clicks}</td>
-                </tr>
-                <tr>
-                  <th>Последний переход</th>
-                  <td>{last_used}</td>
-                </tr>
-              </table>
-              <p style="margin-top: 20px;">
-                <a href="/">← На главную</a>
-              </p>
-            </div>
-          </body>
-        </html>
-        """
+        return render(
+            "stats",
+            short_code=short_code,
+            original_url=original_url,
+            created_at=created_at,
+            clicks=clicks,
+            last_used=last_used,
+            daily=render_rows("stats_row", (
+                {"label": datetime.utcfromtimestamp(ts).strftime("%d.%m.%Y"), "clicks": count}
+                for ts, count in activity["daily"]
+            )),
+            hourly=render_rows("stats_row", (
+                {"label": datetime.utcfromtimestamp(ts).strftime("%d.%m %H:00"), "clicks": count}
+                for ts, count in activity["hourly"]
+            )),
+            referrers=render_rows("stats_row", (
+                {"label": value or "прямой переход", "clicks": count} for value, count in activity["referrers"]
+            )),
+            agents=render_rows("stats_row", (
+                {"label": value, "clicks": count} for value, count in activity["agents"]
+            )),
+        )
 
     except sqlite3.Error as e:
         raise HTTPException(
             status_code=500,
             detail=f"Database error: {str(e)}"
         )
-    finally:
-        conn.close()
 
 
-# перенаправляем по короткой ссылке на исходный URL с обновлением счетчика кликов и даты последнего использования
+# JSON-статистика по агрегатам: GET /api/links/{short_code}/stats?granularity=hour&since=...&until=...
+# since/until -- unix-время (UTC); по умолчанию последние сутки для minute/hour и 30 дней для day
+def fetch_link_activity(short_code: str, granularity: str, since: int, until: int):
+    if not storage.get_link(short_code):
+        return None
+    return {
+        "buckets": fetch_buckets(short_code, granularity, since, until),
+        "referrers": fetch_breakdown(short_code, "referrer", since, until, 20),
+        "agents": fetch_breakdown(short_code, "agent", since, until, 20),
+    }
+
+
+@app.get("/api/links/{short_code}/stats")
+async def link_stats_api(
+    short_code: str,
+    granularity: str = "hour",
+    since: Optional[int] = None,
+    until: Optional[int] = None,
+):
+    size = GRANULARITIES.get(granularity)
+    if size is None:
+        raise HTTPException(status_code=400, detail=f"granularity: одно из {', '.join(GRANULARITIES)}")
+    until = until if until is not None else int(time.time()) + 1
+    since = since if since is not None else until - (30 * 86400 if granularity == "day" else 86400)
+    if since >= until:
+        raise HTTPException(status_code=400, detail="since должен быть меньше until")
+    if (until - since) // size > STATS_MAX_BUCKETS:
+        raise HTTPException(status_code=400, detail=f"Не больше {STATS_MAX_BUCKETS} корзин за запрос")
+
+    activity = await read_routing.run(fetch_link_activity, short_code, granularity, since - since % size, until)
+    if activity is None:
+        raise HTTPException(status_code=404, detail="Link not found")
+    buckets = [{"ts": ts, "clicks": clicks} for ts, clicks in activity["buckets"]]
+    return {
+        "short_code": short_code,
+        "granularity": granularity,
+        "since": since - since % size,
+        "until": until,
+        "total": sum(bucket["clicks"] for bucket in buckets),
+        "buckets": buckets,
+        # разрезы хранятся по дням, поэтому границы здесь округляются до суток
+        "referrers": [{"host": host or None, "clicks": clicks} for host, clicks in activity["referrers"]],
+        "agents": [{"agent": agent, "clicks": clicks} for agent, clicks in activity["agents"]],
+    }
+
+
+# перенаправляем по короткой ссылке на исходный URL: сначала общая таблица горячих ссылок
+# (hotlinks.py), потом кэш процесса, потом база; клики копятся в памяти и пишутся пачками (см. clicks.py)
 @app.get("/r/{short_code}")
-def redirect_to_original(short_code: str):
-    conn = get_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute(
-            "SELECT original_url, clicks, expires_at FROM links WHERE short_code = ?",
-            (short_code,)
-        )
-        link = cursor.fetchone()
-        if not link:
+async def redirect_to_original(short_code: str, request: Request):
+    cached = hot_links.get(short_code)
+    if cached is MISSING:
+        cached = redirect_cache.get(short_code)
+    if cached is MISSING:
+        # несуществующие коды (боты перебирают /r/...) отсекаем без запроса к базе
+        if not code_filter.might_contain(short_code):
             raise HTTPException(status_code=404, detail="Link not found")
-        original_url, clicks, expires_at = link
-
-        # проверка срока действия ссылки
-        if expires_at:
-            expiration_dt = datetime.strptime(expires_at, "%Y-%m-%d %H:%M:%S")
-            if datetime.now() > expiration_dt:
-                # удаляем ссылку, если она просрочена
-                cursor.execute("DELETE FROM links WHERE short_code = ?", (short_code,))
-                conn.commit()
-                raise HTTPException(status_code=404, detail="Link expired")
-
-        cursor.execute(
-            """UPDATE links 
-            SET clicks = ?, 
-                last_used_at = strftime('%Y-%m-%d %H:%M:%S', 'now', 'localtime') 
-            WHERE short_code = ?""",
-            (clicks + 1, short_code)
+        try:
+            cached = await db.run(storage.get_redirect, short_code)
+        except sqlite3.Error as e:
+            raise HTTPException(
+                status_code=500,
+                detail=f"Database error: {str(e)}"
+            )
+        if cached is None:
+            code_filter.record_false_positive()
+            raise HTTPException(status_code=404, detail="Link not found")
+        redirect_cache.set(short_code, cached)
+    original_url, expires_ts, redirect_status = cached
+
+    # проверка срока действия ссылки; саму строку удалит фоновый sweeper (см. expiry.py)
+    if expires_ts is not None and time.time() > expires_ts:
+        redirect_cache.invalidate(short_code)
+        raise HTTPException(status_code=404, detail="Link expired")
+
+    click_buffer.record(
+        short_code,
+        referrer_host(request.headers.get("referer")),
+        classify_agent(request.headers.get("user-agent")),
+    )
+    return redirect_response(request, original_url, expires_ts, redirect_status or settings.REDIRECT_STATUS)
+
+
+# кэшируемый редирект живет не дольше ссылки; ETag позволяет CDN после истечения max-age
+# перепроверить ответ и получить 304 вместо нового тела (переход при этом засчитывается)
+def redirect_response(request: Request, original_url: str, expires_ts, redirect_status: int) -> Response:
+    if redirect_status not in CACHEABLE_REDIRECTS:
+        return RedirectResponse(url=original_url, status_code=redirect_status, headers={"Cache-Control": "no-store"})
+    max_age = settings.REDIRECT_MAX_AGE
+    if expires_ts is not None:
+        max_age = max(0, min(max_age, int(expires_ts - time.time())))
+    etag = f'"{zlib.crc32(original_url.encode()):08x}-{redirect_status}"'
+    headers = {"Cache-Control": f"public, max-age={max_age}", "ETag": etag}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and etag in [tag.strip().replace("W/", "", 1) for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    return RedirectResponse(url=original_url, status_code=redirect_status, headers=headers)
+
+
+# служебные эндпоинты; если задан SHORTENER_ADMIN_TOKEN, нужен заголовок X-Admin-Token
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    if settings.ADMIN_TOKEN and not hmac.compare_digest(x_admin_token or "", settings.ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+
+# выгрузка, загрузка и копия базы отдают или меняют все ссылки, /admin/clicks накручивает
+# счетчики любой ссылки: без SHORTENER_ADMIN_TOKEN они закрыты
+def require_admin_token(x_admin_token: Optional[str] = Header(None)):
+    if not settings.ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Задайте SHORTENER_ADMIN_TOKEN")
+    require_admin(x_admin_token)
+
+
+# переходы по закэшированным 301/308, о которых знает только CDN: периодический отчет
+# {"clicks": [{"short_code", "clicks", "referrer"?, "user_agent"?}]} добавляется к счетчикам
+# и аналитике так же, как обычные клики
+@app.post("/admin/clicks", dependencies=[Depends(require_admin_token)])
+async def report_clicks(payload: dict = Body(...)):
+    items = payload.get("clicks")
+    if not isinstance(items, list):
+        raise HTTPException(status_code=400, detail="Ожидается поле clicks со списком")
+    if len(items) > CLICK_REPORT_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"Не больше {CLICK_REPORT_MAX_ITEMS} записей за запрос")
+    accepted = total = 0
+    rejected = []
+    for index, item in enumerate(items):
+        short_code = item.get("short_code") if isinstance(item, dict) else None
+        clicks = item.get("clicks") if isinstance(item, dict) else None
+        if (
+            not isinstance(short_code, str) or isinstance(clicks, bool) or not isinstance(clicks, int) or clicks <= 0
+            or not code_filter.might_contain(short_code)
+        ):
+            rejected.append(index)
+            continue
+        user_agent = item.get("user_agent")
+        click_buffer.record(
+            short_code,
+            referrer_host(item.get("referrer")),
+            classify_agent(user_agent) if isinstance(user_agent, str) else None,
+            clicks,
         )
-        conn.commit()
-        return RedirectResponse(url=original_url)
+        accepted += 1
+        total += clicks
+    return {"accepted": accepted, "clicks": total, "rejected": rejected}
+
+
+# служебная статистика процесса (кэш редиректов и т.д.)
+@app.get("/admin/stats", dependencies=[Depends(require_admin)])
+async def admin_stats():
+    return {
+        "redirect_cache": redirect_cache.stats(),
+        "click_buffer": click_buffer.stats(),
+        "db_pool": pool.stats(),
+        "storage": storage.stats(),
+        "short_codes": allocator.stats(),
+        "db_executor": db.stats(),
+        "expiry_sweeper": sweeper.stats(),
+        "click_rollups": rollups.stats(),
+        "cache_invalidation": invalidation.stats(),
+        "hot_links": hot_links.stats(),
+        "code_filter": code_filter.stats(),
+        "accounts": {"password_hasher": password_hasher.stats(), "tokens": tokens.stats()},
+        "worker_id": settings.WORKER_ID,
+        "search_index": "fts5" if database.FTS_ENABLED else "like",
+        "startup": startup_stats,
+        "rate_limit": limiter.stats(),
+        "read_routing": read_routing.stats(),
+        "my_urls_cookie": link_cookie.stats(),
+    }
+
+# метрики, которые и так считаются в модулях -- отдаем их значения в момент запроса /metrics
+CallbackMetric(
+    "shortener_redirect_cache_requests_total", "Redirect cache lookups by result", "counter", ("result",),
+    lambda: [(("hit",), redirect_cache.hits), (("miss",), redirect_cache.misses)],
+)
+CallbackMetric(
+    "shortener_redirect_cache_hit_ratio", "Redirect cache hit ratio since start", "gauge", (),
+    lambda: [((), redirect_cache.stats()["hit_ratio"])],
+)
+CallbackMetric(
+    "shortener_hot_links_requests_total", "Shared hot-link table lookups by result", "counter", ("result",),
+    lambda: [(("hit",), hot_links.hits), (("miss",), hot_links.misses)],
+)
+CallbackMetric(
+    "shortener_code_filter_checks_total", "Existence filter definite misses and false positives",
+    "counter", ("result",),
+    lambda: [(("definite_miss",), code_filter.definite_misses), (("false_positive",), code_filter.false_positives)],
+)
+CallbackMetric(
+    "shortener_rate_limited_total", "Requests rejected by admission control by reason", "counter", ("reason",),
+    lambda: [
+        (("write",), limiter.writes.limited), (("read",), limiter.reads.limited), (("overload",), limiter.shed),
+    ],
+)
+CallbackMetric(
+    "shortener_requests_in_flight", "Requests currently admitted in this process", "gauge", (),
+    lambda: [((), limiter.in_flight)],
+)
+CallbackMetric(
+    "shortener_redirect_cache_size", "Entries in the redirect cache", "gauge", (),
+    lambda: [((), redirect_cache.stats()["size"])],
+)
+CallbackMetric(
+    "shortener_expired_links_deleted_total", "Expired links deleted by the background sweeper", "counter", (),
+    lambda: [((), sweeper.removed_total)],
+)
+CallbackMetric(
+    "shortener_db_pool_connections", "Pooled SQLite connections by state", "gauge", ("state",),
+    lambda: [(("in_use",), pool.stats()["in_use"]), (("idle",), pool.stats()["idle"])],
+)
+CallbackMetric(
+    "shortener_db_pool_timeouts_total", "Connection pool acquire timeouts", "counter", (),
+    lambda: [((), pool.timeouts)],
+)
+CallbackMetric(
+    "shortener_db_executor_rejected_total", "DB calls rejected because the executor queue was full", "counter", (),
+    lambda: [((), db.rejected)],
+)
+CallbackMetric(
+    "shortener_read_replica_lag_seconds", "Age of the read-only snapshot each shard's reports are served from",
+    "gauge", ("shard",),
+    lambda: [
+        ((str(index),), lag) for index, lag in enumerate(replica.lag() for replica in read_routing.replicas)
+        if lag is not None
+    ],
+)
+CallbackMetric(
+    "shortener_clicks_pending", "Clicks buffered in memory and not yet flushed", "gauge", (),
+    lambda: [((), click_buffer.stats()["pending_clicks"])],
+)
+CallbackMetric(
+    "shortener_click_events_dropped_total", "Click events dropped while flushes to the database kept failing",
+    "counter", (),
+    lambda: [((), click_buffer.dropped_events)],
+)
 
-    except sqlite3.Error as e:
-        conn.rollback()
-        raise HTTPException(
-            status_code=500,
-            detail=f"Database error: {str(e)}"
-        )
-    finally:
-        conn.close()
 
-# функция my_urls оставляем без изменений (она уже имеет фиксированный путь /my_urls):
-@app.get("/my_urls", response_class=HTMLResponse)
-def my_urls(request: Request):
-    # получаем поисковый запрос, если он есть
-    search_query = request.query_params.get("original_url", "").strip()
+# метрики в текстовом формате Prometheus; закрыты тем же токеном, что и /admin/...
+@app.get("/metrics", dependencies=[Depends(require_admin)])
+async def metrics_endpoint():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 
-    html = f"""
-    <html>
-      <head>
-        <title>Мои URL</title>
-        <style>
-          body {{ font-family: Arial, sans-serif; padding: 20px; }}
-          h1 {{ text-align: center; }}
-          .search-form {{ text-align: center; margin-bottom: 20px; }}
-          input[type="text"] {{ padding: 10px; width: 300px; }}
-          button {{ padding: 10px 20px; }}
-          table {{ width: 100%; border-collapse: collapse; margin-top: 20px; }}
-          th, td {{ padding: 12px; border: 1px solid #ddd; text-align: left; }}
-          th {{ background-color: #f5f5f5; }}
-          a.button {{
-              display: inline-block;
-              padding: 10px 20px;
-              margin: 20px 0;
-              background: #007bff;
-              color: white;
-              text-decoration: none;
-              border-radius: 4px;
-          }}
-          .stat-btn {{
-              background-color: #4CAF50;
-              color: white;
-              border: none;
-              padding: 5px 10px;
-              border-radius: 4px;
-              text-decoration: none;
-          }}
-        </style>
-      </head>
-      <body>
-        <h1>Мои URL</h1>
-        <div class="search-form">
-          <form action="/my_urls" method="get">
-            <input type="text" name="original_url" placeholder="Введите оригинальный или короткий URL" value="{search_query}">
-            <button type="submit">Поиск</button>
-          </form>
-        </div>
-    """
-
-    my_urls_cookie = request.cookies.get("my_urls")
-    if not my_urls_cookie:
-        html += "<p>Вы ещё не создали ни одного URL.</p>"
-    else:
-        short_codes = my_urls_cookie.split(",")
-        conn = get_connection()
-        cursor = conn.cursor()
-        placeholders = ",".join("?" for _ in short_codes)
-        if search_query:
-            pattern = f"%{search_query}%"
-            cursor.execute(f"""
-                SELECT short_code, original_url, created_at 
-                FROM links 
-                WHERE short_code IN ({placeholders})
-                  AND (original_url LIKE ? OR short_code LIKE ?)
-                ORDER BY datetime(created_at) DESC
-            """, tuple(short_codes) + (pattern, pattern))
-        else:
-            cursor.execute(f"""
-                SELECT short_code, original_url, created_at 
-                FROM links 
-                WHERE short_code IN ({placeholders})
-                ORDER BY datetime(created_at) DESC
-            """, tuple(short_codes))
-        links = cursor.fetchall()
-        conn.close()
-        if links:
-            html += """
-            <table>
-              <tr>
-                <th>Короткий код</th>
-                <th>Длинный URL</th>
-                <th>Дата создания</th>
-                <th>Статистика</th>
-              </tr>
-            """
-            for short_code, original_url, created_at in links:
-                html += f"""
-                <tr>
-                  <td><a href="/r/{short_code}" target="_blank">{short_code}</a></td>
-                  <td><a href="{original_url}" target="_blank">{original_url}</a></td>
-                  <td>{created_at}</td>
-                  <td><a href="/links/{short_code}/stats" class="stat-btn" target="_blank">Статистика</a></td>
-                </tr>
-                """
-            html += "</table>"
-        else:
-            html += "<p>По вашему запросу ничего не найдено.</p>"
 
-    html += """
-        <p style="text-align:center;"><a href="/" class="button">← На главную</a></p>
-      </body>
-    </html>
-    """
-    return html
+# курсор страницы: "created_ts.id" последней показанной ссылки и ".шард", если шардов несколько
+def parse_page_cursor(value: Optional[str]):
+    try:
+        parts = [int(part) for part in value.split(".")]
+    except (AttributeError, ValueError):
+        return None
+    if len(parts) == 2:
+        parts.append(0)
+    return tuple(parts) if len(parts) == 3 else None
 
 
-@app.get("/links/search", response_class=HTMLResponse)
-def search_links(request: Request):
+def format_cursor(*parts) -> str:
+    # шард 0 не пишем: с одним файлом курсоры выглядят как раньше
+    return ".".join(str(part) for part in (parts[:-1] if parts[-1] == 0 else parts))
+
+
+# страница списка ссылок: одну страницу (LINKS_PAGE_SIZE) берем из базы заранее,
+# а HTML отдаем потоком кусками по мере рендера
+async def link_list_response(request: Request, page: str, base_path: str):
     search_query = request.query_params.get("original_url", "").strip()
-    my_urls_cookie = request.cookies.get("my_urls")
-    html = """
-    <html>
-      <head>
-        <title>Мои URL - Поиск</title>
-        <style>
-          body { font-family: Arial, sans-serif; padding: 20px; }
-          h1 { text-align: center; }
-          .search-form { text-align: center; margin-bottom: 20px; }
-          input[type="text"] { padding: 10px; width: 300px; }
-          button { padding: 10px 20px; }
-          table { width: 100%; border-collapse: collapse; margin-top: 20px; }
-          th, td { padding: 12px; border-bottom: 1px solid #ddd; text-align: left; }
-          th { background-color: #f5f5f5; }
-          a.button { 
-              display: inline-block; 
-              padding: 10px 20px; 
-              margin: 20px 0; 
-              background: #007bff; 
-              color: white; 
-              text-decoration: none; 
-              border-radius: 4px; 
-          }
-        </style>
-      </head>
-      <body>
-        <h1>Мои URL</h1>
-        <div class="search-form">
-          <form action="/links/search" method="get">
-            <input type="text" name="original_url" placeholder="Введите оригинальный или короткий URL" value="{query}">
-            <button type="submit">Поиск</button>
-          </form>
-        </div>
-    """.replace("{query}", search_query)
-
-    if not my_urls_cookie:
-        html += "<p>Вы ещё не создали ни одного URL.</p>"
+    after = parse_page_cursor(request.query_params.get("after"))
+    cookie = request.cookies.get(COOKIE_NAME)
+    page_size = settings.LINKS_PAGE_SIZE
+
+    # cookie старого формата (коды через запятую) переводим в новый при первом же просмотре
+    migrated = None
+    if link_cookie.is_legacy(cookie):
+        link_ids, list_id = await db.run(link_cookie.migrate, cookie)
+        migrated = link_cookie.dumps(link_ids, list_id)
     else:
-        short_codes = my_urls_cookie.split(",")
-        conn = get_connection()
-        cursor = conn.cursor()
-        placeholders = ",".join("?" for _ in short_codes)
-        if search_query:
-            pattern = f"%{search_query}%"
-            cursor.execute(f"""
-                SELECT short_code, original_url, created_at 
-                FROM links 
-                WHERE short_code IN ({placeholders})
-                  AND (original_url LIKE ? OR short_code LIKE ?)
-                ORDER BY datetime(created_at) DESC
-            """, tuple(short_codes) + (pattern, pattern))
+        link_ids, list_id = link_cookie.load(cookie)
+
+    links = None
+    if link_ids or list_id:
+        links = await read_routing.run(storage.list_links, link_ids, list_id, search_query, after, page_size + 1)
+
+    async def body():
+        yield render(page, search_query=search_query)
+        pager = ""
+        if links is None:
+            yield "<p>Вы ещё не создали ни одного URL.</p>"
+        elif not links:
+            yield "<p>По вашему запросу ничего не найдено.</p>"
         else:
-            cursor.execute(f"""
-                SELECT short_code, original_url, created_at 
-                FROM links 
-                WHERE short_code IN ({placeholders})
-                ORDER BY datetime(created_at) DESC
-            """, tuple(short_codes))
-        links = cursor.fetchall()
-        conn.close()
-        if links:
-            html += """
-            <table>
-              <tr>
-                <th>Короткий код</th>
-                <th>Длинный URL</th>
-                <th>Дата создания</th>
-              </tr>
-            """
-            for short_code, original_url, created_at in links:
-                html += f"""
-                <tr>
-                  <td><a href="/r/{short_code}" target="_blank">{short_code}</a></td>
-                  <td><a href="{original_url}" target="_blank">{original_url}</a></td>
-                  <td>{created_at}</td>
-                </tr>
-                """
-            html += "</table>"
-        else:
-            html += "<p>По вашему запросу ничего не найдено.</p>"
-
-    html += """
-        <p style="text-align:center;"><a href="/" class="button">← На главную</a></p>
-      </body>
-    </html>
-    """
-    return html
+            yield render(f"{page}_table_head")
+            shown = links[:page_size]
+            for start in range(0, len(shown), 50):
+                yield render_rows(f"{page}_row", (
+                    {"short_code": short_code, "original_url": original_url, "created_at": created_at}
+                    for short_code, original_url, created_at, _, _, _ in shown[start:start + 50]
+                ))
+            yield "</table>\n"
+            if len(links) > page_size:
+                last = shown[-1]
+                query = {"after": format_cursor(last[3], last[4], last[5])}
+                if search_query:
+                    query["original_url"] = search_query
+                pager = Safe(render("pager", next_url=f"{base_path}?{urlencode(query)}"))
+        yield render("list_footer", pager=pager)
+
+    response = StreamingResponse(body(), media_type="text/html")
+    if migrated is not None:
+        response.set_cookie(key=COOKIE_NAME, value=migrated, httponly=True)
+    return response
+
+
+@app.get("/my_urls", response_class=HTMLResponse)
+async def my_urls(request: Request):
+    return await link_list_response(request, "my_urls", "/my_urls")
+
+
+@app.get("/links/search", response_class=HTMLResponse)
+async def search_links(request: Request):
+    return await link_list_response(request, "search", "/links/search")
+
+
+# поиск по всем ссылкам сервиса для оператора (не только по cookie), JSON с курсором по id
+# (при нескольких шардах курсор -- строка "id.шард")
+@app.get("/admin/links/search", dependencies=[Depends(require_admin)])
+async def admin_search_links(q: str, before: Optional[str] = None, limit: int = 50):
+    q = q.strip()
+    if not q:
+        raise HTTPException(status_code=400, detail="Пустой поисковый запрос")
+    limit = max(1, min(limit, 500))
+    cursor = None
+    if before is not None:
+        try:
+            parts = [int(part) for part in before.split(".")]
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Неверный курсор before")
+        cursor = (parts[0], parts[1] if len(parts) > 1 else 0)
+    rows = await read_routing.run(storage.search, q, cursor, limit)
+    next_before = None
+    if len(rows) == limit:
+        last_id, last_shard = rows[-1][0], rows[-1][6]
+        # с одним файлом курсор остается числом, как раньше
+        next_before = last_id if last_shard == 0 else f"{last_id}.{last_shard}"
+    return {
+        "results": [
+            {
+                "short_code": short_code,
+                "original_url": original_url,
+                "created_at": created_at,
+                "clicks": clicks,
+                "expires_at": expires_at,
+            }
+            for _, short_code, original_url, created_at, clicks, expires_at, _ in rows
+        ],
+        "next_before": next_before,
+    }
+
+
+# выгрузка всех ссылок потоком, пачками через очередь к базе (transfer.py). Номер последовательности
+# коротких кодов -- в заголовке X-Short-Code-Sequence: его передают загрузке на новой установке
+@app.get("/admin/links/export", dependencies=[Depends(require_admin_token)])
+async def export_links(format: str = "ndjson"):
+    if format not in transfer.FORMATS:
+        raise HTTPException(status_code=400, detail="Формат: ndjson или csv")
+    sequence = await db.run(transfer.short_code_sequence)
+
+    async def body():
+        if format == "csv":
+            yield transfer.header(format)
+        for shard in storage.shards:
+            after_id = 0
+            while True:
+                rows = await db.run(transfer.read_batch, shard, after_id, settings.EXPORT_BATCH_SIZE)
+                if not rows:
+                    break
+                after_id = rows[-1][0]
+                yield transfer.encode_rows(rows, format)
+
+    headers = {
+        "Content-Disposition": f'attachment; filename="links.{format}"',
+        "X-Short-Code-Sequence": str(sequence),
+    }
+    return StreamingResponse(body(), media_type=transfer.FORMATS[format], headers=headers)
+
+
+# загрузка выгрузки из тела запроса (NDJSON или CSV) без чтения его целиком; коды, которые уже
+# есть, пропускаются, строки не в UTF-8 идут в ошибки отчета. short_code_sequence -- X-Short-Code-Sequence выгрузки; keep_owners=true
+# сохраняет owner_id (только для той же базы учетных записей). Для больших таблиц
+# удобнее python transfer.py import: индексы пустого шарда строятся в конце, пока запрос ждет
+@app.post("/admin/links/import", dependencies=[Depends(require_admin_token)])
+async def import_links(
+    request: Request, format: str = "ndjson", short_code_sequence: int = 0, keep_owners: bool = False
+):
+    if format not in transfer.FORMATS:
+        raise HTTPException(status_code=400, detail="Формат: ndjson или csv")
+    importer = transfer.LinkImporter(storage, format, settings.IMPORT_BATCH_SIZE, code_filter, keep_owners)
+    buffer = b""
+    async for chunk in request.stream():
+        buffer += chunk
+        if len(buffer) < 1024 * 1024:
+            continue
+        # перевод строки оставляем: он может быть частью поля CSV в кавычках
+        *lines, buffer = buffer.split(b"\n")
+        await db.run(importer.feed, [line.decode(errors="surrogateescape") + "\n" for line in lines])
+    await db.run(importer.feed, [line.decode(errors="surrogateescape") + "\n" for line in buffer.split(b"\n")])
+    report = await db.run(importer.finish)
+    if short_code_sequence:
+        await db.run(transfer.advance_short_code_sequence, short_code_sequence)
+    return report
+
+
+# онлайн-копия файлов базы в SHORTENER_BACKUP_DIR/<время>/ по шагам backup API (transfer.py);
+# копия идет в общем threadpool, чтобы не занимать потоки очереди к базе
+@app.post("/admin/backup", dependencies=[Depends(require_admin_token)])
+async def backup_database():
+    return {"files": await run_in_threadpool(transfer.backup, storage, transfer.backup_directory())}
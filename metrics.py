@@ -0,0 +1,181 @@
+import threading
+import time
+from bisect import bisect_left
+
+# границы корзин по умолчанию (секунды): от 100 мкс до 10 с
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 10.0)
+
+# все метрики процесса в порядке регистрации; render() отдает их в текстовом формате Prometheus
+REGISTRY = []
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# счетчик с метками: inc() -- один поиск в словаре и сложение под блокировкой
+class Counter:
+    def __init__(self, name: str, help_text: str, labelnames: tuple = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, *labels, amount: int = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+    def collect(self) -> list:
+        with self._lock:
+            items = sorted(self._values.items())
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for labels, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}")
+        return lines
+
+
+# гистограмма с фиксированными корзинами. observe() не считает накопленные суммы:
+# в горячем пути только bisect по кортежу границ и два сложения, накопление -- при выдаче /metrics
+class Histogram:
+    def __init__(self, name: str, help_text: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self._series = {}  # метки -> [счетчики по корзинам (+Inf последней), сумма, количество]
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value: float, *labels):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    # замер блока кода: with histogram.time("label"): ...
+    def time(self, *labels):
+        return _Timer(self, labels)
+
+    def collect(self) -> list:
+        with self._lock:
+            items = sorted((labels, (list(counts), total, count)) for labels, (counts, total, count) in self._series.items())
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = 'le="' + _format_value(bound) + '"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {count}")
+        return lines
+
+
+class _Timer:
+    __slots__ = ("histogram", "labels", "started")
+
+    def __init__(self, histogram: Histogram, labels: tuple):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, *self.labels)
+
+
+# значение, которое считается в момент выдачи /metrics из уже существующих счетчиков
+# (статистика кэша, пула и т.д.); callback возвращает [(значения меток, число), ...]
+class CallbackMetric:
+    def __init__(self, name: str, help_text: str, kind: str, labelnames: tuple, callback):
+        self.name = name
+        self.help = help_text
+        self.kind = kind
+        self.labelnames = labelnames
+        self.callback = callback
+        REGISTRY.append(self)
+
+    def collect(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for labels, value in self.callback():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}")
+        return lines
+
+
+def render() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.collect())
+    return "\n".join(lines) + "\n"
+
+
+# ASGI-middleware: время и статус каждого запроса с меткой шаблона маршрута ("/r/{short_code}"),
+# а не конкретного пути, чтобы число рядов не росло с числом ссылок.
+# Маршрут берем из scope["endpoint"] и scope["router"], которые роутер starlette проставляет при совпадении
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+        self._route_names = None
+
+    def route_name(self, scope) -> str:
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            return "unmatched"
+        if self._route_names is None:
+            self._route_names = {
+                route.endpoint: route.path
+                for route in scope["router"].routes if hasattr(route, "endpoint")
+            }
+        return self._route_names.get(endpoint, "unmatched")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = self.route_name(scope)
+            REQUEST_LATENCY.observe(time.perf_counter() - started, route)
+            REQUESTS.inc(route, scope["method"], status_code)
+
+
+REQUESTS = Counter("shortener_http_requests_total", "HTTP requests by route, method and status", ("route", "method", "status"))
+REQUEST_LATENCY = Histogram("shortener_http_request_duration_seconds", "HTTP request latency by route", ("route",))
+DB_ACQUIRE = Histogram("shortener_db_pool_acquire_seconds", "Time spent waiting for a pooled connection")
+DB_HOLD = Histogram("shortener_db_connection_hold_seconds", "Time a pooled connection is held (queries and transactions)")
+DB_QUEUE_WAIT = Histogram("shortener_db_executor_wait_seconds", "Time a DB call waits in the executor queue")
+DB_CALL = Histogram("shortener_db_call_seconds", "DB call latency in the executor by operation", ("operation",))
@@ -0,0 +1,13 @@
+from passlib.context import CryptContext
+
+# хэширование паролей отдельно от остального сервиса: эти функции выполняются в процессах
+# пула (accounts.py), и процессу нужно импортировать только этот модуль, без базы и настроек
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+
+def hash_password(password: str) -> str:
+    return pwd_context.hash(password)
+
+
+def verify_password(password: str, password_hash: str) -> bool:
+    return pwd_context.verify(password, password_hash)
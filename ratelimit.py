@@ -0,0 +1,138 @@
+import math
+import time
+from collections import OrderedDict
+
+from starlette.responses import PlainTextResponse
+
+import settings
+
+WRITE_METHODS = ("POST", "PUT", "PATCH", "DELETE")
+# ограничиваем только маршруты клиентов, которые идут в базу: создание ссылок и редирект.
+# Страницы, API учетных записей, /admin/... и /metrics проходят без ведер и без счета в in_flight
+LIMITED_PATHS = ("/shorten", "/api/links/bulk")
+LIMITED_PREFIXES = ("/r/",)
+
+
+# ведра токенов по клиентам: rate токенов в секунду, не больше burst, запрос стоит один токен.
+# На активного клиента -- два числа; полное ведро ничем не отличается от отсутствующего, поэтому
+# клиентов, молчащих дольше burst / rate секунд, выбрасываем (а сверх max_clients -- самых давних).
+# Порядок OrderedDict -- порядок последнего обращения, так что проверяются только самые старые
+class TokenBuckets:
+    def __init__(self, rate: float, burst: float, max_clients: int):
+        self.rate = rate
+        self.burst = max(burst, 1.0)
+        self.max_clients = max_clients
+        self.idle_after = self.burst / rate if rate > 0 else 0.0
+        # ключ клиента -> [токенов, время обновления]; трогаем только из цикла событий
+        self._buckets = OrderedDict()
+        self.allowed = 0
+        self.limited = 0
+        self.evicted = 0
+
+    # 0 -- пропускаем, иначе через сколько секунд появится токен
+    def take(self, key: str, now: float) -> float:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [self.burst, now]
+        else:
+            self._buckets.move_to_end(key)
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        self._evict(now)
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            self.allowed += 1
+            return 0.0
+        self.limited += 1
+        return (1 - bucket[0]) / self.rate
+
+    def _evict(self, now: float):
+        while self._buckets:
+            key, (_, updated) = next(iter(self._buckets.items()))
+            if len(self._buckets) <= self.max_clients and now - updated < self.idle_after:
+                break
+            del self._buckets[key]
+            self.evicted += 1
+
+    def stats(self) -> dict:
+        return {
+            "rate": self.rate,
+            "burst": self.burst,
+            "clients": len(self._buckets),
+            "max_clients": self.max_clients,
+            "allowed": self.allowed,
+            "limited": self.limited,
+            "evicted": self.evicted,
+        }
+
+
+# допуск запросов в процесс на маршрутах LIMITED_PATHS/LIMITED_PREFIXES: ведра для записи
+# (POST/PUT/DELETE) и чтения по клиенту и общий предел одновременных таких запросов. Лишнее отбиваем сразу -- 429 клиенту, исчерпавшему свое ведро,
+# 503 всем, когда процесс уже занят max_in_flight запросами, -- вместо очереди без конца
+# перед блокировкой записи SQLite. Каждый воркер serve.py считает сам по себе
+class RateLimiter:
+    def __init__(self, enabled: bool, writes: TokenBuckets, reads: TokenBuckets, max_in_flight: int):
+        self.enabled = enabled
+        self.writes = writes
+        self.reads = reads
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self.shed = 0
+
+    # (код ответа, Retry-After) или None, если запрос можно выполнять
+    # перегрузку проверяем первой: отбитый 503 запрос не должен тратить токен клиента
+    def admit(self, method: str, key: str):
+        if self.max_in_flight > 0 and self.in_flight >= self.max_in_flight:
+            self.shed += 1
+            return 503, 1
+        buckets = self.writes if method in WRITE_METHODS else self.reads
+        if buckets.rate > 0:
+            wait = buckets.take(key, time.monotonic())
+            if wait:
+                return 429, max(1, math.ceil(wait))
+        return None
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+            "shed": self.shed,
+            "writes": self.writes.stats(),
+            "reads": self.reads.stats(),
+        }
+
+
+class RateLimitMiddleware:
+    def __init__(self, app, limiter: RateLimiter, client_key):
+        self.app = app
+        self.limiter = limiter
+        self.client_key = client_key
+
+    async def __call__(self, scope, receive, send):
+        if (
+            scope["type"] != "http" or not self.limiter.enabled or scope["method"] == "OPTIONS"
+            or not (scope["path"] in LIMITED_PATHS or scope["path"].startswith(LIMITED_PREFIXES))
+        ):
+            await self.app(scope, receive, send)
+            return
+        rejected = self.limiter.admit(scope["method"], self.client_key(scope))
+        if rejected is not None:
+            status_code, retry_after = rejected
+            text = "Слишком много запросов, попробуйте позже" if status_code == 429 else "Сервис перегружен, попробуйте позже"
+            response = PlainTextResponse(text, status_code=status_code, headers={"Retry-After": str(retry_after)})
+            await response(scope, receive, send)
+            return
+        self.limiter.in_flight += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.limiter.in_flight -= 1
+
+
+limiter = RateLimiter(
+    settings.RATE_LIMIT_ENABLED,
+    TokenBuckets(settings.RATE_LIMIT_WRITE_RATE, settings.RATE_LIMIT_WRITE_BURST, settings.RATE_LIMIT_MAX_CLIENTS),
+    TokenBuckets(settings.RATE_LIMIT_READ_RATE, settings.RATE_LIMIT_READ_BURST, settings.RATE_LIMIT_MAX_CLIENTS),
+    settings.MAX_IN_FLIGHT,
+)
@@ -0,0 +1,160 @@
+# перераскладка ссылок по шардам при смене их числа (или переход с одного файла на шарды и обратно).
+# Запускать при остановленном сервисе:
+#
+#   python rebalance.py --to-shards 8
+#   SHORTENER_STORAGE_SHARDS=8 uvicorn main:app
+#
+# Источник -- текущие SHORTENER_STORAGE_SHARDS / SHORTENER_STORAGE_SHARD_PATH (или --from-*).
+# Ссылки переезжают пачками: сначала вставка в целевой шард вместе с агрегатами кликов
+# и еще не свернутыми событиями, потом удаление из исходного. Если процесс прервать,
+# повторный запуск доделает работу: уже перенесенные ссылки пропускаются
+import argparse
+import json
+import os
+import sys
+import time
+
+import settings
+from analytics import WATERMARK_NAME
+from storage import create_storage
+
+LINK_COLUMNS = (
+    "original_url, short_code, created_at, clicks, last_used_at, expires_at, url_hash, expires_ts, created_ts, "
+    "redirect_status, owner_id"
+)
+
+
+def watermark(conn) -> int:
+    row = conn.execute("SELECT next_value FROM sequences WHERE name = ?", (WATERMARK_NAME,)).fetchone()
+    return row[0] if row else 0
+
+
+# переносим ссылки rows из source в target; возвращает число перенесенных
+def move_links(source, target, rows: list) -> int:
+    codes = [row[1] for row in rows]
+    placeholders = ",".join("?" for _ in codes)
+    src = source.connect()
+    try:
+        rolled = watermark(src)
+        rollups = src.execute(
+            f"SELECT short_code, granularity, bucket_ts, clicks FROM click_rollups WHERE short_code IN ({placeholders})",
+            codes
+        ).fetchall()
+        breakdowns = src.execute(
+            f"SELECT short_code, dimension, day_ts, value, clicks FROM click_breakdowns WHERE short_code IN ({placeholders})",
+            codes
+        ).fetchall()
+        # свернутые события уже посчитаны в агрегатах, переносим только хвост
+        events = src.execute(
+            f"SELECT ts, short_code, referrer_host, agent, clicks FROM click_events WHERE id > ? AND short_code IN ({placeholders})",
+            [rolled] + codes
+        ).fetchall()
+    finally:
+        src.close()
+
+    dst = target.connect()
+    try:
+        with dst:
+            moved = set()
+            for row in rows:
+                cursor = dst.execute(
+                    f"INSERT OR IGNORE INTO links ({LINK_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", row
+                )
+                if cursor.rowcount:
+                    moved.add(row[1])
+            dst.executemany(
+                "INSERT OR REPLACE INTO click_rollups (short_code, granularity, bucket_ts, clicks) VALUES (?, ?, ?, ?)",
+                [row for row in rollups if row[0] in moved]
+            )
+            dst.executemany(
+                "INSERT OR REPLACE INTO click_breakdowns (short_code, dimension, day_ts, value, clicks) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [row for row in breakdowns if row[0] in moved]
+            )
+            dst.executemany(
+                "INSERT INTO click_events (ts, short_code, referrer_host, agent, clicks) VALUES (?, ?, ?, ?, ?)",
+                [row for row in events if row[1] in moved]
+            )
+    finally:
+        dst.close()
+
+    src = source.connect()
+    try:
+        with src:
+            # агрегаты удалит триггер links_rollups_delete
+            src.execute(f"DELETE FROM links WHERE short_code IN ({placeholders})", codes)
+            src.execute(f"DELETE FROM click_events WHERE short_code IN ({placeholders})", codes)
+    finally:
+        src.close()
+    return len(moved)
+
+
+def rebalance(source_storage, target_storage, batch_size: int) -> dict:
+    started = time.perf_counter()
+    target_paths = [os.path.abspath(shard.pool.path) for shard in target_storage.shards]
+    moved = scanned = 0
+    per_shard = []
+    for source in source_storage.shards:
+        source_path = os.path.abspath(source.pool.path)
+        last_id = 0
+        shard_moved = 0
+        while True:
+            conn = source.connect()
+            try:
+                batch = conn.execute(
+                    f"SELECT id, {LINK_COLUMNS} FROM links WHERE id > ? ORDER BY id LIMIT ?",
+                    (last_id, batch_size)
+                ).fetchall()
+            finally:
+                conn.close()
+            if not batch:
+                break
+            last_id = batch[-1][0]
+            scanned += len(batch)
+            groups = {}
+            for row in batch:
+                index = target_storage.shard_index(row[2])
+                if target_paths[index] != source_path:
+                    groups.setdefault(index, []).append(row[1:])
+            for index, rows in groups.items():
+                shard_moved += move_links(source, target_storage.shards[index], rows)
+        moved += shard_moved
+        per_shard.append({"path": source.pool.path, "moved_out": shard_moved})
+        print(f"{source.pool.path}: moved {shard_moved}", file=sys.stderr, flush=True)
+
+    counts = []
+    for shard in target_storage.shards:
+        conn = shard.connect()
+        try:
+            counts.append({"path": shard.pool.path, "links": conn.execute("SELECT COUNT(*) FROM links").fetchone()[0]})
+        finally:
+            conn.close()
+    return {
+        "scanned": scanned,
+        "moved": moved,
+        "sources": per_shard,
+        "targets": counts,
+        "seconds": round(time.perf_counter() - started, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--from-shards", type=int, default=settings.STORAGE_SHARDS)
+    parser.add_argument("--from-pattern", default=settings.STORAGE_SHARD_PATH)
+    parser.add_argument("--to-shards", type=int, required=True)
+    parser.add_argument("--to-pattern", default=settings.STORAGE_SHARD_PATH)
+    parser.add_argument("--batch", type=int, default=1000)
+    args = parser.parse_args()
+
+    source_storage = create_storage(args.from_shards, args.from_pattern)
+    target_storage = create_storage(args.to_shards, args.to_pattern)
+    source_storage.init_schema()
+    target_storage.init_schema()
+    report = rebalance(source_storage, target_storage, args.batch)
+    # файлы, которые больше не нужны (при уменьшении числа шардов), остаются пустыми -- их можно удалить
+    print(json.dumps(report, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
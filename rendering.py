@@ -0,0 +1,78 @@
+import hashlib
+import html
+import json
+import os
+from string import Template
+
+TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates")
+
+
+# уже готовый HTML: такие значения подставляются без экранирования
+class Safe(str):
+    pass
+
+
+# шаблон разбирается один раз при загрузке на куски "текст + имя переменной",
+# рендер -- это один join без регулярок; все значения, кроме Safe, экранируются
+class CompiledTemplate:
+    def __init__(self, source: str):
+        self.parts = []
+        position = 0
+        for match in Template.pattern.finditer(source):
+            literal = source[position:match.start()]
+            if match.group("escaped") is not None:
+                self.parts.append((literal + Template.delimiter, None))
+            else:
+                name = match.group("named") or match.group("braced")
+                if name is None:
+                    raise ValueError(f"bad placeholder at {match.start()}")
+                self.parts.append((literal, name))
+            position = match.end()
+        self.parts.append((source[position:], None))
+
+    def render(self, values: dict) -> str:
+        out = []
+        for literal, name in self.parts:
+            out.append(literal)
+            if name is not None:
+                value = values[name]
+                out.append(value if isinstance(value, Safe) else html.escape(str(value)))
+        return "".join(out)
+
+
+def load_templates() -> dict:
+    templates = {}
+    for filename in sorted(os.listdir(TEMPLATES_DIR)):
+        if filename.endswith(".html"):
+            with open(os.path.join(TEMPLATES_DIR, filename), encoding="utf-8") as f:
+                templates[filename[:-len(".html")]] = CompiledTemplate(f.read())
+    return templates
+
+
+_templates = load_templates()
+
+
+def render(name: str, **values) -> str:
+    return _templates[name].render(values)
+
+
+# строки таблицы одним join вместо html += в цикле
+def render_rows(name: str, rows) -> Safe:
+    template = _templates[name]
+    return Safe("".join(template.render(row) for row in rows))
+
+
+# строковый литерал для вставки внутрь <script>
+def js_string(value: str) -> Safe:
+    return Safe(json.dumps(value).replace("<", "\\u003c").replace(">", "\\u003e").replace("&", "\\u0026"))
+
+
+# неизменяемая страница: байты и ETag считаются один раз
+class StaticPage:
+    def __init__(self, content: str):
+        self.body = content.encode("utf-8")
+        self.etag = '"' + hashlib.sha1(self.body).hexdigest() + '"'
+
+
+def static_page(name: str) -> StaticPage:
+    return StaticPage(render(name))
@@ -0,0 +1,178 @@
+import os
+import sqlite3
+import threading
+import time
+
+import settings
+from database import ConnectionPool
+from db_async import DBExecutor, db
+
+MODES = ("off", "wal", "snapshot")
+
+
+# соединения только для чтения к одному файлу базы (или шарду). "wal" -- тот же файл с mode=ro:
+# данные свежие, но долгий запрос держит снимок WAL и не дает checkpoint дойти до конца.
+# "snapshot" -- копия файла (<файл>.snapshot), которую раз в interval обновляет процесс
+# с фоновыми задачами; остальные замечают новую копию по inode и переходят на нее, соединения
+# к старой закрываются по мере возврата в пул
+class ReadReplica:
+    def __init__(self, source_path: str, mode: str, pool_size: int, timeout: float):
+        self.source_path = source_path
+        self.mode = mode
+        self.path = source_path if mode == "wal" else source_path + ".snapshot"
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self._pool = None
+        self._inode = None
+        self._lock = threading.Lock()
+        self.refreshes = 0
+        self.last_refresh_ms = 0.0
+        self.fallbacks = 0
+
+    # соединение или None, если копии еще нет
+    def acquire(self):
+        if self.mode == "wal":
+            with self._lock:
+                if self._pool is None:
+                    self._pool = ConnectionPool(self.path, self.pool_size, self.timeout, read_only=True)
+            return self._pool.acquire()
+        try:
+            inode = os.stat(self.path).st_ino
+        except FileNotFoundError:
+            self.fallbacks += 1
+            return None
+        with self._lock:
+            if inode != self._inode:
+                old, self._inode = self._pool, inode
+                # копия после переименования не меняется -- SQLite может не брать блокировки
+                self._pool = ConnectionPool(self.path, self.pool_size, self.timeout, read_only=True, immutable=True)
+                if old is not None:
+                    old.retire()
+            pool = self._pool
+        return pool.acquire()
+
+    # новая копия через backup API (transfer.py): во временный файл и переименованием
+    def refresh(self):
+        from transfer import backup_file
+        started = time.perf_counter()
+        backup_file(self.source_path, self.path, settings.BACKUP_PAGES, 0)
+        self.refreshes += 1
+        self.last_refresh_ms = round((time.perf_counter() - started) * 1000, 1)
+
+    # насколько данные копии старше базы, в секундах; None -- копии нет
+    def lag(self):
+        if self.mode == "wal":
+            return 0.0
+        try:
+            return max(0.0, time.time() - os.stat(self.path).st_mtime)
+        except FileNotFoundError:
+            return None
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.retire()
+            self._pool = None
+            self._inode = None
+
+    def stats(self) -> dict:
+        lag = self.lag()
+        return {
+            "path": self.path,
+            "lag_seconds": round(lag, 1) if lag is not None else None,
+            "refreshes": self.refreshes,
+            "last_refresh_ms": self.last_refresh_ms,
+            "fallbacks": self.fallbacks,
+            "pool": self._pool.stats() if self._pool is not None else None,
+        }
+
+
+# маршрутизация чтения для отчетов: статистика ссылок, списки /my_urls, /links/search, /api/me/links
+# и поиск оператора идут в свои потоки (очередь как у db_async) и к своим соединениям только
+# для чтения (SQLiteShard.connect_read), поэтому запись и редиректы не ждут ни потоков, ни пула
+# за тяжелыми запросами. При mode "off" все как раньше -- общая очередь и основной пул
+class ReadRouting:
+    def __init__(self, mode: str, interval: float, pool_size: int, workers: int, queue_size: int):
+        if mode not in MODES:
+            raise ValueError(f"SHORTENER_READ_ROUTING: одно из {', '.join(MODES)}")
+        self.mode = mode
+        self.interval = interval
+        self.pool_size = pool_size
+        self.executor = DBExecutor(workers, queue_size, settings.DB_EXECUTOR_MODE) if mode != "off" else None
+        self.replicas = []
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode != "off"
+
+    # реплика на каждый шард хранилища
+    def attach(self, storage):
+        if not self.enabled:
+            return
+        self.replicas = []
+        for shard in storage.shards:
+            shard.replica = ReadReplica(shard.pool.path, self.mode, self.pool_size, settings.DB_POOL_TIMEOUT)
+            self.replicas.append(shard.replica)
+
+    # копию обновляет только процесс с фоновыми задачами (SHORTENER_BACKGROUND_JOBS), остальные читают
+    def start(self, refresh: bool):
+        if not self.enabled:
+            return
+        self.executor.start()
+        if self.mode == "snapshot" and refresh and self.interval > 0 and self._thread is None:
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name="read-snapshot", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self.executor is not None:
+            self.executor.stop()
+        for replica in self.replicas:
+            replica.close()
+
+    # первая копия -- сразу, если ее нет или она старше interval; пока ее нет, чтение идет в основной файл
+    def _run(self):
+        wait = 0.0
+        while not self._stopped.wait(wait):
+            for replica in self.replicas:
+                lag = replica.lag()
+                if lag is not None and lag < self.interval:
+                    continue
+                try:
+                    replica.refresh()
+                except (sqlite3.Error, OSError):
+                    pass
+            ages = [replica.lag() for replica in self.replicas]
+            wait = max(1.0, self.interval - max(age or 0.0 for age in ages))
+
+    def run(self, fn, *args):
+        return (self.executor or db).run(fn, *args)
+
+    def max_lag(self):
+        lags = [replica.lag() for replica in self.replicas]
+        return max(lags) if lags and None not in lags else None
+
+    def stats(self) -> dict:
+        if not self.enabled:
+            return {"mode": "off"}
+        return {
+            "mode": self.mode,
+            "interval": self.interval,
+            "executor": self.executor.stats(),
+            "replicas": [replica.stats() for replica in self.replicas],
+        }
+
+
+read_routing = ReadRouting(
+    settings.READ_ROUTING,
+    settings.READ_SNAPSHOT_INTERVAL,
+    settings.READ_POOL_SIZE,
+    settings.READ_WORKERS,
+    settings.READ_QUEUE_SIZE,
+)
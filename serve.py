@@ -0,0 +1,107 @@
+# запуск сервиса в несколько процессов, чтобы занять все ядра:
+#
+#   python serve.py --workers 4 --port 8000
+#
+# Родитель один раз создает схему базы, открывает слушающий сокет и запускает воркеры
+# (каждый -- свой uvicorn с main:app на общем сокете). У воркеров свои кэши редиректов,
+# поэтому изменения и удаления ссылок расходятся между ними через канал инвалидации
+# (invalidation.py) с задержкой не больше SHORTENER_CACHE_INVALIDATION_INTERVAL.
+# Упавший воркер перезапускается; SIGINT/SIGTERM останавливают все процессы
+import argparse
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import time
+
+# если воркер упал сразу после старта, ждем столько секунд перед перезапуском, чтобы не крутить его в цикле
+RESTART_DELAY = 1.0
+
+
+def bind_socket(host: str, port: int) -> socket.socket:
+    # proto указываем явно: asyncio включает TCP_NODELAY на принятых соединениях, только если
+    # proto == IPPROTO_TCP, иначе ответы из двух записей ждут delayed ACK (~40 мс на запрос)
+    sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+
+def run_worker(sock: socket.socket, host: str, port: int, log_level: str, access_log: bool):
+    import uvicorn
+
+    config = uvicorn.Config(
+        "main:app", host=host, port=port, log_level=log_level, access_log=access_log, lifespan="on"
+    )
+    uvicorn.Server(config).run(sockets=[sock])
+
+
+def start_worker(context, worker_id: int, args, sock: socket.socket):
+    # настройки читаются из окружения при импорте settings, поэтому номер воркера
+    # передаем через него; дочерний процесс (spawn) наследует окружение в момент запуска
+    os.environ["SHORTENER_WORKERS"] = str(args.workers)
+    os.environ["SHORTENER_WORKER_ID"] = str(worker_id)
+    process = context.Process(
+        target=run_worker,
+        args=(sock, args.host, args.port, args.log_level, not args.no_access_log),
+        name=f"shortener-worker-{worker_id}",
+    )
+    process.start()
+    return process
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--log-level", default="info")
+    parser.add_argument("--no-access-log", action="store_true")
+    args = parser.parse_args()
+
+    # схему и миграции выполняем один раз здесь, а не наперегонки в каждом воркере
+    from storage import storage
+    storage.init_schema()
+    storage.close()
+
+    sock = bind_socket(args.host, args.port)
+    context = multiprocessing.get_context("spawn")
+    workers = {i: start_worker(context, i, args, sock) for i in range(args.workers)}
+    started = {i: time.monotonic() for i in workers}
+    print(f"serving on http://{args.host}:{args.port} with {args.workers} workers", file=sys.stderr, flush=True)
+
+    stopping = []
+
+    def shutdown(signum, frame):
+        stopping.append(signum)
+
+    signal.signal(signal.SIGINT, shutdown)
+    signal.signal(signal.SIGTERM, shutdown)
+
+    while not stopping:
+        time.sleep(0.2)
+        for i, process in list(workers.items()):
+            if process.is_alive() or stopping:
+                continue
+            print(f"worker {i} exited with code {process.exitcode}, restarting", file=sys.stderr, flush=True)
+            if time.monotonic() - started[i] < RESTART_DELAY:
+                time.sleep(RESTART_DELAY)
+            workers[i] = start_worker(context, i, args, sock)
+            started[i] = time.monotonic()
+
+    # SIGTERM дает uvicorn штатно закончить запросы и выполнить shutdown (сброс кликов)
+    for process in workers.values():
+        if process.is_alive():
+            process.terminate()
+    for process in workers.values():
+        process.join(30)
+        if process.is_alive():
+            process.kill()
+    sock.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+import os
+
+
+# настройки сервиса; любое значение можно переопределить переменной окружения
+def _env_int(name: str, default: int) -> int:
+    value = os.environ.get(name)
+    return int(value) if value else default
+
+
+def _env_float(name: str, default: float) -> float:
+    value = os.environ.get(name)
+    return float(value) if value else default
+
+
+def _env_bool(name: str, default: bool) -> bool:
+    value = os.environ.get(name)
+    return value.lower() in ("1", "true", "yes", "on") if value else default
+
+
+# кэш редиректов: сколько коротких кодов держать в памяти и сколько секунд доверять записи
+REDIRECT_CACHE_SIZE = _env_int("SHORTENER_REDIRECT_CACHE_SIZE", 4096)
+REDIRECT_CACHE_TTL = _env_float("SHORTENER_REDIRECT_CACHE_TTL", 300.0)
+
+# отложенная запись кликов: период сброса в секундах, сколько кодов копить до досрочного сброса
+# и сколько событий кликов держать, пока база не принимает запись (сверх -- старые выбрасываются)
+CLICK_FLUSH_INTERVAL = _env_float("SHORTENER_CLICK_FLUSH_INTERVAL", 2.0)
+CLICK_FLUSH_MAX_PENDING = _env_int("SHORTENER_CLICK_FLUSH_MAX_PENDING", 1000)
+CLICK_EVENTS_MAX_PENDING = _env_int("SHORTENER_CLICK_EVENTS_MAX_PENDING", 100000)
+
+# база данных и пул соединений
+DB_PATH = os.environ.get("SHORTENER_DB_PATH", "shortener.db")
+DB_POOL_SIZE = _env_int("SHORTENER_DB_POOL_SIZE", 16)
+DB_POOL_TIMEOUT = _env_float("SHORTENER_DB_POOL_TIMEOUT", 5.0)
+DB_BUSY_TIMEOUT_MS = _env_int("SHORTENER_DB_BUSY_TIMEOUT_MS", 5000)
+DB_SYNCHRONOUS = os.environ.get("SHORTENER_DB_SYNCHRONOUS", "NORMAL")
+DB_CACHE_SIZE_KB = _env_int("SHORTENER_DB_CACHE_SIZE_KB", 65536)
+DB_MMAP_SIZE = _env_int("SHORTENER_DB_MMAP_SIZE", 268435456)
+
+# генерация коротких кодов: минимальная длина, размер резервируемого блока номеров
+# и ключ перемешивания, чтобы коды нельзя было угадать по порядку (пустой -- случайный,
+# хранится в файле <SHORTENER_DB_PATH>.code-secret и общий для всех воркеров)
+SHORT_CODE_MIN_LENGTH = _env_int("SHORTENER_SHORT_CODE_MIN_LENGTH", 6)
+SHORT_CODE_BLOCK_SIZE = _env_int("SHORTENER_SHORT_CODE_BLOCK_SIZE", 1000)
+SHORT_CODE_SCRAMBLE = _env_bool("SHORTENER_SHORT_CODE_SCRAMBLE", True)
+SHORT_CODE_SECRET = os.environ.get("SHORTENER_SHORT_CODE_SECRET", "")
+
+# асинхронный доступ к базе: "dedicated" -- свои потоки и ограниченная очередь,
+# "threadpool" -- общий threadpool starlette (для сравнения в бенчмарке)
+DB_EXECUTOR_MODE = os.environ.get("SHORTENER_DB_EXECUTOR_MODE", "dedicated")
+DB_WORKERS = _env_int("SHORTENER_DB_WORKERS", 8)
+DB_QUEUE_SIZE = _env_int("SHORTENER_DB_QUEUE_SIZE", 1024)
+
+# фоновая очистка просроченных ссылок: период в секундах и размер одной пачки удаления
+EXPIRY_SWEEP_INTERVAL = _env_float("SHORTENER_EXPIRY_SWEEP_INTERVAL", 60.0)
+EXPIRY_SWEEP_BATCH = _env_int("SHORTENER_EXPIRY_SWEEP_BATCH", 500)
+
+# пакетное создание ссылок: максимум элементов в JSON-запросе и размер транзакции для NDJSON
+BULK_MAX_ITEMS = _env_int("SHORTENER_BULK_MAX_ITEMS", 50000)
+BULK_CHUNK_SIZE = _env_int("SHORTENER_BULK_CHUNK_SIZE", 5000)
+
+# сколько секунд браузер и CDN могут держать неизменяемые страницы (главная) без перепроверки
+STATIC_PAGE_MAX_AGE = _env_int("SHORTENER_STATIC_PAGE_MAX_AGE", 3600)
+
+# сколько ссылок показывать на одной странице /my_urls и /links/search
+LINKS_PAGE_SIZE = _env_int("SHORTENER_LINKS_PAGE_SIZE", 100)
+
+# сколько последних анонимных ссылок держать в самом cookie my_urls (linkcookie.py); более старые
+# уходят в список на сервере, а в cookie остается только его номер
+MY_URLS_COOKIE_MAX_LINKS = _env_int("SHORTENER_MY_URLS_COOKIE_MAX_LINKS", 50)
+
+# токен для /admin/...; пустой -- служебные эндпоинты открыты (как для локальной разработки),
+# кроме выгрузки, загрузки и копии базы и /admin/clicks: они без токена закрыты
+ADMIN_TOKEN = os.environ.get("SHORTENER_ADMIN_TOKEN", "")
+
+# аналитика кликов: как часто сворачивать сырые события в агрегаты, сколько событий за проход,
+# сколько дней хранить сырые события и поминутные агрегаты (часовые и дневные хранятся всегда)
+ROLLUP_INTERVAL = _env_float("SHORTENER_ROLLUP_INTERVAL", 30.0)
+ROLLUP_BATCH = _env_int("SHORTENER_ROLLUP_BATCH", 50000)
+EVENT_RETENTION_DAYS = _env_int("SHORTENER_EVENT_RETENTION_DAYS", 7)
+MINUTE_ROLLUP_RETENTION_DAYS = _env_int("SHORTENER_MINUTE_ROLLUP_RETENTION_DAYS", 2)
+
+# хранилище ссылок: при SHORTENER_STORAGE_SHARDS=1 все в одном файле SHORTENER_DB_PATH,
+# иначе ссылки раскладываются по файлам из шаблона (номер шарда вместо {shard}) по хэшу кода;
+# последовательности коротких кодов остаются в SHORTENER_DB_PATH
+STORAGE_SHARDS = _env_int("SHORTENER_STORAGE_SHARDS", 1)
+STORAGE_SHARD_PATH = os.environ.get("SHORTENER_STORAGE_SHARD_PATH", "shortener-{shard}.db")
+
+# несколько процессов (serve.py): число воркеров и номер текущего; при WORKERS > 1 включается
+# канал инвалидации кэша между процессами с периодом опроса в секундах.
+# Фоновые задачи (очистка просроченных, свертка кликов) по умолчанию идут только в воркере 0
+WORKERS = _env_int("SHORTENER_WORKERS", 1)
+WORKER_ID = _env_int("SHORTENER_WORKER_ID", 0)
+BACKGROUND_JOBS = _env_bool("SHORTENER_BACKGROUND_JOBS", WORKER_ID == 0)
+CACHE_INVALIDATION_INTERVAL = _env_float("SHORTENER_CACHE_INVALIDATION_INTERVAL", 0.5)
+
+# общая для всех процессов таблица горячих ссылок в файле (hotlinks.py); пустой путь -- выключена.
+# Вместимость в ссылках (слотов вдвое больше, по 20 байт) и размер области адресов в мегабайтах
+HOT_LINKS_PATH = os.environ.get("SHORTENER_HOT_LINKS_PATH", "")
+HOT_LINKS_CAPACITY = _env_int("SHORTENER_HOT_LINKS_CAPACITY", 1000000)
+HOT_LINKS_DATA_MB = _env_int("SHORTENER_HOT_LINKS_DATA_MB", 128)
+
+# фильтр существования коротких кодов (codefilter.py): 404 на несуществующий код без запроса к базе.
+# Файл по умолчанию рядом с базой; размер считается на max(CAPACITY, 2 * число ссылок) при заданной
+# доле ложных срабатываний; пересборка раз в REBUILD_INTERVAL секунд (0 -- только при старте)
+CODE_FILTER_ENABLED = _env_bool("SHORTENER_CODE_FILTER", True)
+CODE_FILTER_PATH = os.environ.get("SHORTENER_CODE_FILTER_PATH", DB_PATH + ".filter")
+CODE_FILTER_CAPACITY = _env_int("SHORTENER_CODE_FILTER_CAPACITY", 1000000)
+CODE_FILTER_FP_RATE = _env_float("SHORTENER_CODE_FILTER_FP_RATE", 0.01)
+CODE_FILTER_REBUILD_INTERVAL = _env_float("SHORTENER_CODE_FILTER_REBUILD_INTERVAL", 3600.0)
+
+# код ответа редиректа по умолчанию (у ссылки можно задать свой): 301/308 кэшируются браузерами
+# и CDN не дольше REDIRECT_MAX_AGE секунд и срока ссылки, 302/307 не кэшируются и считают каждый клик
+REDIRECT_STATUS = _env_int("SHORTENER_REDIRECT_STATUS", 307)
+REDIRECT_MAX_AGE = _env_int("SHORTENER_REDIRECT_MAX_AGE", 86400)
+
+# учетные записи (accounts.py): ключ подписи токенов (пустой -- случайный, хранится в файле
+# <SHORTENER_DB_PATH>.secret и общий для всех воркеров), срок жизни токена в минутах,
+# процессы для bcrypt (0 -- общий threadpool) и сколько проверок пароля может ждать их,
+# прежде чем вход ответит 503; кэш уже проверенных токенов (размер и время жизни записи в секундах)
+SECRET_KEY = os.environ.get("SHORTENER_SECRET_KEY", "")
+ACCESS_TOKEN_EXPIRE_MINUTES = _env_int("SHORTENER_ACCESS_TOKEN_EXPIRE_MINUTES", 30)
+PASSWORD_HASH_WORKERS = _env_int("SHORTENER_PASSWORD_HASH_WORKERS", 2)
+PASSWORD_HASH_MAX_PENDING = _env_int("SHORTENER_PASSWORD_HASH_MAX_PENDING", 32)
+TOKEN_CACHE_SIZE = _env_int("SHORTENER_TOKEN_CACHE_SIZE", 10000)
+TOKEN_CACHE_TTL = _env_float("SHORTENER_TOKEN_CACHE_TTL", 300.0)
+
+# ограничение запросов (ratelimit.py) на /shorten, /api/links/bulk и /r/...: по умолчанию выключено,
+# в каждом процессе отдельно. Ведра токенов на клиента (пользователь по токену или IP) для записи
+# (POST/PUT/DELETE) и для чтения -- запросов в секунду и запас на всплеск (скорость 0 -- без
+# ограничения), сколько клиентов помнить; IP из X-Forwarded-For -- только за своим прокси.
+# Сверх MAX_IN_FLIGHT одновременных запросов к этим маршрутам -- сразу 503
+RATE_LIMIT_ENABLED = _env_bool("SHORTENER_RATE_LIMIT", False)
+RATE_LIMIT_WRITE_RATE = _env_float("SHORTENER_RATE_LIMIT_WRITE_RATE", 5.0)
+RATE_LIMIT_WRITE_BURST = _env_float("SHORTENER_RATE_LIMIT_WRITE_BURST", 20.0)
+RATE_LIMIT_READ_RATE = _env_float("SHORTENER_RATE_LIMIT_READ_RATE", 100.0)
+RATE_LIMIT_READ_BURST = _env_float("SHORTENER_RATE_LIMIT_READ_BURST", 200.0)
+RATE_LIMIT_MAX_CLIENTS = _env_int("SHORTENER_RATE_LIMIT_MAX_CLIENTS", 100000)
+RATE_LIMIT_TRUST_FORWARDED = _env_bool("SHORTENER_RATE_LIMIT_TRUST_FORWARDED", False)
+MAX_IN_FLIGHT = _env_int("SHORTENER_MAX_IN_FLIGHT", 512)
+
+# выгрузка и загрузка ссылок (transfer.py): строк в одной пачке чтения и в одной транзакции загрузки;
+# онлайн-копия базы: каталог для копий /admin/backup, страниц за шаг backup API и пауза между шагами в секундах
+EXPORT_BATCH_SIZE = _env_int("SHORTENER_EXPORT_BATCH_SIZE", 5000)
+IMPORT_BATCH_SIZE = _env_int("SHORTENER_IMPORT_BATCH_SIZE", 20000)
+BACKUP_DIR = os.environ.get("SHORTENER_BACKUP_DIR", "backups")
+BACKUP_PAGES = _env_int("SHORTENER_BACKUP_PAGES", 1024)
+BACKUP_PAUSE = _env_float("SHORTENER_BACKUP_PAUSE", 0.0)
+
+# маршрутизация отчетных чтений (replica.py): off -- как раньше; wal -- соединения только для чтения
+# к тем же файлам; snapshot -- к копиям <файл>.snapshot, которые обновляются раз в READ_SNAPSHOT_INTERVAL
+# секунд (это и есть наибольшее отставание). Свои потоки, очередь и пул соединений на шард
+READ_ROUTING = os.environ.get("SHORTENER_READ_ROUTING", "off")
+READ_SNAPSHOT_INTERVAL = _env_float("SHORTENER_READ_SNAPSHOT_INTERVAL", 300.0)
+READ_POOL_SIZE = _env_int("SHORTENER_READ_POOL_SIZE", 4)
+READ_WORKERS = _env_int("SHORTENER_READ_WORKERS", 4)
+READ_QUEUE_SIZE = _env_int("SHORTENER_READ_QUEUE_SIZE", 256)
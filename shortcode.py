@@ -0,0 +1,131 @@
+import hashlib
+import threading
+
+import settings
+from database import get_connection, load_secret_file
+
+ALPHABET = "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
+BASE = len(ALPHABET)
+FEISTEL_ROUNDS = 4
+
+
+def base62_encode(number: int, length: int) -> str:
+    chars = []
+    for _ in range(length):
+        number, rest = divmod(number, BASE)
+        chars.append(ALPHABET[rest])
+    return "".join(reversed(chars))
+
+
+# номер -> (длина кода, номер внутри пространства кодов этой длины);
+# когда коды длины L заканчиваются, следующие номера получают длину L + 1
+def split_tier(number: int, min_length: int):
+    length = min_length
+    space = BASE ** length
+    while number >= space:
+        number -= space
+        length += 1
+        space = BASE ** length
+    return length, number
+
+
+# биективное перемешивание номера внутри [0, 62^length):
+# сеть Фейстеля на ближайшей четной степени двойки + cycle walking
+# secret None -- ключ из файла рядом с базой; читается при первом коде, а не при импорте
+class Scrambler:
+    def __init__(self, secret: str = None):
+        self.secret = secret
+        self._key = None
+
+    @property
+    def key(self) -> bytes:
+        if self._key is None:
+            secret = self.secret if self.secret is not None else load_secret_file(settings.DB_PATH + ".code-secret")
+            self._key = hashlib.blake2b(secret.encode(), digest_size=16).digest()
+        return self._key
+
+    def _round(self, value: int, round_no: int, length: int, mask: int) -> int:
+        digest = hashlib.blake2b(
+            value.to_bytes(8, "big"),
+            key=self.key,
+            salt=bytes([round_no, length]),
+            digest_size=8,
+        ).digest()
+        return int.from_bytes(digest, "big") & mask
+
+    def _feistel(self, value: int, half_bits: int, length: int) -> int:
+        mask = (1 << half_bits) - 1
+        left, right = value >> half_bits, value & mask
+        for round_no in range(FEISTEL_ROUNDS):
+            left, right = right, left ^ self._round(right, round_no, length, mask)
+        return (left << half_bits) | right
+
+    def permute(self, number: int, length: int) -> int:
+        space = BASE ** length
+        bits = (space - 1).bit_length()
+        half_bits = (bits + 1) // 2
+        value = self._feistel(number, half_bits, length)
+        while value >= space:
+            value = self._feistel(value, half_bits, length)
+        return value
+
+
+# резервируем в базе блок из count номеров и возвращаем первый из них
+def reserve_block(count: int, name: str = "short_code") -> int:
+    conn = get_connection()
+    try:
+        with conn:
+            conn.execute("INSERT OR IGNORE INTO sequences (name, next_value) VALUES (?, 0)", (name,))
+            conn.execute("UPDATE sequences SET next_value = next_value + ? WHERE name = ?", (count, name))
+            next_value = conn.execute("SELECT next_value FROM sequences WHERE name = ?", (name,)).fetchone()[0]
+    finally:
+        conn.close()
+    return next_value - count
+
+
+# выдает уникальные короткие коды без проверочных запросов к базе:
+# процесс забирает блок номеров из последовательности и кодирует их по одному
+class ShortCodeAllocator:
+    def __init__(self, block_size: int, min_length: int, scrambler: Scrambler = None, reserve=reserve_block):
+        self.block_size = block_size
+        self.min_length = min_length
+        self.scrambler = scrambler
+        self._reserve = reserve
+        self._lock = threading.Lock()
+        self._next = 0
+        self._end = 0
+        self.blocks = 0
+
+    def next_number(self) -> int:
+        with self._lock:
+            if self._next >= self._end:
+                self._next = self._reserve(self.block_size)
+                self._end = self._next + self.block_size
+                self.blocks += 1
+            number = self._next
+            self._next += 1
+            return number
+
+    def encode(self, number: int) -> str:
+        length, number = split_tier(number, self.min_length)
+        if self.scrambler is not None:
+            number = self.scrambler.permute(number, length)
+        return base62_encode(number, length)
+
+    def next_code(self) -> str:
+        return self.encode(self.next_number())
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "block_size": self.block_size,
+                "blocks_reserved": self.blocks,
+                "remaining_in_block": self._end - self._next,
+            }
+
+
+allocator = ShortCodeAllocator(
+    settings.SHORT_CODE_BLOCK_SIZE,
+    settings.SHORT_CODE_MIN_LENGTH,
+    Scrambler(settings.SHORT_CODE_SECRET or None) if settings.SHORT_CODE_SCRAMBLE else None,
+)
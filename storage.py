@@ -0,0 +1,718 @@
+import heapq
+import itertools
+import sqlite3
+import time
+import zlib
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+
+import database
+import settings
+from database import ConnectionPool, init_db, url_hash
+from shortcode import allocator
+
+# сколько значений подставлять в один IN (...), чтобы не упереться в лимит переменных SQLite
+BULK_QUERY_CHUNK = 500
+
+
+def chunked(values: list, size: int):
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+# условие поиска подстроки по всем ссылкам шарда: через триграммный FTS-индекс, а для запросов
+# короче трех символов (и без FTS5) -- через LIKE
+def search_condition(search_query: str):
+    if database.FTS_ENABLED and len(search_query) >= 3:
+        phrase = '"' + search_query.replace('"', '""') + '"'
+        return "id IN (SELECT rowid FROM links_fts WHERE links_fts MATCH ?)", (phrase,)
+    return filter_condition(search_query)
+
+
+# подстрока среди уже отобранных строк (ссылки из cookie, списка, владельца): подзапрос к FTS
+# собрал бы все совпадения таблицы ради нескольких кандидатов, поэтому проверяем их самих.
+# % и _ в запросе -- обычные символы, как во фразе FTS
+def filter_condition(search_query: str):
+    escaped = search_query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    pattern = f"%{escaped}%"
+    return "(original_url LIKE ? ESCAPE '\\' OR short_code LIKE ? ESCAPE '\\')", (pattern, pattern)
+
+
+# то, что main.py и фоновые задачи ждут от хранилища ссылок. Все методы синхронные
+# и вызываются из потоков db_async; курсоры постраничности -- кортежи, которые
+# хранилище само вернуло в строках (последние элементы строки). Хранилище без какого-то
+# из методов не создастся вовсе (TypeError), а не упадет при первом вызове
+class Storage(ABC):
+    # (short_code, None) или (None, текст ошибки); дубль URL среди ссылок того же владельца
+    # (или среди анонимных) возвращает существующий код
+    @abstractmethod
+    def create_link(
+            self, url: str, alias, expires_at: str, expires_ts: int, redirect_status: int = None, owner_id: int = None
+    ):
+        ...
+
+    # items: [{"url", "alias", "expires_at", "expires_ts", "digest", "redirect_status"}] -> [(short_code, status, error)]
+    @abstractmethod
+    def create_links(self, items: list, owner_id: int = None) -> list:
+        ...
+
+    @abstractmethod
+    def delete_link(self, short_code: str) -> bool:
+        ...
+
+    @abstractmethod
+    def update_url(self, short_code: str, new_url: str) -> bool:
+        ...
+
+    # код ответа редиректа для ссылки; None -- по умолчанию из настроек
+    @abstractmethod
+    def set_redirect_status(self, short_code: str, redirect_status) -> bool:
+        ...
+
+    # (original_url, created_at, clicks, last_used_at) или None
+    @abstractmethod
+    def get_link(self, short_code: str):
+        ...
+
+    # (original_url, expires_ts, redirect_status) или None
+    @abstractmethod
+    def get_redirect(self, short_code: str):
+        ...
+
+    # (owner_id,) или None, если ссылки нет; owner_id None -- анонимная ссылка
+    @abstractmethod
+    def link_owner(self, short_code: str):
+        ...
+
+    # ссылки из cookie my_urls: link_ids -- {шард: [id]}, list_id -- вытесненный из cookie список
+    # на сервере (или None); [(short_code, original_url, created_at, created_ts, id, shard)], новые первыми
+    @abstractmethod
+    def list_links(self, link_ids: dict, list_id, search_query: str, after=None, limit: int = None) -> list:
+        ...
+
+    # {шард: [id]} ссылок с такими кодами; несуществующие коды пропускаются
+    @abstractmethod
+    def link_ids(self, short_codes) -> dict:
+        ...
+
+    # добавить ссылки {шард: [id]} в серверный список list_id
+    @abstractmethod
+    def save_link_list(self, list_id: int, link_ids: dict):
+        ...
+
+    # ссылки пользователя, строки и курсор как в list_links
+    @abstractmethod
+    def list_owner_links(self, owner_id: int, search_query: str, after=None, limit: int = None) -> list:
+        ...
+
+    # [(id, short_code, original_url, created_at, clicks, expires_at, shard)]
+    @abstractmethod
+    def search(self, search_query: str, before=None, limit: int = 50) -> list:
+        ...
+
+    # счетчик удалений и изменений адреса/срока ссылок (триггеры links_version_*)
+    @abstractmethod
+    def links_version(self) -> int:
+        ...
+
+    # (short_code, original_url, expires_ts, redirect_status) самых посещаемых неистекших ссылок,
+    # не больше limit
+    @abstractmethod
+    def top_links(self, limit: int, now: int):
+        ...
+
+    # сумма счетчиков AUTOINCREMENT таблицы links: растет при любой вставке, в том числе в обход сервиса
+    @abstractmethod
+    def links_high_water(self) -> int:
+        ...
+
+    @abstractmethod
+    def count_links(self) -> int:
+        ...
+
+    # все короткие коды (для фильтра существования, codefilter.py)
+    @abstractmethod
+    def iter_codes(self):
+        ...
+
+    # создать или обновить схему хранилища (database.init_db); при старте, а не при импорте
+    @abstractmethod
+    def init_schema(self) -> int:
+        ...
+
+    @abstractmethod
+    def close(self):
+        ...
+
+    @abstractmethod
+    def stats(self) -> dict:
+        ...
+
+
+# один файл SQLite со своим пулом соединений (и своей блокировкой записи):
+# здесь все SQL-запросы к таблице links
+class SQLiteShard:
+    def __init__(self, index: int, connection_pool: ConnectionPool):
+        self.index = index
+        self.pool = connection_pool
+        # соединения только для чтения для отчетов и поиска (replica.py); None -- читаем из pool
+        self.replica = None
+
+    def connect(self):
+        return self.pool.acquire()
+
+    # соединение для отчетных запросов: из реплики, если она включена и готова, иначе основное
+    def connect_read(self):
+        if self.replica is not None:
+            conn = self.replica.acquire()
+            if conn is not None:
+                return conn
+        return self.pool.acquire()
+
+    # original_url -> short_code для ссылок владельца (None -- анонимных) с такими отпечатками URL
+    def find_by_hashes(self, digests: list, owner_id: int = None) -> dict:
+        found = {}
+        conn = self.connect()
+        try:
+            for chunk in chunked(digests, BULK_QUERY_CHUNK):
+                placeholders = ",".join("?" for _ in chunk)
+                for original_url, short_code in conn.execute(
+                    f"SELECT original_url, short_code FROM links WHERE url_hash IN ({placeholders}) AND owner_id IS ?",
+                    chunk + [owner_id]
+                ):
+                    found.setdefault(original_url, short_code)
+        finally:
+            conn.close()
+        return found
+
+    def find_codes(self, short_codes: list) -> set:
+        taken = set()
+        conn = self.connect()
+        try:
+            for chunk in chunked(short_codes, BULK_QUERY_CHUNK):
+                placeholders = ",".join("?" for _ in chunk)
+                taken.update(row[0] for row in conn.execute(
+                    f"SELECT short_code FROM links WHERE short_code IN ({placeholders})", chunk
+                ))
+        finally:
+            conn.close()
+        return taken
+
+    # False -- код уже занят
+    def insert_link(
+            self, url: str, short_code: str, expires_at: str, expires_ts: int, digest: int, redirect_status: int = None,
+            owner_id: int = None
+    ) -> bool:
+        conn = self.connect()
+        try:
+            with conn:
+                conn.execute(
+                    "INSERT INTO links (original_url, short_code, expires_at, expires_ts, url_hash, created_ts, "
+                    "redirect_status, owner_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (url, short_code, expires_at, expires_ts, digest, int(time.time()), redirect_status, owner_id)
+                )
+            return True
+        except sqlite3.IntegrityError:
+            return False
+        finally:
+            conn.close()
+
+    # вставка пачки одной транзакцией; rows: [(url, short_code, expires_at, expires_ts, digest, redirect_status,
+    # owner_id)], возвращает список флагов "вставлено" в том же порядке
+    def insert_links(self, rows: list) -> list:
+        inserted = []
+        created_ts = int(time.time())
+        conn = self.connect()
+        try:
+            with conn:
+                for url, short_code, expires_at, expires_ts, digest, redirect_status, owner_id in rows:
+                    try:
+                        conn.execute(
+                            "INSERT INTO links (original_url, short_code, expires_at, expires_ts, url_hash, created_ts, "
+                            "redirect_status, owner_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                            (url, short_code, expires_at, expires_ts, digest, created_ts, redirect_status, owner_id)
+                        )
+                        inserted.append(True)
+                    except sqlite3.IntegrityError:
+                        inserted.append(False)
+        finally:
+            conn.close()
+        return inserted
+
+    def delete_link(self, short_code: str) -> bool:
+        conn = self.connect()
+        try:
+            with conn:
+                return conn.execute("DELETE FROM links WHERE short_code = ?", (short_code,)).rowcount > 0
+        finally:
+            conn.close()
+
+    def update_url(self, short_code: str, new_url: str) -> bool:
+        conn = self.connect()
+        try:
+            with conn:
+                return conn.execute(
+                    "UPDATE links SET original_url = ?, url_hash = ? WHERE short_code = ?",
+                    (new_url, url_hash(new_url), short_code)
+                ).rowcount > 0
+        finally:
+            conn.close()
+
+    def set_redirect_status(self, short_code: str, redirect_status) -> bool:
+        conn = self.connect()
+        try:
+            with conn:
+                return conn.execute(
+                    "UPDATE links SET redirect_status = ? WHERE short_code = ?", (redirect_status, short_code)
+                ).rowcount > 0
+        finally:
+            conn.close()
+
+    def get_link(self, short_code: str):
+        conn = self.connect()
+        try:
+            return conn.execute(
+                "SELECT original_url, created_at, clicks, last_used_at FROM links WHERE short_code = ?",
+                (short_code,)
+            ).fetchone()
+        finally:
+            conn.close()
+
+    def get_redirect(self, short_code: str):
+        conn = self.connect()
+        try:
+            return conn.execute(
+                "SELECT original_url, expires_ts, redirect_status FROM links WHERE short_code = ?",
+                (short_code,)
+            ).fetchone()
+        finally:
+            conn.close()
+
+    def link_owner(self, short_code: str):
+        conn = self.connect()
+        try:
+            return conn.execute("SELECT owner_id FROM links WHERE short_code = ?", (short_code,)).fetchone()
+        finally:
+            conn.close()
+
+    # ссылки из cookie: id -- по первичному ключу, и ссылки серверного списка list_id.
+    # id в cookie не больше MY_URLS_COOKIE_MAX_LINKS, так что в лимит переменных SQLite они влезают
+    def list_links(self, link_ids: list, list_id, search_query: str, after=None, limit: int = None) -> list:
+        conditions, params = [], []
+        if link_ids:
+            conditions.append(f"id IN ({','.join('?' for _ in link_ids)})")
+            params.extend(link_ids)
+        if list_id:
+            conditions.append("id IN (SELECT link_id FROM link_lists WHERE list_id = ?)")
+            params.append(list_id)
+        conn = self.connect_read()
+        try:
+            return self.list_page(conn, f"({' OR '.join(conditions)})", params, search_query, after, limit)
+        finally:
+            conn.close()
+
+    def find_ids(self, short_codes: list) -> list:
+        ids = []
+        conn = self.connect()
+        try:
+            for chunk in chunked(short_codes, BULK_QUERY_CHUNK):
+                placeholders = ",".join("?" for _ in chunk)
+                ids.extend(row[0] for row in conn.execute(
+                    f"SELECT id FROM links WHERE short_code IN ({placeholders})", chunk
+                ))
+        finally:
+            conn.close()
+        return ids
+
+    def add_to_list(self, list_id: int, link_ids: list):
+        conn = self.connect()
+        try:
+            with conn:
+                conn.executemany(
+                    "INSERT OR IGNORE INTO link_lists (list_id, link_id) VALUES (?, ?)",
+                    ((list_id, link_id) for link_id in link_ids)
+                )
+        finally:
+            conn.close()
+
+    # ссылки пользователя: owner_id = ? с сортировкой идут одним проходом по idx_links_owner
+    def list_owner_links(self, owner_id: int, search_query: str, after=None, limit: int = None) -> list:
+        conn = self.connect_read()
+        try:
+            return self.list_page(conn, "owner_id = ?", [owner_id], search_query, after, limit)
+        finally:
+            conn.close()
+
+    # страница списка по условию condition. Сортировка и постраничность по индексу
+    # (created_ts, id); общий порядок между шардами -- (created_ts, шард, id), поэтому курсор
+    # (created_ts, id, шард) в каждом шарде превращается в свое условие по индексу
+    def list_page(self, conn, condition: str, params: list, search_query: str, after, limit) -> list:
+        where = [condition]
+        if search_query:
+            search, search_params = filter_condition(search_query)
+            where.append(search)
+            params.extend(search_params)
+        if after:
+            created_ts, link_id, shard = after
+            if self.index < shard:
+                where.append("created_ts <= ?")
+                params.append(created_ts)
+            elif self.index > shard:
+                where.append("created_ts < ?")
+                params.append(created_ts)
+            else:
+                where.append("(created_ts < ? OR (created_ts = ? AND id < ?))")
+                params.extend((created_ts, created_ts, link_id))
+        params.append(limit if limit is not None else -1)
+        return conn.execute(f"""
+            SELECT short_code, original_url, created_at, created_ts, id, {self.index}
+            FROM links
+            WHERE {" AND ".join(where)}
+            ORDER BY created_ts DESC, id DESC
+            LIMIT ?
+        """, params).fetchall()
+
+    # поиск по всем ссылкам шарда; общий порядок -- (id, шард) по убыванию
+    def search(self, search_query: str, before=None, limit: int = 50) -> list:
+        conn = self.connect_read()
+        try:
+            condition, params = search_condition(search_query)
+            params = list(params)
+            where = [condition]
+            if before is not None:
+                link_id, shard = before
+                where.append("id <= ?" if self.index < shard else "id < ?")
+                params.append(link_id)
+            params.append(limit)
+            return conn.execute(f"""
+                SELECT id, short_code, original_url, created_at, clicks, expires_at, {self.index}
+                FROM links
+                WHERE {" AND ".join(where)}
+                ORDER BY id DESC
+                LIMIT ?
+            """, params).fetchall()
+        finally:
+            conn.close()
+
+    # счетчики кликов и сырые события -- одной транзакцией в этом шарде
+    def record_clicks(self, rows: list, events: list):
+        conn = self.connect()
+        try:
+            with conn:
+                conn.executemany(
+                    "UPDATE links SET clicks = clicks + ?, last_used_at = ? WHERE short_code = ?",
+                    rows
+                )
+                conn.executemany(
+                    "INSERT INTO click_events (ts, short_code, referrer_host, agent, clicks) VALUES (?, ?, ?, ?, ?)",
+                    events
+                )
+        finally:
+            conn.close()
+
+    # одна короткая транзакция удаления просроченных; возвращает удаленные коды
+    def delete_expired(self, now: int, limit: int) -> list:
+        conn = self.connect()
+        try:
+            with conn:
+                rows = conn.execute(
+                    "SELECT id, short_code FROM links WHERE expires_ts <= ? LIMIT ?",
+                    (now, limit)
+                ).fetchall()
+                if rows:
+                    placeholders = ",".join("?" for _ in rows)
+                    conn.execute(f"DELETE FROM links WHERE id IN ({placeholders})", [row[0] for row in rows])
+        finally:
+            conn.close()
+        return [short_code for _, short_code in rows]
+
+    def links_version(self) -> int:
+        conn = self.connect()
+        try:
+            row = conn.execute("SELECT next_value FROM sequences WHERE name = 'links_version'").fetchone()
+        finally:
+            conn.close()
+        return row[0] if row else 0
+
+    def links_high_water(self) -> int:
+        conn = self.connect()
+        try:
+            row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'links'").fetchone()
+        finally:
+            conn.close()
+        return row[0] if row else 0
+
+    def count_links(self) -> int:
+        conn = self.connect()
+        try:
+            return conn.execute("SELECT COUNT(*) FROM links").fetchone()[0]
+        finally:
+            conn.close()
+
+    def iter_codes(self):
+        conn = self.connect()
+        try:
+            for (short_code,) in conn.execute("SELECT short_code FROM links"):
+                yield short_code
+        finally:
+            conn.close()
+
+    # генератор (clicks, short_code, original_url, expires_ts, redirect_status) по убыванию кликов;
+    # соединение держится, пока его не дочитали
+    def top_links(self, limit: int, now: int):
+        conn = self.connect()
+        try:
+            yield from conn.execute(
+                "SELECT clicks, short_code, original_url, expires_ts, redirect_status FROM links "
+                "WHERE expires_ts IS NULL OR expires_ts > ? ORDER BY clicks DESC LIMIT ?",
+                (now, limit)
+            )
+        finally:
+            conn.close()
+
+
+# ссылки разложены по N файлам SQLite по crc32(short_code) % N: у каждого шарда свой
+# писатель, редирект и изменение ссылки идут ровно в один шард, а запросы по многим
+# ссылкам (списки, поиск, проверка дублей URL) расходятся по шардам параллельно.
+# С одним шардом это обычная работа с одним файлом
+class ShardedSQLiteStorage(Storage):
+    def __init__(self, shards: list, generate_code=allocator.next_code):
+        self.shards = shards
+        self.generate_code = generate_code
+        # фильтр существования кодов (codefilter.py), подключается при старте приложения
+        self.code_filter = None
+        self._executor = ThreadPoolExecutor(max_workers=len(shards), thread_name_prefix="shard") if len(shards) > 1 else None
+
+    def shard_index(self, short_code: str) -> int:
+        if len(self.shards) == 1:
+            return 0
+        return zlib.crc32(short_code.encode()) % len(self.shards)
+
+    def shard_for(self, short_code: str) -> SQLiteShard:
+        return self.shards[self.shard_index(short_code)]
+
+    # fn(shard, *args) для каждого шарда, параллельно; результаты в порядке шардов
+    def fan_out(self, fn, *args) -> list:
+        if self._executor is None:
+            return [fn(shard, *args) for shard in self.shards]
+        return list(self._executor.map(lambda shard: fn(shard, *args), self.shards))
+
+    # {индекс шарда: [коды]} -- чтобы каждый шард спрашивать только о своих кодах
+    def group_codes(self, short_codes) -> dict:
+        groups = {}
+        for short_code in short_codes:
+            groups.setdefault(self.shard_index(short_code), []).append(short_code)
+        return groups
+
+    def find_existing(self, digests: list, owner_id: int = None) -> dict:
+        existing = {}
+        for found in self.fan_out(SQLiteShard.find_by_hashes, digests, owner_id):
+            for original_url, short_code in found.items():
+                existing.setdefault(original_url, short_code)
+        return existing
+
+    # занятые коды из short_codes; те, которых точно нет по фильтру, в базе не ищем
+    def taken_codes(self, short_codes) -> set:
+        candidates = [code for code in short_codes if self.code_filter is None or self.code_filter.might_contain(code)]
+        taken = set()
+        for index, codes in self.group_codes(candidates).items():
+            taken.update(self.shards[index].find_codes(codes))
+        if self.code_filter is not None:
+            self.code_filter.record_false_positive(len(candidates) - len(taken))
+        return taken
+
+    def create_link(
+            self, url: str, alias, expires_at: str, expires_ts: int, redirect_status: int = None, owner_id: int = None
+    ):
+        if alias and self.taken_codes([alias]):
+            return None, f"Alias '{alias}' уже занят"
+
+        # поиск существующей записи
+        digest = url_hash(url)
+        existing = self.find_existing([digest], owner_id).get(url)
+        if existing:
+            return existing, None
+
+        while True:
+            short_code = alias or self.generate_code()
+            if self.shard_for(short_code).insert_link(
+                    url, short_code, expires_at, expires_ts, digest, redirect_status, owner_id
+            ):
+                return short_code, None
+            if alias:
+                return None, f"Alias '{alias}' уже занят"
+            # сгенерированный код совпал с чьим-то алиасом -- берем следующий номер
+
+    # пакет: дубли URL и занятые алиасы ищем запросами по множеству, вставки группируем
+    # по шардам -- одна транзакция на шард
+    def create_links(self, items: list, owner_id: int = None) -> list:
+        existing = self.find_existing(list({item["digest"] for item in items}), owner_id)
+
+        taken = self.taken_codes({item["alias"] for item in items if item["alias"]})
+
+        results = [None] * len(items)
+        planned = {}  # индекс шарда -> [(позиция, строка для вставки)]
+        first_seen = {}  # URL -> позиция, где он создается в этом пакете
+        repeats = []
+        deferred = []
+        for position, item in enumerate(items):
+            url, alias = item["url"], item["alias"]
+            if alias and alias in taken:
+                results[position] = (None, "error", f"Alias '{alias}' уже занят")
+                continue
+            if url in existing:
+                results[position] = (existing[url], "existing", None)
+                continue
+            if url in first_seen:
+                repeats.append((position, first_seen[url]))
+                continue
+            first_seen[url] = position
+            short_code = alias or self.generate_code()
+            if alias:
+                taken.add(alias)
+            row = (
+                url, short_code, item["expires_at"], item["expires_ts"], item["digest"], item.get("redirect_status"),
+                owner_id
+            )
+            planned.setdefault(self.shard_index(short_code), []).append((position, row))
+
+        def insert(shard):
+            batch = planned.get(shard.index)
+            return shard.insert_links([row for _, row in batch]) if batch else []
+
+        for shard, inserted in zip(self.shards, self.fan_out(insert)):
+            for (position, row), ok in zip(planned.get(shard.index, ()), inserted):
+                if ok:
+                    results[position] = (row[1], "created", None)
+                elif items[position]["alias"]:
+                    results[position] = (None, "error", f"Alias '{row[1]}' уже занят")
+                else:
+                    # сгенерированный код совпал с чьим-то алиасом -- сохраним отдельно
+                    deferred.append(position)
+
+        for position in deferred:
+            item = items[position]
+            short_code, error = self.create_link(
+                item["url"], None, item["expires_at"], item["expires_ts"], item.get("redirect_status"), owner_id
+            )
+            results[position] = (short_code, "error", error) if error else (short_code, "created", None)
+        # повтор URL внутри пакета получает код, созданный для первого вхождения
+        for position, first in repeats:
+            short_code, status, error = results[first]
+            results[position] = (short_code, "existing", None) if short_code else results[first]
+        return results
+
+    def delete_link(self, short_code: str) -> bool:
+        return self.shard_for(short_code).delete_link(short_code)
+
+    def update_url(self, short_code: str, new_url: str) -> bool:
+        return self.shard_for(short_code).update_url(short_code, new_url)
+
+    def set_redirect_status(self, short_code: str, redirect_status) -> bool:
+        return self.shard_for(short_code).set_redirect_status(short_code, redirect_status)
+
+    def get_link(self, short_code: str):
+        return self.shard_for(short_code).get_link(short_code)
+
+    def get_redirect(self, short_code: str):
+        return self.shard_for(short_code).get_redirect(short_code)
+
+    def link_owner(self, short_code: str):
+        return self.shard_for(short_code).link_owner(short_code)
+
+    # серверный список может быть в любом шарде, поэтому с list_id спрашиваем все
+    def list_links(self, link_ids: dict, list_id, search_query: str, after=None, limit: int = None) -> list:
+        def query(shard):
+            ids = link_ids.get(shard.index)
+            return shard.list_links(ids, list_id, search_query, after, limit) if ids or list_id else []
+
+        return self.merge_pages(self.fan_out(query), limit)
+
+    def link_ids(self, short_codes) -> dict:
+        found = {}
+        for index, codes in self.group_codes(set(short_codes)).items():
+            ids = self.shards[index].find_ids(codes)
+            if ids:
+                found[index] = ids
+        return found
+
+    def save_link_list(self, list_id: int, link_ids: dict):
+        for index, ids in link_ids.items():
+            if index < len(self.shards):
+                self.shards[index].add_to_list(list_id, ids)
+
+    def list_owner_links(self, owner_id: int, search_query: str, after=None, limit: int = None) -> list:
+        return self.merge_pages(self.fan_out(SQLiteShard.list_owner_links, owner_id, search_query, after, limit), limit)
+
+    # страницы шардов в общем порядке (created_ts, шард, id)
+    def merge_pages(self, parts: list, limit: int = None) -> list:
+        rows = [row for part in parts for row in part]
+        if len(self.shards) > 1:
+            rows.sort(key=lambda row: (row[3], row[5], row[4]), reverse=True)
+        return rows[:limit] if limit is not None else rows
+
+    def search(self, search_query: str, before=None, limit: int = 50) -> list:
+        rows = [row for part in self.fan_out(SQLiteShard.search, search_query, before, limit) for row in part]
+        if len(self.shards) > 1:
+            rows.sort(key=lambda row: (row[0], row[6]), reverse=True)
+        return rows[:limit]
+
+    # счетчики шардов только растут, поэтому сумма совпадает, только если совпал каждый
+    def links_version(self) -> int:
+        return sum(shard.links_version() for shard in self.shards)
+
+    def top_links(self, limit: int, now: int):
+        parts = [shard.top_links(limit, now) for shard in self.shards]
+        try:
+            merged = heapq.merge(*parts, key=lambda row: -(row[0] or 0))
+            for row in itertools.islice(merged, limit):
+                yield row[1:]
+        finally:
+            # возвращаем соединения недочитанных шардов в пулы
+            for part in parts:
+                part.close()
+
+    def links_high_water(self) -> int:
+        return sum(shard.links_high_water() for shard in self.shards)
+
+    def count_links(self) -> int:
+        return sum(self.fan_out(SQLiteShard.count_links))
+
+    def iter_codes(self):
+        for shard in self.shards:
+            yield from shard.iter_codes()
+
+    # основная база (последовательности, пользователи) тоже нужна, даже если ссылки в шардах
+    def init_schema(self) -> int:
+        pools = [database.pool] + [shard.pool for shard in self.shards if shard.pool is not database.pool]
+        return sum(init_db(connection_pool) for connection_pool in pools)
+
+    def close(self):
+        for shard in self.shards:
+            shard.pool.close_all()
+
+    def stats(self) -> dict:
+        return {
+            "backend": "sqlite",
+            "shards": len(self.shards),
+            "pools": [shard.pool.stats() for shard in self.shards],
+        }
+
+
+def shard_paths(count: int, pattern: str) -> list:
+    return [pattern.format(shard=index) for index in range(count)]
+
+
+# хранилище по настройкам: один шард -- основной пул database.pool, иначе свои файлы и пулы
+def create_storage(count: int = None, pattern: str = None) -> ShardedSQLiteStorage:
+    count = count or settings.STORAGE_SHARDS
+    if count <= 1:
+        return ShardedSQLiteStorage([SQLiteShard(0, database.pool)])
+    shards = []
+    for index, path in enumerate(shard_paths(count, pattern or settings.STORAGE_SHARD_PATH)):
+        connection_pool = ConnectionPool(path, settings.DB_POOL_SIZE, settings.DB_POOL_TIMEOUT)
+        shards.append(SQLiteShard(index, connection_pool))
+    return ShardedSQLiteStorage(shards)
+
+
+storage = create_storage()
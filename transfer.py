@@ -0,0 +1,471 @@
+# выгрузка и загрузка ссылок (NDJSON или CSV) и онлайн-копия файлов базы, без остановки сервиса:
+#
+#   python transfer.py export --format csv > links.csv
+#   python transfer.py import links.ndjson --short-code-sequence 123000
+#   python transfer.py backup /var/backups/shortener
+#
+# То же через /admin/links/export, /admin/links/import и /admin/backup (main.py).
+# Выгрузка идет пачками по id (keyset): память не зависит от размера таблицы, а соединение
+# берется из пула на одну пачку, так что долгая выгрузка не держит снимок базы и не мешает
+# checkpoint. Это не снимок на момент начала: ссылки, созданные по ходу, могут попасть в файл,
+# удаленные -- пропасть, но каждая встречается не больше одного раза. Снимок дает backup
+# (SHORTENER_DB_PATH=копия python transfer.py export).
+# Загрузка -- пачками по транзакции на шард; код, который уже есть в базе, пропускается.
+# Учетные записи не переносятся, поэтому владельцы ссылок сбрасываются (кроме --keep-owners).
+# В пустой шард вторичные индексы и полнотекстовый индекс строятся один раз в конце, а не
+# на каждой вставке. Номер последовательности коротких кодов выгрузка сообщает отдельно
+# (short_code_sequence): без него новые коды на чистой установке с тем же ключом
+# (SHORTENER_SHORT_CODE_SECRET или файл <база>.code-secret) пошли бы по уже занятым
+import argparse
+import csv
+import io
+import json
+import os
+import sqlite3
+import sys
+import time
+from datetime import datetime
+
+import database
+import settings
+from database import DEFAULT_EXPIRATION_FORMAT, url_hash
+
+FORMATS = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+# id и url_hash не выгружаем: в другой базе id свои, а отпечаток считается заново
+EXPORT_COLUMNS = (
+    "short_code", "original_url", "created_at", "created_ts", "clicks", "last_used_at", "expires_at", "expires_ts",
+    "redirect_status", "owner_id",
+)
+# как REDIRECT_STATUSES в main.py; None -- код по умолчанию из настроек
+REDIRECT_STATUSES = (None, 301, 302, 307, 308)
+INSERT_SQL = (
+    "INSERT OR IGNORE INTO links (short_code, original_url, created_at, created_ts, clicks, last_used_at, "
+    "expires_at, expires_ts, redirect_status, owner_id, url_hash) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+)
+# отметка в sequences шарда: индексы сняты загрузкой и еще не построены (процесс прервали) --
+# следующая загрузка в этот шард построит их в первую очередь
+DEFERRED_MARKER = "import_deferred_indexes"
+# сколько ошибочных строк перечислять в отчете (считаются все)
+MAX_REPORTED_ERRORS = 20
+# сколько раз копия может начаться заново из-за записи в исходную базу, прежде чем
+# копируем остаток одним шагом
+BACKUP_MAX_RESTARTS = 3
+
+
+# пачка строк шарда после after_id: [(id, *EXPORT_COLUMNS)]
+def read_batch(shard, after_id: int, limit: int) -> list:
+    conn = shard.connect()
+    try:
+        return conn.execute(
+            f"SELECT id, {', '.join(EXPORT_COLUMNS)} FROM links WHERE id > ? ORDER BY id LIMIT ?",
+            (after_id, limit)
+        ).fetchall()
+    finally:
+        conn.close()
+
+
+def header(fmt: str) -> str:
+    return ",".join(EXPORT_COLUMNS) + "\r\n" if fmt == "csv" else ""
+
+
+def encode_rows(rows: list, fmt: str) -> str:
+    if fmt == "csv":
+        output = io.StringIO()
+        csv.writer(output).writerows(row[1:] for row in rows)
+        return output.getvalue()
+    return "".join(json.dumps(dict(zip(EXPORT_COLUMNS, row[1:])), ensure_ascii=False) + "\n" for row in rows)
+
+
+# все ссылки всех шардов кусками текста (по куску на пачку); для командной строки,
+# main.py читает пачки сам через очередь к базе
+def export_chunks(storage, fmt: str, batch_size: int):
+    yield header(fmt)
+    for shard in storage.shards:
+        after_id = 0
+        while True:
+            rows = read_batch(shard, after_id, batch_size)
+            if not rows:
+                break
+            after_id = rows[-1][0]
+            yield encode_rows(rows, fmt)
+
+
+def short_code_sequence() -> int:
+    conn = database.get_connection()
+    try:
+        row = conn.execute("SELECT next_value FROM sequences WHERE name = 'short_code'").fetchone()
+    finally:
+        conn.close()
+    return row[0] if row else 0
+
+
+# последовательность не ниже value: номера, уже выданные источником, здесь не выдаем.
+# Блоки, которые воркеры зарезервировали раньше, дорабатываются -- совпадения с загруженными
+# кодами там редки, и create_link просто берет следующий номер
+def advance_short_code_sequence(value: int):
+    conn = database.get_connection()
+    try:
+        with conn:
+            conn.execute("INSERT OR IGNORE INTO sequences (name, next_value) VALUES ('short_code', 0)")
+            conn.execute(
+                "UPDATE sequences SET next_value = MAX(next_value, ?) WHERE name = 'short_code'", (value,)
+            )
+    finally:
+        conn.close()
+
+
+def to_int(value):
+    if value is None or value == "":
+        return None
+    return value if type(value) is int else int(value)
+
+
+# строка выгрузки (dict) -> параметры INSERT_SQL; ValueError -- строку пропускаем.
+# owner_id -- id учетной записи исходной установки: таблица users не переносится, и на другой
+# установке тот же id может принадлежать другому человеку, поэтому без keep_owners ссылка
+# становится анонимной
+def prepare_row(record, keep_owners: bool = False) -> tuple:
+    if not isinstance(record, dict):
+        raise ValueError("строка должна быть объектом")
+    short_code, original_url = record.get("short_code"), record.get("original_url")
+    if not isinstance(short_code, str) or not short_code or not isinstance(original_url, str) or not original_url:
+        raise ValueError("нужны short_code и original_url")
+    get = record.get
+    # в CSV пустое поле -- пустая строка
+    created_at, last_used_at = get("created_at") or None, get("last_used_at") or None
+    expires_at = get("expires_at") or None
+    created_ts, clicks, expires_ts = to_int(get("created_ts")), to_int(get("clicks")), to_int(get("expires_ts"))
+    redirect_status = to_int(get("redirect_status"))
+    owner_id = to_int(get("owner_id")) if keep_owners else None
+    if created_ts is None:
+        created_ts = int(time.time())
+    if created_at is None:
+        created_at = datetime.fromtimestamp(created_ts).strftime(DEFAULT_EXPIRATION_FORMAT)
+    if expires_ts is None and expires_at:
+        expires_ts = int(datetime.strptime(expires_at, DEFAULT_EXPIRATION_FORMAT).timestamp())
+    if redirect_status not in REDIRECT_STATUSES:
+        raise ValueError(f"redirect_status {redirect_status} не поддерживается")
+    # байты не в UTF-8 приходят суррогатами (errors="surrogateescape"), SQLite их не примет
+    for value in (short_code, original_url, created_at, last_used_at, expires_at):
+        if isinstance(value, str) and not value.isascii():
+            try:
+                value.encode()
+            except UnicodeEncodeError:
+                raise ValueError("текст не в UTF-8") from None
+    return (
+        short_code, original_url, created_at, created_ts, clicks or 0, last_used_at, expires_at, expires_ts,
+        redirect_status, owner_id, url_hash(original_url),
+    )
+
+
+# вторичные индексы links и вставка в полнотекстовый индекс: в пустом шарде дешевле построить
+# их один раз после загрузки, чем обновлять на каждой строке. Уникальный индекс short_code
+# остается -- по нему пропускаются уже существующие коды
+def drop_indexes(conn):
+    with conn:
+        for name, _ in database.LINK_INDEXES:
+            conn.execute(f"DROP INDEX IF EXISTS {name}")
+        conn.execute("DROP TRIGGER IF EXISTS links_fts_insert")
+        conn.execute("INSERT OR REPLACE INTO sequences (name, next_value) VALUES (?, 1)", (DEFERRED_MARKER,))
+
+
+def build_indexes(conn):
+    with conn:
+        for _, sql in database.LINK_INDEXES:
+            conn.execute(sql)
+        if database.FTS_ENABLED:
+            database.migrate_search_index(conn)
+            conn.execute("INSERT INTO links_fts (links_fts) VALUES ('rebuild')")
+        conn.execute("DELETE FROM sequences WHERE name = ?", (DEFERRED_MARKER,))
+    conn.execute("PRAGMA optimize")
+
+
+# загрузка потока строк: feed() принимает очередные строки файла, строки копятся по шардам
+# и уходят одной транзакцией на batch_size строк. Синхронный, для потока базы (db_async)
+# или командной строки; после загрузки нужно вызвать finish()
+class LinkImporter:
+    def __init__(self, storage, fmt: str, batch_size: int, code_filter=None, keep_owners: bool = False):
+        self.storage = storage
+        self.fmt = fmt
+        self.batch_size = batch_size
+        self.code_filter = code_filter
+        self.keep_owners = keep_owners
+        self._pending = {}  # индекс шарда -> [строки для INSERT_SQL]
+        self._prepared = set()  # шарды, где уже решили, откладывать ли индексы
+        self._deferred = set()
+        self._columns = None  # заголовок CSV
+        self._partial = []  # начало записи CSV, чьи кавычки закроются в следующей пачке
+        self.line_no = 0
+        self.read = 0
+        self.inserted = 0
+        self.skipped = 0
+        self.owners_cleared = 0
+        self.error_count = 0
+        self.errors = []
+        self.started = time.perf_counter()
+
+    def _error(self, message: str):
+        self.error_count += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({"line": self.line_no, "error": message})
+
+    def _records(self, lines: list):
+        if self.fmt == "csv":
+            # поле в кавычках может содержать перевод строки, а пачка -- оборваться посреди записи:
+            # разбираем строки до последней границы записи (четное число кавычек с начала записи),
+            # хвост ждет следующей пачки. Удвоенная кавычка внутри поля четность не меняет
+            lines = self._partial + list(lines)
+            quoted, complete = False, 0
+            for i, line in enumerate(lines):
+                if line.count('"') % 2:
+                    quoted = not quoted
+                if not quoted:
+                    complete = i + 1
+            lines, self._partial = lines[:complete], lines[complete:]
+            for values in csv.reader(lines):
+                self.line_no += 1
+                if self._columns is None:
+                    self._columns = values
+                elif values:
+                    yield dict(zip(self._columns, values))
+            return
+        for line in lines:
+            self.line_no += 1
+            if line.strip():
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    self._error("неверный JSON")
+
+    # lines -- строки файла (str) с переводом строки, целыми строками
+    def feed(self, lines: list):
+        for record in self._records(lines):
+            try:
+                row = prepare_row(record, self.keep_owners)
+            except (TypeError, ValueError) as e:
+                self._error(str(e))
+                continue
+            self.read += 1
+            if not self.keep_owners and record.get("owner_id") not in (None, ""):
+                self.owners_cleared += 1
+            index = self.storage.shard_index(row[0])
+            pending = self._pending.setdefault(index, [])
+            pending.append(row)
+            if len(pending) >= self.batch_size:
+                self._flush(index)
+
+    # первая пачка в шард: достраиваем индексы прерванной загрузки, в пустом шарде снимаем их
+    def _prepare(self, shard, conn):
+        self._prepared.add(shard.index)
+        if conn.execute("SELECT 1 FROM sequences WHERE name = ?", (DEFERRED_MARKER,)).fetchone():
+            build_indexes(conn)
+        if conn.execute("SELECT 1 FROM links LIMIT 1").fetchone() is None:
+            drop_indexes(conn)
+            self._deferred.add(shard.index)
+
+    def _flush(self, index: int):
+        rows = self._pending.pop(index, None)
+        if not rows:
+            return
+        shard = self.storage.shards[index]
+        conn = shard.connect()
+        try:
+            if index not in self._prepared:
+                self._prepare(shard, conn)
+            with conn:
+                # rowcount executemany -- сумма по строкам, без изменений из триггеров
+                inserted = conn.executemany(INSERT_SQL, rows).rowcount
+        finally:
+            conn.close()
+        self.inserted += inserted
+        self.skipped += len(rows) - inserted
+        # пропущенные коды и так есть в базе (и в фильтре); лишнее увеличение их счетчиков
+        # дает только ложное "может быть", которое уберет пересборка
+        if self.code_filter is not None:
+            self.code_filter.add([row[0] for row in rows])
+
+    def finish(self) -> dict:
+        if self._partial:
+            self.line_no += 1
+            self._error("незакрытые кавычки в конце CSV")
+            self._partial = []
+        for index in list(self._pending):
+            self._flush(index)
+        indexed = time.perf_counter()
+        for index in sorted(self._deferred):
+            conn = self.storage.shards[index].connect()
+            try:
+                build_indexes(conn)
+            finally:
+                conn.close()
+        self._deferred.clear()
+        finished = time.perf_counter()
+        seconds = finished - self.started
+        return {
+            "read": self.read,
+            "inserted": self.inserted,
+            "skipped": self.skipped,
+            "owners_cleared": self.owners_cleared,
+            "errors": self.error_count,
+            "first_errors": self.errors,
+            "seconds": round(seconds, 2),
+            "index_seconds": round(finished - indexed, 2),
+            "rows_per_sec": round(self.read / seconds) if seconds else None,
+        }
+
+
+# онлайн-копия одного файла SQLite через backup API по pages страниц за шаг: между шагами
+# исходная база свободна, и редиректы (и запись) идут как обычно. Запись в исходную базу
+# другим соединением начинает копию заново; после BACKUP_MAX_RESTARTS таких раз остаток
+# копируем одним шагом -- в WAL он тоже не блокирует ни читателей, ни писателя.
+# Копия пишется во временный файл и переименовывается, так что в target всегда целый файл
+def backup_file(source_path: str, target: str, pages: int, pause: float) -> dict:
+    tmp_path = target + ".tmp"
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(tmp_path + suffix):
+            os.unlink(tmp_path + suffix)
+    started = time.perf_counter()
+    restarts = 0
+    remaining_before = None
+
+    class Restarted(Exception):
+        pass
+
+    def progress(status, remaining, total):
+        nonlocal remaining_before, restarts
+        if remaining_before is not None and remaining > remaining_before:
+            restarts += 1
+            if restarts > BACKUP_MAX_RESTARTS:
+                raise Restarted()
+        remaining_before = remaining
+        if pause:
+            time.sleep(pause)
+
+    source = database.open_connection(source_path)
+    dest = sqlite3.connect(tmp_path)
+    try:
+        try:
+            source.backup(dest, pages=pages, progress=progress)
+        except Restarted:
+            source.backup(dest, pages=-1)
+        dest.execute("PRAGMA journal_mode = DELETE")
+        page_count = dest.execute("PRAGMA page_count").fetchone()[0]
+        page_size = dest.execute("PRAGMA page_size").fetchone()[0]
+    finally:
+        dest.close()
+        source.close()
+    os.replace(tmp_path, target)
+    seconds = time.perf_counter() - started
+    return {
+        "source": source_path,
+        "target": target,
+        "bytes": page_count * page_size,
+        "restarts": restarts,
+        "seconds": round(seconds, 2),
+        "mb_per_sec": round(page_count * page_size / 1048576 / seconds, 1) if seconds else None,
+    }
+
+
+# основной файл и файлы шардов -- в каталог directory под своими именами. Файлы копируются
+# по очереди, так что общий момент снимка у них не совпадает
+def backup(storage, directory: str, pages: int = None, pause: float = None) -> list:
+    pages = pages or settings.BACKUP_PAGES
+    pause = settings.BACKUP_PAUSE if pause is None else pause
+    os.makedirs(directory, exist_ok=True)
+    paths = [database.pool.path] + [
+        shard.pool.path for shard in storage.shards if shard.pool is not database.pool
+    ]
+    return [backup_file(path, os.path.join(directory, os.path.basename(path)), pages, pause) for path in paths]
+
+
+def backup_directory() -> str:
+    return os.path.join(settings.BACKUP_DIR, time.strftime("%Y%m%d-%H%M%S"))
+
+
+def lines_in_batches(stream, size: int):
+    batch = []
+    for line in stream:
+        batch.append(line)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command", required=True)
+    export = commands.add_parser("export", help="выгрузить ссылки в stdout или файл")
+    export.add_argument("output", nargs="?", default="-")
+    export.add_argument("--format", choices=FORMATS, default="ndjson")
+    export.add_argument("--batch", type=int, default=settings.EXPORT_BATCH_SIZE)
+    load = commands.add_parser("import", help="загрузить ссылки из stdin или файла")
+    load.add_argument("input", nargs="?", default="-")
+    load.add_argument("--format", choices=FORMATS, default=None, help="по умолчанию по расширению, иначе ndjson")
+    load.add_argument("--batch", type=int, default=settings.IMPORT_BATCH_SIZE)
+    load.add_argument("--short-code-sequence", type=int, default=0, help="short_code_sequence из отчета выгрузки")
+    load.add_argument(
+        "--keep-owners", action="store_true", help="сохранить owner_id (только если учетные записи те же)"
+    )
+    copy = commands.add_parser("backup", help="онлайн-копия файлов базы")
+    copy.add_argument("directory", nargs="?", default="")
+    copy.add_argument("--pages", type=int, default=settings.BACKUP_PAGES)
+    copy.add_argument("--pause", type=float, default=settings.BACKUP_PAUSE)
+    args = parser.parse_args()
+
+    from storage import storage
+    storage.init_schema()
+    try:
+        if args.command == "export":
+            sequence = short_code_sequence()
+            started = time.perf_counter()
+            output = sys.stdout if args.output == "-" else open(args.output, "w", encoding="utf-8", newline="")
+            rows = 0
+            try:
+                for chunk in export_chunks(storage, args.format, args.batch):
+                    output.write(chunk)
+                    rows += chunk.count("\n")
+            finally:
+                if output is not sys.stdout:
+                    output.close()
+            seconds = time.perf_counter() - started
+            report = {
+                "rows": rows - (1 if args.format == "csv" else 0),
+                "short_code_sequence": sequence,
+                "seconds": round(seconds, 2),
+            }
+        elif args.command == "import":
+            fmt = args.format or ("csv" if args.input.endswith(".csv") else "ndjson")
+            # фильтр кодов общий с работающим сервисом: без этого он отвечал бы 404 на загруженные коды.
+            # Если сервис остановлен, фильтр пересоберется при его старте (изменился links_high_water)
+            from codefilter import code_filter
+            shared_filter = code_filter if code_filter.in_use() else None
+            if shared_filter is not None:
+                shared_filter.open()
+            importer = LinkImporter(storage, fmt, args.batch, shared_filter, args.keep_owners)
+            if args.input == "-":
+                sys.stdin.reconfigure(encoding="utf-8", errors="surrogateescape", newline="")
+                source = sys.stdin
+            else:
+                source = open(args.input, encoding="utf-8", errors="surrogateescape", newline="")
+            try:
+                for lines in lines_in_batches(source, args.batch):
+                    importer.feed(lines)
+                report = importer.finish()
+            finally:
+                if source is not sys.stdin:
+                    source.close()
+                code_filter.close()
+            if args.short_code_sequence:
+                advance_short_code_sequence(args.short_code_sequence)
+        else:
+            report = backup(storage, args.directory or backup_directory(), args.pages, args.pause)
+    finally:
+        storage.close()
+        database.pool.close_all()
+    print(json.dumps(report, ensure_ascii=False), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()